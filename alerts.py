@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+阈值告警引擎
+
+定期采集系统指标，按规则判断，条件持续满足指定时长后通过 Incoming Webhook
+主动推送到 Synology Chat；告警期间不重复推送（可配置提醒间隔），恢复时推送恢复通知。
+
+规则语法（ALERT_RULES，分号分隔）:
+    disk > 90                 磁盘使用率超过 90%
+    cpu > 80 for 5m           CPU 持续 5 分钟超过 80%
+    memory >= 95 for 30s
+    load > 8
+    process:nginx missing     进程 nginx 不存在
+    process:redis-server missing for 1m
+
+多个 gunicorn worker 中只有持有 "alerts" 租约的那个负责评估，规则状态保存在共享状态中，
+worker 轮换后去抖和去重状态不丢失。
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+METRIC_NAMES = {'cpu': 'CPU', 'memory': '内存', 'disk': '磁盘', 'load': '负载'}
+
+OPERATORS = {
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+}
+
+_THRESHOLD_RE = re.compile(r'^(cpu|memory|disk|load)\s*(>=|<=|>|<)\s*([\d.]+)%?(?:\s+for\s+(\S+))?$')
+_PROCESS_RE = re.compile(r'^process:(\S+)\s+missing(?:\s+for\s+(\S+))?$')
+
+
+def parse_duration(text: str) -> int:
+    """解析 30s / 5m / 1h / 1d，纯数字按秒"""
+    if not text:
+        return 0
+    match = re.match(r'^(\d+)([smhd]?)$', text.strip())
+    if not match:
+        raise ValueError(f'无法解析时长: {text}')
+    return int(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600} 小时'
+    if seconds >= 60:
+        return f'{seconds // 60} 分钟'
+    return f'{seconds} 秒'
+
+
+class AlertRule:
+    """一条告警规则"""
+
+    def __init__(self, spec: str):
+        self.spec = ' '.join(spec.split())
+        self.process = None
+        self.metric = None
+
+        match = _THRESHOLD_RE.match(self.spec.lower())
+        if match:
+            self.metric, self.op, threshold, duration = match.groups()
+            self.threshold = float(threshold)
+        else:
+            match = _PROCESS_RE.match(self.spec)
+            if not match:
+                raise ValueError(f'无法解析告警规则: {spec}')
+            self.process, duration = match.groups()
+
+        self.duration = parse_duration(duration)
+
+    @property
+    def name(self) -> str:
+        return self.spec
+
+    def check(self, metrics: dict) -> tuple:
+        """返回 (是否触发, 当前值描述)"""
+        if self.process:
+            running = self.process in metrics.get('processes', ())
+            return not running, '运行中' if running else '未运行'
+
+        value = metrics.get(self.metric)
+        if value is None:
+            return False, '无数据'
+        unit = '' if self.metric == 'load' else '%'
+        return OPERATORS[self.op](value, self.threshold), f'{value:.1f}{unit}'
+
+    def describe(self) -> str:
+        if self.process:
+            text = f'进程 {self.process} 未运行'
+        else:
+            unit = '' if self.metric == 'load' else '%'
+            text = f'{METRIC_NAMES[self.metric]} {self.op} {self.threshold:g}{unit}'
+        if self.duration:
+            text += f'（持续 {format_duration(self.duration)}）'
+        return text
+
+
+def parse_rules(spec: str) -> list:
+    """解析 ALERT_RULES，无效规则记录错误并跳过"""
+    rules = []
+    for item in (spec or '').split(';'):
+        if not item.strip():
+            continue
+        try:
+            rules.append(AlertRule(item))
+        except ValueError as e:
+            logger.error(str(e))
+    return rules
+
+
+class AlertEngine:
+    """
+    collect(with_processes: bool) -> dict  采集指标，如 {'cpu': 12.5, 'disk': 91.0, 'processes': [...]}
+    push(text: str) -> dict                推送消息
+    """
+
+    def __init__(self, rules: list, collect, push, state, interval: float = 30, repeat: float = 3600):
+        self.rules = rules
+        self.collect = collect
+        self.push = push
+        self.state = state
+        self.interval = interval
+        self.repeat = repeat
+        self.owner = str(os.getpid())
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _key(self, rule: AlertRule) -> str:
+        return f'alerts:rule:{rule.name}'
+
+    def evaluate(self, now: float = None) -> list:
+        """评估一轮所有规则，返回本轮推送的消息"""
+        now = now or time.time()
+        with_processes = any(rule.process for rule in self.rules)
+        metrics = self.collect(with_processes)
+
+        sent = []
+        for rule in self.rules:
+            key = self._key(rule)
+            st = self.state.get(key) or {'since': None, 'firing': False, 'notified_at': 0}
+            active, value = rule.check(metrics)
+
+            message = None
+            if active:
+                if st['since'] is None:
+                    st['since'] = now
+                if now - st['since'] >= rule.duration:
+                    if not st['firing']:
+                        message = f"🚨 **告警** {rule.describe()}\n当前: {value}"
+                    elif self.repeat and now - st['notified_at'] >= self.repeat:
+                        message = (f"🚨 **告警持续中** {rule.describe()}\n"
+                                   f"当前: {value}，已持续 {format_duration(now - st['since'])}")
+                    if message:
+                        st['firing'] = True
+                        st['notified_at'] = now
+            else:
+                if st['firing']:
+                    message = f"✅ **已恢复** {rule.describe()}\n当前: {value}"
+                st = {'since': None, 'firing': False, 'notified_at': 0}
+
+            st['value'] = value
+            self.state.set(key, st)
+
+            if message:
+                result = self.push(message)
+                if not result.get('success'):
+                    logger.error(f"告警推送失败: {result.get('error')}")
+                sent.append(message)
+
+        return sent
+
+    def status_text(self) -> str:
+        """/alerts 的回复内容"""
+        if not self.rules:
+            return "🔕 未配置告警规则（.env 中的 ALERT_RULES）"
+
+        output = f"🔔 **告警规则**（每 {format_duration(self.interval)} 检查）\n\n"
+        for rule in self.rules:
+            st = self.state.get(self._key(rule)) or {}
+            emoji = '🚨' if st.get('firing') else ('⏳' if st.get('since') else '✅')
+            output += f"{emoji} {rule.describe()} - 当前: {st.get('value', '未检查')}\n"
+        return output
+
+    # ===================== 后台调度 =====================
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if self.state.acquire_lease('alerts', self.owner, ttl=self.interval * 3):
+                    self.evaluate()
+            except Exception as e:
+                logger.error(f"告警评估失败: {str(e)}", exc_info=True)
+
+    def start(self):
+        if not self.rules or self._thread:
+            return
+        self.owner = str(os.getpid())
+        self._thread = threading.Thread(target=self._run, name='alert-engine', daemon=True)
+        self._thread.start()
+        logger.info(f"告警引擎已启动: {len(self.rules)} 条规则，间隔 {self.interval} 秒")
+
+    def stop(self):
+        self._stop.set()
+        self.state.release_lease('alerts', self.owner)
@@ -9,21 +9,45 @@ import json
 import logging
 import subprocess
 import psutil
+import time
 import uuid
+import threading
 import re
+import hashlib
+import hmac
 from datetime import datetime
 from pathlib import Path
-from flask import Flask, request, jsonify
+from urllib.parse import quote
+from flask import Flask, request, jsonify, send_file, Response
 from dotenv import load_dotenv
 from zhipuai import ZhipuAI
 
+from shared_state import SharedState, SingleFlight
+from notifier import MessageSender, split_message
+from alerts import AlertEngine, parse_rules
+from command_cache import CommandCache, split_force, format_age
+from fanout import FanoutClient, parse_hosts, parse_groups, render_sys_table, render_shell_results, ALL
+from shell_sessions import SessionPool
+from profiler import Profiler, traced
+from usage import UsageTracker, choose_model, extract_usage
+from metrics_store import MetricsStore, MetricsRecorder, collect_process_samples, history_text
+from downloads import resolve_allowed, make_link, verify_link, should_compress, gzip_stream, format_size
+from file_catalog import CatalogStore, parse_query, run_query, render_result, parse_natural
+from planner import PlanRunner, make_plan, looks_multi_step, render_plan, render_step
+from task_store import TaskStore, TaskMaintainer, parse_retention
+from deadline import deadline_scope, budget, run_within, start_late, wait_late
+from log_setup import setup_logging, log_context, get_context, update_context, log_extra, parse_sample_rates
+
 # 加载环境变量
 load_dotenv()
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# 配置日志（队列化、JSON 结构化，可按类别采样）
+setup_logging(
+    level=os.getenv('LOG_LEVEL', 'INFO'),
+    log_file=os.path.expanduser(os.getenv('LOG_FILE', '')) or None,
+    sample_rates=parse_sample_rates(os.getenv('LOG_SAMPLE', '')),
+    max_bytes=int(os.getenv('LOG_MAX_BYTES', 0)),
+    backup_count=int(os.getenv('LOG_BACKUPS', 5))
 )
 logger = logging.getLogger(__name__)
 
@@ -34,8 +58,67 @@ CONFIG = {
     'port': int(os.getenv('PORT', 5001)),
     'glm_api_key': os.getenv('GLM_API_KEY', ''),
     'glm_model': os.getenv('GLM_MODEL', 'glm-4-plus'),
+    'glm_fast_model': os.getenv('GLM_FAST_MODEL', ''),
+    'fast_max_tokens': int(os.getenv('FAST_MAX_TOKENS', 1024)),
+    'route_short_chars': int(os.getenv('ROUTE_SHORT_CHARS', 60)),
+    'token_budget_user_daily': int(os.getenv('TOKEN_BUDGET_USER_DAILY', 0)),
+    'token_budget_daily': int(os.getenv('TOKEN_BUDGET_DAILY', 0)),
     'max_tokens': int(os.getenv('MAX_TOKENS', 4096)),
     'tasks_dir': os.path.expanduser('~/SynologyChatbotClaude/tasks'),
+    'state_db': os.path.expanduser(os.getenv('STATE_DB', '~/SynologyChatbotClaude/state.db')),
+    'idempotency_ttl': int(os.getenv('IDEMPOTENCY_TTL', 300)),
+    'idempotency_wait': int(os.getenv('IDEMPOTENCY_WAIT', 25)),
+    'webhook_url': os.getenv('SYNOLOGY_CHAT_WEBHOOK_URL', ''),
+    'alert_rules': os.getenv('ALERT_RULES', ''),
+    'alert_interval': int(os.getenv('ALERT_INTERVAL', 30)),
+    'alert_repeat': int(os.getenv('ALERT_REPEAT', 3600)),
+    'message_max_chars': int(os.getenv('MESSAGE_MAX_CHARS', 2000)),
+    'message_max_chunks': int(os.getenv('MESSAGE_MAX_CHUNKS', 10)),
+    'webhook_rate': float(os.getenv('WEBHOOK_RATE', 1.0)),
+    'webhook_burst': int(os.getenv('WEBHOOK_BURST', 3)),
+    'webhook_batch_window': float(os.getenv('WEBHOOK_BATCH_WINDOW', 0.5)),
+    'cache_ttl': int(os.getenv('CACHE_TTL', 10)),
+    'cache_commands': [c.strip() for c in os.getenv('CACHE_COMMANDS', '').split(',') if c.strip()],
+    'app_mode': os.getenv('APP_MODE', 'bot'),
+    'agent_token': os.getenv('AGENT_TOKEN', ''),
+    'fanout_hosts': parse_hosts(os.getenv('FANOUT_HOSTS', '')),
+    'fanout_groups': parse_groups(os.getenv('FANOUT_GROUPS', '')),
+    'fanout_timeout': float(os.getenv('FANOUT_TIMEOUT', 15)),
+    'shell_sessions': os.getenv('SHELL_SESSIONS', 'true').lower() in ('1', 'true', 'yes'),
+    'shell_pool_size': int(os.getenv('SHELL_POOL_SIZE', 2)),
+    'shell_max_sessions': int(os.getenv('SHELL_MAX_SESSIONS', 16)),
+    'shell_idle_timeout': int(os.getenv('SHELL_IDLE_TIMEOUT', 900)),
+    'admin_token': os.getenv('ADMIN_TOKEN', ''),
+    'admin_users': [u.strip() for u in os.getenv('ADMIN_USERS', '').split(',') if u.strip()],
+    'profile_dir': os.path.expanduser(os.getenv('PROFILE_DIR', '~/SynologyChatbotClaude/profiles')),
+    'profile_interval': float(os.getenv('PROFILE_INTERVAL', 0.005)),
+    'metrics_history': os.getenv('METRICS_HISTORY', 'true').lower() in ('1', 'true', 'yes'),
+    'metrics_dir': os.path.expanduser(os.getenv('METRICS_DIR', '~/SynologyChatbotClaude/metrics')),
+    'metrics_interval': int(os.getenv('METRICS_INTERVAL', 10)),
+    'metrics_processes': [p.strip() for p in os.getenv('METRICS_PROCESSES', '').split(',') if p.strip()],
+    'metrics_top_processes': int(os.getenv('METRICS_TOP_PROCESSES', 5)),
+    'metrics_max_series': int(os.getenv('METRICS_MAX_SERIES', 64)),
+    'metrics_series_expire': int(os.getenv('METRICS_SERIES_EXPIRE', 7 * 86400)),
+    'allowed_paths': [p.strip() for p in os.getenv('ALLOWED_PATHS', '~').split(',') if p.strip()],
+    'download_secret': os.getenv('DOWNLOAD_SECRET', ''),
+    'public_base_url': os.getenv('PUBLIC_BASE_URL', ''),
+    'download_ttl': int(os.getenv('DOWNLOAD_TTL', 600)),
+    'catalog_dir': os.path.expanduser(os.getenv('CATALOG_DIR', '~/SynologyChatbotClaude/catalog')),
+    'catalog_max_age': int(os.getenv('CATALOG_MAX_AGE', 3600)),
+    'graceful_timeout': int(os.getenv('GRACEFUL_TIMEOUT', 60)),
+    'allowed_commands': {c.strip() for c in os.getenv(
+        'ALLOWED_COMMANDS', 'ls,cd,pwd,cat,echo,grep,find,ps,kill,top,df,du,whoami,date,head,tail,wc').split(',')
+        if c.strip()},
+    'planner': os.getenv('PLANNER', 'true').lower() in ('1', 'true', 'yes'),
+    'plan_max_workers': int(os.getenv('PLAN_MAX_WORKERS', 4)),
+    'plan_step_timeout': int(os.getenv('PLAN_STEP_TIMEOUT', 30)),
+    'task_retention': parse_retention(os.getenv('TASK_RETENTION', 'completed=30d,failed=30d,pending=90d,processing=90d')),
+    'task_blob_threshold': int(os.getenv('TASK_BLOB_THRESHOLD', 4096)),
+    'task_blob_codec': os.getenv('TASK_BLOB_CODEC', 'lzma'),
+    'task_maintain_interval': int(os.getenv('TASK_MAINTAIN_INTERVAL', 3600)),
+    'request_deadline': float(os.getenv('REQUEST_DEADLINE', 20)),
+    'deadline_reserve': float(os.getenv('DEADLINE_RESERVE', 1.5)),
+    'llm_timeout': float(os.getenv('LLM_TIMEOUT', 60)),
 }
 
 # 初始化 API 客户端
@@ -46,9 +129,51 @@ if CONFIG['glm_api_key']:
 # 确保任务目录存在
 Path(CONFIG['tasks_dir']).mkdir(parents=True, exist_ok=True)
 
+# 跨 worker 共享状态（缓存、计数器、会话）
+shared_state = SharedState(CONFIG['state_db'])
+
+# Incoming Webhook 限速批量发送
+message_sender = MessageSender(CONFIG['webhook_url'], shared_state,
+                               rate=CONFIG['webhook_rate'], burst=CONFIG['webhook_burst'],
+                               limit=CONFIG['message_max_chars'],
+                               batch_window=CONFIG['webhook_batch_window'])
+
+# 只读命令结果缓存
+command_cache = CommandCache(shared_state, ttl=CONFIG['cache_ttl'],
+                             allowed=set(CONFIG['cache_commands']) or None)
+
+# 每用户常驻 Shell 会话（/cd 之后 /ls 保持目录）
+shell_pool = None
+if CONFIG['shell_sessions']:
+    shell_pool = SessionPool(shared_state, warm=CONFIG['shell_pool_size'],
+                             max_sessions=CONFIG['shell_max_sessions'],
+                             idle_timeout=CONFIG['shell_idle_timeout'])
+
+# 多主机并发执行（控制端）
+fanout_client = FanoutClient(CONFIG['fanout_hosts'], CONFIG['fanout_groups'], CONFIG['agent_token'],
+                             timeout=CONFIG['fanout_timeout'])
+
+# LLM Token 用量统计与预算
+usage_tracker = UsageTracker(shared_state, user_budget=CONFIG['token_budget_user_daily'],
+                             daily_budget=CONFIG['token_budget_daily'])
+
+# 任务文件（紧凑 JSON + 大结果压缩归档 + 摘要索引）
+task_store = TaskStore(CONFIG['tasks_dir'], shared_state, retention=CONFIG['task_retention'],
+                       blob_threshold=CONFIG['task_blob_threshold'], codec=CONFIG['task_blob_codec'])
+
+# 目录扫描结果（列式文件目录），供 /query 查询
+catalog_store = CatalogStore(CONFIG['catalog_dir'], max_age=CONFIG['catalog_max_age'])
+
+# 按需请求剖析
+profiler = Profiler(shared_state, CONFIG['profile_dir'], interval=CONFIG['profile_interval'])
+
+# Synology 重发的 Webhook 只处理一次
+webhook_flight = SingleFlight(shared_state, 'webhook', result_ttl=CONFIG['idempotency_ttl'])
+
 
 # ===================== 意图识别 =====================
 
+@traced('classify_intent')
 def classify_intent(message: str) -> dict:
     """
     使用 GLM-4 分类用户意图
@@ -59,6 +184,11 @@ def classify_intent(message: str) -> dict:
         'extracted': dict  # 提取的参数
     }
     """
+    # 剩余时间不够一次 LLM 调用或当日总预算已用完时按 chat 处理
+    limit = budget(CONFIG['llm_timeout'], CONFIG['deadline_reserve'])
+    if limit < 1 or usage_tracker.over_daily_budget():
+        return {'intent': 'chat', 'confidence': 0.0, 'extracted': {}}
+
     try:
         prompt = f"""你是一个意图分类助手。分析用户消息，判断意图类型。
 
@@ -78,12 +208,16 @@ def classify_intent(message: str) -> dict:
     "extracted": {{"path": "路径", "command": "命令"}}
 }}"""
 
+        # 分类是简单任务，配置了快速模型时优先使用
+        model = CONFIG['glm_fast_model'] or CONFIG['glm_model']
         response = glm_client.chat.completions.create(
-            model=CONFIG['glm_model'],
+            model=model,
             messages=[{"role": "user", "content": prompt}],
             max_tokens=500,
-            temperature=0.1
+            temperature=0.1,
+            timeout=limit
         )
+        usage_tracker.record(get_context().get('user'), 'classify', model, extract_usage(response))
 
         result_text = response.choices[0].message.content.strip()
 
@@ -91,7 +225,8 @@ def classify_intent(message: str) -> dict:
         json_match = re.search(r'\{.*\}', result_text, re.DOTALL)
         if json_match:
             result = json.loads(json_match.group())
-            logger.info(f"意图识别: {result['intent']} (置信度: {result.get('confidence', 0)})")
+            logger.info('意图识别', extra=log_extra('intent', intent=result['intent'],
+                                                    confidence=result.get('confidence', 0)))
             return result
         else:
             logger.warning(f"无法解析意图，默认为 chat")
@@ -102,27 +237,66 @@ def classify_intent(message: str) -> dict:
         return {'intent': 'chat', 'confidence': 0.0, 'extracted': {}}
 
 
+# ===================== 截止时间 =====================
+# webhook() 为每个请求设置截止时间（REQUEST_DEADLINE），各阶段按剩余时间设置超时；
+# 来不及完成的先回复部分结果，其余部分完成后通过 Incoming Webhook 推送
+
+def push_later(render):
+    """截止时间后才完成的结果用 render 渲染后推送；未配置 Incoming Webhook 时返回 None"""
+    if not message_sender.enabled:
+        return None
+    return lambda result: message_sender.send(render(result))
+
+
 # ===================== 系统命令 =====================
 
+def collect_metrics(cpu_interval: float = None, with_processes: bool = False) -> dict:
+    """
+    采集原始数值指标（百分比 / 字节），供系统信息、告警等复用
+
+    cpu_interval=None 时不阻塞，返回距上次调用以来的 CPU 平均使用率
+    """
+    memory = psutil.virtual_memory()
+    disk = psutil.disk_usage('/')
+
+    metrics = {
+        'cpu': psutil.cpu_percent(interval=cpu_interval),
+        'memory': memory.percent,
+        'memory_used': memory.used,
+        'memory_total': memory.total,
+        'disk': disk.percent,
+        'disk_used': disk.used,
+        'disk_total': disk.total,
+        'load': os.getloadavg()[0] if hasattr(os, 'getloadavg') else None,
+    }
+
+    if with_processes:
+        metrics['processes'] = sorted({
+            proc.info['name'] for proc in psutil.process_iter(['name']) if proc.info['name']
+        })
+
+    return metrics
+
+
+@traced('system_info')
 def get_system_info() -> dict:
     """获取系统信息"""
     try:
-        cpu = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory()
-        disk = psutil.disk_usage('/')
+        m = collect_metrics(cpu_interval=1)
 
         return {
             'success': True,
             'data': {
-                'CPU': f'{cpu}%',
-                '内存': f'{memory.percent}% ({memory.used / 1024**3:.1f}GB / {memory.total / 1024**3:.1f}GB)',
-                '磁盘': f'{disk.percent}% ({disk.used / 1024**3:.1f}GB / {disk.total / 1024**3:.1f}GB)',
+                'CPU': f"{m['cpu']}%",
+                '内存': f"{m['memory']}% ({m['memory_used'] / 1024**3:.1f}GB / {m['memory_total'] / 1024**3:.1f}GB)",
+                '磁盘': f"{m['disk']}% ({m['disk_used'] / 1024**3:.1f}GB / {m['disk_total'] / 1024**3:.1f}GB)",
             }
         }
     except Exception as e:
         return {'success': False, 'error': str(e)}
 
 
+@traced('list_directory')
 def list_directory(path: str = None) -> dict:
     """列出目录内容"""
     try:
@@ -153,104 +327,396 @@ def list_directory(path: str = None) -> dict:
         return {'success': False, 'error': str(e)}
 
 
-def analyze_directory(path: str = None) -> dict:
-    """分析目录"""
+def _directory_summary(target_path: str, catalog) -> dict:
+    # 最大的文件
+    top_files = [(f, f"{s / 1024**2:.1f}MB") for f, s in catalog.largest(10)]
+
+    return {
+        'success': True,
+        'path': target_path,
+        'summary': {
+            '文件数': catalog.count,
+            '目录数': catalog.meta['dirs'],
+            '总大小': f"{catalog.total_size() / 1024**3:.2f}GB",
+            '最大文件': top_files[0] if top_files else None
+        },
+        'top_files': top_files
+    }
+
+
+@traced('analyze_directory')
+def analyze_directory(path: str = None, on_late=None) -> dict:
+    """
+    分析目录。截止时间到了还没扫描完时返回 partial 结果（已扫描的比例、目前最大的文件），
+    扫描在后台继续，完成后以完整结果调用 on_late
+    """
     try:
         target_path = os.path.expanduser(path) if path else os.path.expanduser('~/Downloads')
 
         if not os.path.exists(target_path):
             return {'success': False, 'error': f'路径不存在: {target_path}'}
 
-        total_size = 0
-        file_count = 0
-        dir_count = 0
-        largest_files = []
+        # 遍历的同时生成列式文件目录，之后的 /query 不必再次遍历
+        progress = {}
+        on_time, catalog = run_within(
+            lambda: catalog_store.scan(target_path, progress),
+            on_late and (lambda c: on_late(_directory_summary(target_path, c))),
+            reserve=CONFIG['deadline_reserve'])
+        if not on_time:
+            logger.info(f"目录扫描超出截止时间，后台继续: {target_path}")
+            return {'success': True, 'partial': True, 'path': target_path, 'progress': dict(progress)}
+        return _directory_summary(target_path, catalog)
+    except Exception as e:
+        return {'success': False, 'error': str(e)}
 
-        for root, dirs, files in os.walk(target_path):
-            dir_count += len(dirs)
-            for file in files:
-                file_path = os.path.join(root, file)
-                try:
-                    size = os.path.getsize(file_path)
-                    total_size += size
-                    file_count += 1
-                    largest_files.append((file_path, size))
-                except:
-                    pass
 
-        # 排序找出最大的文件
-        largest_files.sort(key=lambda x: x[1], reverse=True)
-        top_files = [(f, f"{s / 1024**2:.1f}MB") for f, s in largest_files[:10]]
+def format_analysis(result: dict) -> str:
+    if not result['success']:
+        return f"❌ 分析失败: {result['error']}"
+
+    if result.get('partial'):
+        progress = result['progress']
+        output = f"⏳ **目录分析** - {result['path']}\n\n"
+        output += (f"已扫描约 {progress.get('fraction', 0):.0%}：{progress.get('files', 0):,} 个文件，"
+                   f"{progress.get('bytes', 0) / 1024**3:.2f}GB\n")
+        if progress.get('largest'):
+            output += f"\n📦 **目前最大的文件**\n"
+            for size, f in progress['largest']:
+                output += f"- {f.split('/')[-1]}: {size / 1024**2:.1f}MB\n"
+        if message_sender.enabled:
+            return output + "\n扫描仍在进行，完成后推送完整结果"
+        return output + "\n扫描在后台继续，稍后可用 /query 查看"
+
+    summary = result['summary']
+    output = f"📁 **目录分析** - {result['path']}\n\n"
+    output += f"📊 **统计**\n"
+    output += f"- 文件数: {summary['文件数']:,}\n"
+    output += f"- 目录数: {summary['目录数']:,}\n"
+    output += f"- 总大小: {summary['总大小']}\n"
+
+    if summary.get('最大文件'):
+        output += f"\n📦 **最大的文件**\n"
+        for f, size in result['top_files'][:5]:
+            fname = f.split('/')[-1]
+            output += f"- {fname}: {size}\n"
+
+    return output
+
+
+DANGEROUS_COMMANDS = ['rm -rf /', 'rm -rf /*', 'mkfs', 'format', ':(){:|:&};:']
+
+
+def is_dangerous(command: str) -> bool:
+    """危险命令检查"""
+    return any(danger in command.lower() for danger in DANGEROUS_COMMANDS)
 
-        return {
-            'success': True,
-            'path': target_path,
-            'summary': {
-                '文件数': file_count,
-                '目录数': dir_count,
-                '总大小': f"{total_size / 1024**3:.2f}GB",
-                '最大文件': top_files[0] if top_files else None
-            },
-            'top_files': top_files
-        }
-    except Exception as e:
-        return {'success': False, 'error': str(e)}
+
+def _finish_command(proc, timeout: float, on_late):
+    """截止时间之后继续等待命令结束，把完整结果交给 on_late"""
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+        result = {'success': proc.returncode == 0, 'output': stdout if stdout else stderr,
+                  'return_code': proc.returncode}
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        result = {'success': False, 'error': '❌ 命令超时'}
+    on_late(result)
 
 
-def execute_shell_command(command: str, timeout: int = 30) -> dict:
-    """执行 Shell 命令"""
+@traced('shell.spawn')
+def execute_shell_command(command: str, timeout: int = 30, on_late=None) -> dict:
+    """
+    执行 Shell 命令。截止时间先于 timeout 到达时：有 on_late 则先返回已有的输出（partial），
+    命令继续执行，结束后以完整结果调用 on_late；没有 on_late 则按超时处理
+    """
     try:
         # 安全检查
-        dangerous = ['rm -rf /', 'rm -rf /*', 'mkfs', 'format', ':(){:|:&};:']
-        if any(danger in command.lower() for danger in dangerous):
+        if is_dangerous(command):
             return {'success': False, 'error': '❌ 危险命令已阻止'}
 
-        result = subprocess.run(
+        limit = budget(timeout, CONFIG['deadline_reserve'])
+        proc = subprocess.Popen(
             command,
             shell=True,
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             text=True,
-            timeout=timeout,
             cwd=os.path.expanduser('~')
         )
 
-        output = result.stdout if result.stdout else result.stderr
+        try:
+            stdout, stderr = proc.communicate(timeout=limit)
+        except subprocess.TimeoutExpired as e:
+            if on_late is None or limit >= timeout:
+                proc.kill()
+                proc.communicate()
+                return {'success': False, 'error': '❌ 命令超时'}
+            start_late(_finish_command, proc, timeout - limit, on_late, name='shell-late')
+            partial = e.stdout or b''
+            return {
+                'success': True,
+                'partial': True,
+                'output': partial.decode('utf-8', 'replace') if isinstance(partial, bytes) else partial,
+                'return_code': None
+            }
+
+        output = stdout if stdout else stderr
 
         return {
-            'success': result.returncode == 0,
+            'success': proc.returncode == 0,
             'output': output,
-            'return_code': result.returncode
+            'return_code': proc.returncode
         }
 
-    except subprocess.TimeoutExpired:
-        return {'success': False, 'error': '❌ 命令超时'}
     except Exception as e:
         return {'success': False, 'error': f'❌ 错误: {str(e)}'}
 
 
-def call_glm_api(message: str) -> str:
-    """调用 GLM API 进行对话"""
+@traced('shell.session')
+def execute_in_session(user: str, command: str, timeout: int = 30, on_late=None) -> dict:
+    """在用户的常驻 Shell 会话中执行命令（保留 cwd 和环境变量）；截止时间的处理同 execute_shell_command"""
+    if is_dangerous(command):
+        return {'success': False, 'error': '❌ 危险命令已阻止'}
+    try:
+        if on_late is None:
+            return shell_pool.run(user, command, budget(timeout, CONFIG['deadline_reserve']))
+        on_time, result = run_within(lambda: shell_pool.run(user, command, timeout), on_late,
+                                     reserve=CONFIG['deadline_reserve'])
+        # 会话的输出在命令结束时才一起读出，没有部分输出
+        return result if on_time else {'success': True, 'partial': True, 'output': '', 'return_code': None}
+    except Exception as e:
+        return {'success': False, 'error': f'❌ 错误: {str(e)}'}
+
+
+@traced('llm')
+def call_glm_api(message: str, intent: str = 'chat') -> str:
+    """调用 GLM API 进行对话（按复杂度和预算选择模型，记录 token 用量）"""
     if not glm_client:
         return "⚠️ GLM API 未配置。请在 .env 文件中设置 GLM_API_KEY。\n\n注意：系统命令仍然可以正常使用，如：\n- \"帮我分析下下载目录\"\n- \"看看系统状态\"\n- \"列出文件\""
 
-    try:
-        response = glm_client.chat.completions.create(
-            model=CONFIG['glm_model'],
-            messages=[{"role": "user", "content": message}],
-            max_tokens=CONFIG['max_tokens']
-        )
+    user = get_context().get('user')
+    if usage_tracker.over_daily_budget():
+        return "⚠️ 今日 Token 总预算已用完，AI 对话暂停到明天。\n\n💡 系统命令仍然可以正常使用。"
 
-        reply = response.choices[0].message.content
-        logger.info(f"GLM API 调用成功")
-        return reply
+    model = choose_model(message, CONFIG['glm_model'], CONFIG['glm_fast_model'],
+                         short_chars=CONFIG['route_short_chars'],
+                         downgrade=usage_tracker.over_user_budget(user))
+    max_tokens = CONFIG['max_tokens'] if model == CONFIG['glm_model'] else CONFIG['fast_max_tokens']
+
+    def chat(timeout: float) -> str:
+        try:
+            response = glm_client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": message}],
+                max_tokens=max_tokens,
+                timeout=timeout
+            )
+
+            usage = extract_usage(response)
+            usage_tracker.record(user, intent, model, usage)
+            reply = response.choices[0].message.content
+            logger.info('GLM API 调用成功', extra=log_extra('llm', model=model, intent=intent, **usage))
+            return reply
+
+        except Exception as e:
+            logger.error(f"调用 GLM API 失败: {str(e)}")
+            return f"⚠️ 调用 GLM API 出错: {str(e)}\n\n💡 请检查 API 密钥配置或使用系统命令功能。"
+
+    # 截止时间前没有回复：先告知用户，回复生成后推送
+    on_late = push_later(lambda reply: reply)
+    if on_late is None:
+        return chat(budget(CONFIG['llm_timeout'], CONFIG['deadline_reserve']))
+    on_time, reply = run_within(lambda: chat(CONFIG['llm_timeout']), on_late, reserve=CONFIG['deadline_reserve'])
+    return reply if on_time else "⏳ AI 还在思考，回复生成后推送..."
 
-    except Exception as e:
-        logger.error(f"调用 GLM API 失败: {str(e)}")
-        return f"⚠️ 调用 GLM API 出错: {str(e)}\n\n💡 请检查 API 密钥配置或使用系统命令功能。"
+
+# ===================== 只读命令缓存 =====================
+
+def run_cached(key: str, compute, fresh: bool = False, cwd: str = None, on_late=None, pending: dict = None) -> tuple:
+    """
+    按规范化命令 + 工作目录缓存 compute 的结果，返回 (结果, 回复末尾的缓存说明)。
+    相同的请求正在执行、截止时间前等不到时返回 pending（不重复执行），结果之后交给 on_late
+    """
+    result = command_cache.run(key, cwd or os.path.expanduser('~'), compute, fresh, on_late)
+    if result['source'] == 'pending':
+        return pending or {'success': False, 'error': '⏳ 相同的请求正在执行，请稍后再试'}, ''
+    note = format_age(result['age']) if result['source'] == 'cache' else ''
+    return result['value'], note
+
+
+def run_shell(cmd: str, timeout: int = 30, on_late=None) -> tuple:
+    """
+    执行 Shell 命令；有用户身份且启用了会话时在该用户的常驻 Shell 中执行。
+    只读命令按 (命令, 工作目录) 走缓存，末尾的 ! 表示强制刷新；
+    截止时间前未完成的返回 partial 结果，完整结果交给 on_late
+    """
+    user = get_context().get('user')
+    if shell_pool and user:
+        cwd = shell_pool.cwd_for(user)
+        execute = lambda c: execute_in_session(user, c, timeout, on_late)
+    else:
+        cwd = None
+        execute = lambda c: execute_shell_command(c, timeout, on_late)
+
+    base, fresh = split_force(cmd)
+    normalized = command_cache.classify(base)
+    if normalized:
+        # 挂靠的命令没在截止时间前结束：按"仍在运行"回复，结果出来后推送
+        pending = {'success': True, 'partial': True, 'output': '', 'pending': True} if on_late else None
+        result, note = run_cached(normalized, lambda: execute(base), fresh, cwd=cwd,
+                                  on_late=on_late, pending=pending)
+        if result.get('partial') and not result.get('pending'):
+            command_cache.forget(normalized, cwd or os.path.expanduser('~'))
+        return result, note
+    return execute(cmd), ''
+
+
+def format_command_result(result: dict, note: str = '') -> str:
+    if result.get('partial'):
+        output = result['output'].strip()
+        reply = "⏳ **命令仍在运行**，结束后推送完整输出"
+        return reply + (f"\n\n目前的输出:\n```\n{output}\n```" if output else '')
+    if result['success']:
+        output = result['output'].strip()
+        if not output:
+            return "✅ **命令执行成功**（无输出）" + note
+        return f"✅ **命令执行成功**\n\n```\n{output}\n```" + note
+    return f"❌ **命令执行失败**\n\n{result.get('error', '未知错误')}"
+
+
+# ===================== 多主机 =====================
+
+@traced('fanout')
+def fanout_process(message: str):
+    """
+    /cmd @group、$cmd @group、$sys @all、"看看所有服务器状态" 分发到多台主机；
+    不是多主机请求时返回 None。只在快捷命令、$ 命令和自然语言分支中调用，内置命令（/task 等）不会被分发
+    """
+    if not fanout_client.enabled:
+        return None
+
+    if any(kw in message for kw in ['所有服务器', '全部服务器']):
+        body, names, op = 'sys', fanout_client.resolve(ALL), 'sys'
+    elif message.startswith(('/', '$')):
+        target = fanout_client.split_target(message[1:])
+        if not target:
+            return None
+        body, names = target
+        op = 'sys' if message.startswith('$') and body == 'sys' else 'shell'
+    else:
+        return None
+
+    if not names:
+        return "❌ 目标组中没有已配置的主机"
+
+    update_context(handler='fanout')
+    logger.info('多主机执行', extra=log_extra('command', op=op, hosts=len(names)))
+    # 每台主机的超时不超过请求的剩余时间
+    limit = budget(CONFIG['fanout_timeout'], CONFIG['deadline_reserve'])
+    results = fanout_client.run(names, {'op': op, 'command': body}, timeout=limit)
+    if op == 'sys':
+        return render_sys_table(results)
+    return render_shell_results(body, results)
+
+
+# ===================== 多步骤任务 =====================
+
+def _plan_llm(prompt: str) -> str:
+    """让 LLM 以 JSON 输出执行计划"""
+    model = CONFIG['glm_fast_model'] or CONFIG['glm_model']
+    response = glm_client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=CONFIG['fast_max_tokens'],
+        temperature=0.1,
+        response_format={'type': 'json_object'},
+        timeout=budget(CONFIG['llm_timeout'], CONFIG['deadline_reserve'])
+    )
+    usage_tracker.record(get_context().get('user'), 'plan', model, extract_usage(response))
+    return response.choices[0].message.content.strip()
+
+
+def _plan_shell(step: dict, inputs: list) -> dict:
+    # 每个步骤独立的子进程，互不等待（用户的常驻 Shell 同一时间只能执行一条命令）
+    result = execute_shell_command(step['args'], timeout=CONFIG['plan_step_timeout'])
+    return {'success': result['success'], 'text': result.get('output') or result.get('error', '')}
+
+
+def _plan_sysinfo(step: dict, inputs: list) -> dict:
+    result = get_system_info()
+    if not result['success']:
+        return {'success': False, 'text': result['error']}
+    return {'success': True, 'text': '\n'.join(f"{k}: {v}" for k, v in result['data'].items())}
+
+
+def _plan_analyze_dir(step: dict, inputs: list) -> dict:
+    result = analyze_directory(step['args'] or None)
+    if not result['success']:
+        return {'success': False, 'text': result['error']}
+    if result.get('partial'):
+        progress = result['progress']
+        return {'success': False, 'text': f"⏱️ 截止时间前只扫描了约 {progress.get('fraction', 0):.0%}"
+                                          f"（{progress.get('files', 0):,} 个文件）"}
+    summary = result['summary']
+    lines = [f"{result['path']}: {summary['文件数']} 个文件, {summary['目录数']} 个目录, 共 {summary['总大小']}"]
+    lines += [f"{size:>10}  {name}" for name, size in result['top_files']]
+    return {'success': True, 'text': '\n'.join(lines)}
+
+
+def _plan_summarize(step: dict, inputs: list) -> dict:
+    material = '\n\n'.join(f"## {r['title']}{'' if r['success'] else '（失败）'}\n{r['text'][:3000]}"
+                           for r in inputs)
+    prompt = f"用户请求: {step['args']}\n\n以下是各步骤的执行结果，请用中文简要总结，并指出需要注意的问题：\n\n{material}"
+    return {'success': True, 'text': call_glm_api(prompt, intent='plan')}
+
+
+plan_runner = PlanRunner({
+    'shell': _plan_shell,
+    'sysinfo': _plan_sysinfo,
+    'analyze_dir': _plan_analyze_dir,
+    'summarize': _plan_summarize,
+}, max_workers=CONFIG['plan_max_workers'], step_timeout=CONFIG['plan_step_timeout'])
+
+
+def plan_process(message: str):
+    """
+    complex 意图：拆成步骤 DAG 并行执行。
+    配置了 Incoming Webhook 时先回复计划，各步骤完成后逐条推送；否则等全部完成后一起回复。
+    拆不出多个步骤时返回 None，交给普通对话处理
+    """
+    plan = make_plan(message, CONFIG['allowed_commands'])
+    if plan.get('rejected'):
+        update_context(handler='plan')
+        return f"❌ 无法执行计划: {plan['error']}"
+    # 规则拆不出来时让 LLM 规划，同一次调用判断是否需要多个步骤（不再单独做意图识别）；
+    # 剩余时间不够一次规划调用或当日总预算已用完时直接交给普通对话（由它回复预算提示）
+    if not plan['success'] and glm_client and not usage_tracker.over_daily_budget() \
+            and budget(CONFIG['llm_timeout'], CONFIG['deadline_reserve']) >= 5:
+        plan = make_plan(message, CONFIG['allowed_commands'], ask=_plan_llm)
+    if not plan['success']:
+        logger.info(f"未生成执行计划: {plan['error']}")
+        return None
+
+    steps = plan['steps']
+    update_context(handler='plan')
+    logger.info('执行计划', extra=log_extra('plan', steps=len(steps), source=plan['source']))
+
+    if message_sender.enabled:
+        def push(result):
+            message_sender.send(render_step(result))
+
+        # 后台线程沿用当前请求的日志上下文（用户、请求 ID），不受请求截止时间限制
+        start_late(plan_runner.run, steps, push, name='plan')
+        return render_plan(steps) + "\n⏳ 每个步骤完成后推送结果"
+
+    results = plan_runner.run(steps)
+    return render_plan(steps) + '\n' + '\n\n'.join(render_step(r) for r in results)
 
 
 # ===================== 智能处理器 =====================
 
+@traced('smart_process')
 def smart_process(message: str) -> str:
     """智能处理用户消息"""
 
@@ -258,28 +724,56 @@ def smart_process(message: str) -> str:
 
     # ========== 系统命令（快捷方式）==========
     if message.startswith('$'):
+        # 多主机（$sys @all、$cmd @group）
+        reply = fanout_process(message)
+        if reply:
+            return reply
         # 手动命令模式
+        update_context(handler='legacy_command')
         return process_command(message)
 
+    # ========== 内置命令 ==========
+    if message == '/profile' or message.startswith('/profile '):
+        update_context(handler='profile')
+        return profile_command(message)
+
+    if message == '/usage' or message.startswith('/usage '):
+        update_context(handler='usage')
+        return usage_tracker.report_text(message.split()[1:], get_context().get('user'))
+
+    if message == '/alerts':
+        update_context(handler='alerts')
+        return alert_engine.status_text()
+
+    if message.startswith(('/get ', '发送文件')) or message == '/get':
+        update_context(handler='get_file')
+        return send_file_command(message)
+
+    if message == '/query' or message.startswith('/query '):
+        update_context(handler='file_query')
+        return query_command(message[len('/query'):])
+
+    if message == '/history' or message.startswith('/history '):
+        update_context(handler='history')
+        return history_text(metrics_store, message[len('/history'):])
+
     # ========== 快捷命令模式 ==========
     if message.startswith('/') and not message.startswith(('/task ', '/status ', '/tasks')):
+        # 多主机（/cmd @group）
+        reply = fanout_process(message)
+        if reply:
+            return reply
         # 处理 /pwd, /ls, /whoami 等快捷命令
         cmd = message[1:].strip()
         if cmd:
-            logger.info(f"快捷命令: {cmd}")
-            result = execute_shell_command(cmd)
-            if result['success']:
-                output = result['output'].strip()
-                if not output:
-                    return "✅ **命令执行成功**（无输出）"
-                if len(output) > 1000:
-                    output = output[:1000] + "\n... (输出已截断)"
-                return f"✅ **命令执行成功**\n\n```\n{output}\n```"
-            else:
-                return f"❌ **命令执行失败**\n\n{result.get('error', '未知错误')}"
+            update_context(handler='quick_command')
+            logger.info('快捷命令', extra=log_extra('command', command=cmd.split()[0]))
+            result, note = run_shell(cmd, on_late=push_later(format_command_result))
+            return format_command_result(result, note)
 
     # ========== 帮助命令 ==========
     if message in ['/help', '帮助', 'help']:
+        update_context(handler='help')
         return """🤖 Synology Chat 智能助手
 
 💬 **直接说**：
@@ -287,11 +781,13 @@ def smart_process(message: str) -> str:
    "看看系统状态"
    "列出文件"
    "执行 ls 命令"
+   "检查磁盘和最大的日志文件并总结"（多个步骤并行执行）
 
 💻 **快捷命令**：
    /pwd              - 显示当前目录
    /ls               - 列出文件
    /whoami           - 显示当前用户
+   /cd <目录>        - 切换目录（之后的命令在该目录执行）
    /<命令>           - 执行任意命令
 
 📋 **任务系统**：
@@ -299,6 +795,35 @@ def smart_process(message: str) -> str:
    /status <id>      - 查看任务状态
    /tasks            - 查看所有任务
 
+🔔 **告警**：
+   /alerts           - 查看告警规则和状态
+
+📎 **文件下载**：
+   /get <路径>       - 生成短期有效的下载链接（-z 压缩传输）
+   "发送文件 ~/logs/app.log"
+
+🗂️ **文件查询**（基于最近一次目录分析）：
+   /query size>100M age>1y    - 一年以前且大于 100MB 的文件
+   /query ~/Downloads by ext  - 按扩展名统计（by dir / by month）
+   "这周改了什么文件"
+
+📉 **指标历史**：
+   /history cpu 12h  - CPU 走势（也支持 内存/磁盘/负载/进程名）
+   "昨晚 CPU 和内存怎么样"
+
+📈 **用量**：
+   /usage [7d] [me]  - Token 用量（按用户/意图/模型）
+
+🔬 **剖析**（管理员）：
+   /profile on 5     - 剖析接下来的 5 个请求
+   /profile          - 查看各阶段耗时汇总
+   /profile off      - 关闭
+
+🖥️ **多主机**（需配置 FANOUT_HOSTS）：
+   /<命令> @<组>     - 在一组主机上并发执行，如 /df -h @web
+   $sys @all         - 所有主机的系统状态
+   "看看所有服务器状态"
+
 💻 **传统命令模式**：
    $sys              - 系统信息
    $ps               - 进程列表
@@ -306,6 +831,7 @@ def smart_process(message: str) -> str:
 
     # ========== 任务系统命令 ==========
     if message.startswith('/task '):
+        update_context(handler='task')
         task_desc = message[6:].strip()
         result = create_task('claude_code', task_desc)
         if result['success']:
@@ -330,7 +856,7 @@ def smart_process(message: str) -> str:
             status_emoji = {'pending': '⏳', 'processing': '🔄', 'completed': '✅', 'failed': '❌'}
             output = f"{status_emoji.get(task['status'], '📝')} [{task['id']}] {task['description']}\n状态: {task['status']}"
             if task.get('result'):
-                output += f"\n\n📤 结果:\n{task['result'][:500]}"
+                output += f"\n\n📤 结果:\n{task['result']}"
             return output
         return f"❌ {result['error']}"
 
@@ -346,12 +872,41 @@ def smart_process(message: str) -> str:
         return "📝 暂无任务"
 
     # ========== 智能意图识别 + 自动执行 ==========
-    logger.info(f"智能处理消息: {message}")
+    logger.debug('智能处理消息', extra=log_extra('request', chars=len(message)))
+    _, fresh = split_force(message)
+
+    # 模式 -2: 所有服务器的状态（"看看所有服务器状态"）
+    reply = fanout_process(message)
+    if reply:
+        return reply
+
+    # 模式 -1: 多步骤任务（"检查磁盘和最大的日志文件并总结"），先于单项关键词匹配
+    if CONFIG['planner'] and looks_multi_step(message):
+        reply = plan_process(message)
+        if reply:
+            return reply
+
+    # 模式 0: 指标历史（"昨晚 CPU 怎么样"、"过去 6 小时内存"、"今天 CPU 走势"），
+    # 必须有明确的历史说法，"今天的磁盘状态"、"最近内存占用" 仍然查询当前状态
+    # 英文词按单词匹配（"download" 不算 load）；中文字符也属于 \w，所以不用 \b
+    history_range = (r'历史|趋势|走势|曲线|昨晚|昨夜|昨天|\d+\s*(分钟|小时|天)|'
+                     r'(?<![a-z0-9])(history|trend|overnight|last night|yesterday|\d+[mhd])(?![a-z])')
+    history_metrics = r'内存|磁盘|负载|(?<![a-z])(cpu|memory|disk|load)(?![a-z])'
+    if re.search(history_range, message_lower) and re.search(history_metrics, message_lower):
+        update_context(handler='history')
+        return history_text(metrics_store, message)
+
+    # 模式 0.5: 文件查询（"一年以前且大于 100MB 的文件"、"按扩展名统计"、"这周改了什么"）
+    file_query = parse_natural(message) if re.search(r'文件|扩展名|改了什么', message) else None
+    if file_query:
+        update_context(handler='file_query')
+        return query_command(file_query + ('!' if fresh else ''))
 
     # 模式 1: 系统信息查询
     system_keywords = ['系统', '状态', 'cpu', '内存', '磁盘', 'system']
     if any(kw in message_lower for kw in system_keywords):
-        result = get_system_info()
+        update_context(handler='system')
+        result, note = run_cached('$sys', get_system_info, fresh)
         if result['success']:
             output = "📊 **系统状态**\n\n"
             for key, value in result['data'].items():
@@ -367,10 +922,12 @@ def smart_process(message: str) -> str:
                     output += f"```\n{bar} {value}\n```\n"
                 else:
                     output += f"**{key}**: {value}\n"
-            return output
+            return output + note
+        return f"❌ {result['error']}"
 
     # 模式 2: 目录分析
     if '分析' in message and ('目录' in message or '文件夹' in message or '下载' in message):
+        update_context(handler='analyze_dir')
         # 提取路径
         path = None
         if '下载' in message or 'download' in message_lower:
@@ -380,24 +937,7 @@ def smart_process(message: str) -> str:
         elif '桌面' in message or 'desktop' in message_lower:
             path = '~/Desktop'
 
-        result = analyze_directory(path)
-        if result['success']:
-            summary = result['summary']
-            output = f"📁 **目录分析** - {result['path']}\n\n"
-            output += f"📊 **统计**\n"
-            output += f"- 文件数: {summary['文件数']:,}\n"
-            output += f"- 目录数: {summary['目录数']:,}\n"
-            output += f"- 总大小: {summary['总大小']}\n"
-
-            if summary.get('最大文件'):
-                output += f"\n📦 **最大的文件**\n"
-                for f, size in result['top_files'][:5]:
-                    fname = f.split('/')[-1]
-                    output += f"- {fname}: {size}\n"
-
-            return output
-        else:
-            return f"❌ 分析失败: {result['error']}"
+        return format_analysis(analyze_directory(path, on_late=push_later(format_analysis)))
 
     # 模式 3: 执行命令（优先级高于列出文件）
     if message.startswith('执行') or message.startswith('run') or message.startswith('运行'):
@@ -408,21 +948,14 @@ def smart_process(message: str) -> str:
             # 移除末尾的"命令"二字（例如："执行 pwd 命令" -> "pwd"）
             cmd = re.sub(r'\s*命令\s*$', '', cmd).strip()
 
-            logger.info(f"执行命令: {cmd}")
-            result = execute_shell_command(cmd)
-            if result['success']:
-                output = result['output'].strip()
-                if not output:
-                    return "✅ **命令执行成功**（无输出）"
-                # 截断过长的输出
-                if len(output) > 1000:
-                    output = output[:1000] + "\n... (输出已截断)"
-                return f"✅ **命令执行成功**\n\n```\n{output}\n```"
-            else:
-                return f"❌ **命令执行失败**\n\n{result.get('error', '未知错误')}"
+            update_context(handler='exec')
+            logger.info('执行命令', extra=log_extra('command', command=cmd.split()[0] if cmd else ''))
+            result, note = run_shell(cmd, on_late=push_later(format_command_result))
+            return format_command_result(result, note)
 
     # 模式 4: 列出文件
     if '列表' in message or '列出' in message or 'ls' in message_lower or ('文件' in message and '列出' in message):
+        update_context(handler='list_dir')
         # 尝试提取路径
         path = None
         if '下载' in message or 'download' in message_lower:
@@ -434,19 +967,18 @@ def smart_process(message: str) -> str:
         elif '当前' in message:
             path = '.'
 
-        result = list_directory(path)
+        result, note = run_cached(f'list_directory {path}', lambda: list_directory(path), fresh)
         if result['success']:
             output = f"📁 **{result['path']}**\n\n"
-            for entry in result['entries'][:20]:
+            for entry in result['entries']:
                 output += f"{entry}\n"
-            if len(result['entries']) > 20:
-                output += f"\n... 还有 {len(result['entries']) - 20} 项"
-            return output
+            return output + note
         else:
             return f"❌ 列出失败: {result['error']}"
 
     # 模式 5: 进程查询
     if '进程' in message or 'process' in message_lower or '运行' in message:
+        update_context(handler='process')
         try:
             processes = []
             for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent']):
@@ -470,6 +1002,7 @@ def smart_process(message: str) -> str:
             return f"❌ 获取进程失败: {str(e)}"
 
     # 默认：普通对话
+    update_context(handler='chat')
     return call_glm_api(message)
 
 
@@ -478,10 +1011,10 @@ def process_command(message: str) -> str:
     parts = message[1:].strip().split(maxsplit=1)
     cmd = parts[0] if parts else ''
 
-    if cmd == 'sys':
-        result = get_system_info()
+    if cmd in ('sys', 'sys!'):
+        result, note = run_cached('$sys', get_system_info, fresh=cmd.endswith('!'))
         if result['success']:
-            return '\n'.join([f"{k}: {v}" for k, v in result['data'].items()])
+            return '\n'.join([f"{k}: {v}" for k, v in result['data'].items()]) + note
         return f"错误: {result['error']}"
 
     elif cmd == 'ps' or cmd == 'top':
@@ -509,9 +1042,11 @@ def process_command(message: str) -> str:
         if not shell_cmd:
             return "用法: $ command"
 
-        result = execute_shell_command(shell_cmd)
+        result, note = run_shell(shell_cmd, on_late=push_later(format_command_result))
+        if result.get('partial'):
+            return format_command_result(result)
         output = result.get('output', '') or result.get('error', '')
-        return output if output else "命令执行完成，无输出"
+        return (output if output else "命令执行完成，无输出") + note
 
 
 def create_task(task_type: str, description: str) -> dict:
@@ -528,54 +1063,382 @@ def create_task(task_type: str, description: str) -> dict:
         'error': None
     }
 
-    task_file = os.path.join(CONFIG['tasks_dir'], f'{task_id}.json')
-    with open(task_file, 'w', encoding='utf-8') as f:
-        json.dump(task, f, ensure_ascii=False, indent=2)
-
+    task_store.create(task)
     logger.info(f"任务已创建: {task_id}")
     return {'success': True, 'task_id': task_id, 'task': task}
 
 
 def get_task(task_id: str) -> dict:
-    """获取任务"""
-    task_file = os.path.join(CONFIG['tasks_dir'], f'{task_id}.json')
-    if not os.path.exists(task_file):
-        return {'success': False, 'error': f'任务不存在: {task_id}'}
+    """获取任务（含已归档的结果）"""
+    return task_store.get(task_id)
 
-    with open(task_file, 'r', encoding='utf-8') as f:
-        task = json.load(f)
 
-    return {'success': True, 'task': task}
+def list_tasks() -> dict:
+    """列出所有任务的摘要（不含结果），新的在前"""
+    return {'success': True, 'tasks': task_store.list()}
 
 
-def list_tasks() -> dict:
-    """列出所有任务"""
-    tasks = []
-    for filename in os.listdir(CONFIG['tasks_dir']):
-        if filename.endswith('.json'):
-            task_file = os.path.join(CONFIG['tasks_dir'], filename)
-            with open(task_file, 'r', encoding='utf-8') as f:
-                task = json.load(f)
-                tasks.append(task)
+# 定期压缩已结束任务的结果、按保留期删除旧任务
+task_maintainer = TaskMaintainer(task_store, shared_state, interval=CONFIG['task_maintain_interval'])
+task_maintainer.start()
+
+
+# ===================== 主动告警 =====================
+
+alert_engine = AlertEngine(
+    parse_rules(CONFIG['alert_rules']),
+    collect=lambda with_processes: collect_metrics(with_processes=with_processes),
+    push=message_sender.send,
+    state=shared_state,
+    interval=CONFIG['alert_interval'],
+    repeat=CONFIG['alert_repeat']
+)
+if CONFIG['webhook_url']:
+    alert_engine.start()
+
+
+# ===================== 指标历史 =====================
+
+metrics_store = MetricsStore(CONFIG['metrics_dir'], max_series=CONFIG['metrics_max_series'],
+                             expire=CONFIG['metrics_series_expire'])
+
+
+def collect_history_samples() -> dict:
+    """主机指标 + 按进程名汇总的 CPU/内存"""
+    m = collect_metrics()
+    samples = {name: m[name] for name in ('cpu', 'memory', 'disk', 'load')}
+    samples.update(collect_process_samples(CONFIG['metrics_processes'], CONFIG['metrics_top_processes']))
+    return samples
+
+
+metrics_recorder = MetricsRecorder(metrics_store, collect_history_samples, shared_state,
+                                   interval=CONFIG['metrics_interval'])
+if CONFIG['metrics_history']:
+    metrics_recorder.start()
+
+
+# ===================== 平滑重启 =====================
+# 由 gunicorn.conf.py 的钩子调用：HUP 时先启动新 worker，旧 worker 收到 SIGTERM 后
+# 处理完当前请求再退出；未发出的推送经共享状态交给新 worker
+
+# 本 worker 的启动时间和状态，restart.sh 据此判断新 worker 是否已就绪
+lifecycle = {'started_at': time.time(), 'draining': False, 'drain_started': None}
+
+# gunicorn 强制结束前留给租约释放、关闭会话的时间（秒）
+HANDOVER_MARGIN = 2
+
+
+def begin_drain():
+    """收到 SIGTERM：/health 返回 503，不再被当作就绪"""
+    lifecycle['draining'] = True
+    lifecycle['drain_started'] = time.time()
+
+
+def warm_up():
+    """worker 开始接收请求前：建立共享状态连接、取 CPU 采样基线，并接管上一代 worker 留下的推送"""
+    shared_state.get('lifecycle:warm_up')
+    collect_metrics()
+    threading.Thread(target=adopt_handover, name='handover', daemon=True).start()
+
+
+def _save_pushes(pending: list):
+    if pending:
+        shared_state.set(f'handover:push:{os.getpid()}:{uuid.uuid4().hex[:8]}', pending, ttl=3600)
+        logger.info(f"移交未发出的推送: {len(pending)} 条")
+
+
+def handover():
+    """
+    worker 退出前：先保存未发出的推送，再用 gunicorn 强制结束前剩下的时间等待截止时间后仍在执行的工作
+    （它们的推送由本 worker 继续发送，最后仍未发出的再保存一次），释放后台任务租约让新 worker 立即接手
+    """
+    # gunicorn 从 SIGTERM 起 graceful_timeout 秒后强制结束 worker，排空进行中的请求已经用掉了一部分
+    kill_at = (lifecycle['drain_started'] or time.time()) + CONFIG['graceful_timeout'] - HANDOVER_MARGIN
+    remaining = lambda: max(0.0, kill_at - time.time())
+
+    # 正在发送的那条留给最后一次 handover，避免发出后又被新 worker 重发
+    _save_pushes(message_sender.handover(inflight=False))
+    running = wait_late(max(0.0, remaining() - 5))
+    if running:
+        logger.warning(f"仍有 {running} 个后台任务未完成，它们的结果不会被推送")
+    _save_pushes(message_sender.handover(timeout=min(5, remaining())))
+
+    alert_engine.stop()
+    metrics_recorder.stop()
+    task_maintainer.stop()
+    if shell_pool:
+        shell_pool.close_all()
+
+
+def adopt_handover():
+    """启动后的一段时间内（覆盖旧 worker 的排空时间）接管其他 worker 移交的推送"""
+    own = f'handover:push:{os.getpid()}:'
+    deadline = time.time() + CONFIG['graceful_timeout'] + 30
+    while time.time() < deadline:
+        for key, texts in shared_state.items('handover:push:'):
+            # delete 成功的 worker 才负责发送，避免重复
+            if not key.startswith(own) and shared_state.delete(key):
+                logger.info(f"接管推送: {len(texts)} 条")
+                for text in texts:
+                    message_sender.send(text)
+        time.sleep(2)
+
+
+# ===================== 文件查询 =====================
+
+@traced('file_query')
+def query_command(text: str) -> str:
+    """/query 查询语句（末尾加 ! 重新扫描）；未指定目录时用最近扫描的目录"""
+    text, fresh = split_force(text)
+    try:
+        query = parse_query(text)
+    except (ValueError, re.error) as e:
+        return (f"❌ {str(e)}\n\n用法: /query [目录] [size>100M] [age>1y] [ext=mp4,mkv] [name~关键字] "
+                f"[by ext|dir|month] [sort size|mtime|age] [top 20]")
+
+    root = query['root'] or catalog_store.latest_root() or '~/Downloads'
+    if not os.path.isdir(os.path.expanduser(root)):
+        return f"❌ 目录不存在: {root}"
+
+    # 没有扫描结果或已过期时需要重新遍历：截止时间前扫不完就先回复进度，扫完后推送查询结果
+    render = lambda catalog: render_result(run_query(catalog, query), query['group'])
+    progress = {}
+    on_time, catalog = run_within(lambda: catalog_store.get(root, max_age=0 if fresh else None, progress=progress),
+                                  push_later(render), reserve=CONFIG['deadline_reserve'])
+    if on_time:
+        return render(catalog)
+    reply = (f"⏳ 正在扫描 {root}：已扫描约 {progress.get('fraction', 0):.0%}，"
+             f"{progress.get('files', 0):,} 个文件")
+    return reply + ("\n完成后推送查询结果" if message_sender.enabled else "\n扫描在后台继续，稍后再查询")
+
+
+# ===================== 文件下载 =====================
+
+def send_file_command(message: str) -> str:
+    """/get [-z] <路径> 或 "发送文件 <路径>"：回复短期有效的签名下载链接"""
+    if not CONFIG['download_secret'] or not CONFIG['public_base_url']:
+        return "❌ 未配置 DOWNLOAD_SECRET 和 PUBLIC_BASE_URL，无法生成下载链接"
+
+    path = re.sub(r'^(/get|发送文件)\s*', '', message).strip()
+    compress = path.startswith('-z ')
+    if compress:
+        path = path[3:].strip()
+    if not path:
+        return "用法: /get <路径>（加 -z 压缩传输），或 \"发送文件 <路径>\""
+
+    # 相对路径按用户 Shell 会话的当前目录解析
+    user = get_context().get('user')
+    base = shell_pool.cwd_for(user) if shell_pool and user else os.path.expanduser('~')
+    result = resolve_allowed(os.path.join(base, os.path.expanduser(path)), CONFIG['allowed_paths'])
+    if not result['success']:
+        return f"❌ {result['error']}"
+
+    path = result['path']
+    compress = compress and should_compress(path)
+    link = make_link(CONFIG['public_base_url'], path, CONFIG['download_secret'],
+                     ttl=CONFIG['download_ttl'], compress=compress)
+    logger.info('生成下载链接', extra=log_extra('download', size=os.path.getsize(path), compress=compress))
+
+    return (f"📎 **{os.path.basename(path)}**（{format_size(os.path.getsize(path))}"
+            f"{'，gzip 压缩传输' if compress else ''}）\n\n{link}\n\n"
+            f"⏱️ {CONFIG['download_ttl'] // 60} 分钟内有效")
+
 
-    tasks.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-    return {'success': True, 'tasks': tasks}
+# ===================== 管理 =====================
+
+def is_admin() -> bool:
+    """当前用户是否为管理员；未配置 ADMIN_USERS 时所有人都是管理员"""
+    return not CONFIG['admin_users'] or str(get_context().get('user')) in CONFIG['admin_users']
+
+
+def profile_command(message: str) -> str:
+    """/profile [on N | off | reset]"""
+    if not is_admin():
+        return "❌ 只有管理员可以使用 /profile"
+
+    args = message.split()[1:]
+    if args and args[0] == 'on':
+        count = int(args[1]) if len(args) > 1 and args[1].isdigit() else 5
+        profiler.enable(count)
+        return f"🔬 已开启剖析：接下来的 {count} 个请求\n完成后发送 /profile 查看结果"
+    if args and args[0] == 'off':
+        profiler.disable()
+        return "🔬 已关闭剖析"
+    if args and args[0] == 'reset':
+        profiler.reset()
+        return "🔬 剖析统计已清空"
+    return profiler.summary_text()
+
+
+def wants_profile() -> bool:
+    """带管理员令牌的 X-Profile 头，或 /profile on 剩余名额"""
+    if request.headers.get('X-Profile') and CONFIG['admin_token']:
+        if hmac.compare_digest(request.headers.get('X-Admin-Token', ''), CONFIG['admin_token']):
+            return True
+    return profiler.claim()
+
+
+# ===================== 幂等处理 =====================
+
+def idempotency_key(data: dict):
+    """
+    Synology 重发请求的去重键：优先 post_id / message_id，
+    否则用 user_id + text + timestamp；没有时间戳时无法区分重发和用户重复发送，返回 None
+    """
+    message_id = data.get('post_id') or data.get('message_id')
+    if message_id:
+        return f"post:{message_id}"
+
+    if data.get('timestamp'):
+        raw = f"{data.get('user_id', '')}|{data.get('text', '')}|{data['timestamp']}"
+        return 'msg:' + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    return None
+
+
+@traced('deliver_reply')
+def deliver_reply(reply: str) -> str:
+    """
+    长回复在代码块/行边界处切分：第一段作为 Webhook 响应直接返回，
+    其余段通过 Incoming Webhook 限速推送；未配置 Incoming Webhook 时只返回第一段
+    """
+    chunks = split_message(reply, CONFIG['message_max_chars'] - 80)
+    if len(chunks) == 1:
+        return reply
+
+    if not message_sender.enabled:
+        return chunks[0] + (f"\n\n... (输出过长，仅显示第 1/{len(chunks)} 段；"
+                            f"配置 SYNOLOGY_CHAT_WEBHOOK_URL 后可接收完整输出)")
+
+    shown = chunks[:CONFIG['message_max_chunks']]
+    for index, chunk in enumerate(shown[1:], start=2):
+        # 稍作延迟，让第一段（Webhook 响应）先显示
+        message_sender.send(f"({index}/{len(shown)})\n{chunk}", delay=1.0)
+    if len(chunks) > len(shown):
+        message_sender.send(f"... 输出过长，省略剩余 {len(chunks) - len(shown)} 段", delay=1.0)
+
+    return chunks[0] + f"\n\n📨 (1/{len(shown)}) 其余内容随后发送"
+
+
+def process_once(data: dict, user_message: str) -> str:
+    """同一条消息的重发挂靠到正在执行的计算上，已完成的直接返回缓存结果"""
+    key = idempotency_key(data)
+    if key is None:
+        return deliver_reply(smart_process(user_message))
+
+    # 切分推送放在 compute 内，重发的请求不会重复推送后续段
+    # 重发的请求最多等到截止时间，之后回复"仍在处理中"
+    result = webhook_flight.do(key, lambda: deliver_reply(smart_process(user_message)),
+                               wait=budget(CONFIG['idempotency_wait'], CONFIG['deadline_reserve']))
+    if result['source'] == 'pending':
+        return "⏳ 这条消息仍在处理中，请稍候..."
+    if result['source'] != 'computed':
+        logger.info(f"重复请求 {key}，复用结果（{result['source']}）")
+    return result['value']
 
 
 # ===================== API 端点 =====================
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    """健康检查"""
+    """健康检查（排空中的 worker 返回 503）"""
+    if lifecycle['draining']:
+        return jsonify({'status': 'draining', 'pid': os.getpid()}), 503
     return jsonify({
         'status': 'healthy',
+        'mode': CONFIG['app_mode'],
+        'pid': os.getpid(),
+        'started_at': lifecycle['started_at'],
         'features': ['nlp', 'auto_execute', 'system_monitoring', 'glm_chat']
     })
 
 
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def admin_profile():
+    """剖析汇总；?file=<名称> 下载 .folded / .spans.json；POST {"enable": N} 剖析接下来 N 个请求"""
+    token = request.headers.get('X-Admin-Token', '')
+    if not CONFIG['admin_token'] or not hmac.compare_digest(token, CONFIG['admin_token']):
+        return jsonify({'error': 'forbidden'}), 403
+
+    filename = request.args.get('file')
+    if filename:
+        path = os.path.join(CONFIG['profile_dir'], os.path.basename(filename))
+        if not os.path.isfile(path):
+            return jsonify({'error': 'not found'}), 404
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read(), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+    if request.method == 'POST':
+        count = (request.get_json(silent=True) or {}).get('enable')
+        if not isinstance(count, int) or count < 0:
+            return jsonify({'error': 'enable 应为非负整数'}), 400
+        profiler.enable(count)
+
+    return jsonify({
+        'remaining': profiler.remaining(),
+        'top_spans': profiler.summary(),
+        'files': profiler.recent_files(20)
+    })
+
+
+@app.route('/agent/run', methods=['POST'])
+def agent_run():
+    """agent 端：执行控制端分发的命令"""
+    token = request.headers.get('X-Agent-Token', '')
+    if not CONFIG['agent_token'] or not hmac.compare_digest(token, CONFIG['agent_token']):
+        return jsonify({'success': False, 'error': 'forbidden'}), 403
+
+    payload = request.get_json(silent=True) or {}
+    timeout = max(1, int(payload.get('timeout', 15)) - 1)
+
+    if payload.get('op') == 'sys':
+        try:
+            return jsonify({'success': True, 'metrics': collect_metrics(cpu_interval=0.5)})
+        except Exception as e:
+            return jsonify({'success': False, 'error': str(e)})
+
+    if payload.get('op') == 'shell' and payload.get('command'):
+        result, _ = run_shell(payload['command'], timeout=timeout)
+        return jsonify(result)
+
+    return jsonify({'success': False, 'error': f"未知操作: {payload.get('op')}"}), 400
+
+
+@app.route('/download', methods=['GET'])
+def download():
+    """签名链接下载：不压缩时走 sendfile 并支持 Range，压缩时流式 gzip"""
+    if not CONFIG['download_secret']:
+        return jsonify({'error': 'download disabled'}), 404
+
+    result = verify_link(request.args, CONFIG['download_secret'])
+    if not result['success']:
+        return jsonify({'error': result['error']}), 403
+
+    # 签名后文件可能被替换成指向别处的符号链接，这里再检查一次
+    allowed = resolve_allowed(result['path'], CONFIG['allowed_paths'])
+    if not allowed['success']:
+        return jsonify({'error': allowed['error']}), 403
+    path = allowed['path']
+    logger.info('文件下载', extra=log_extra('download', size=os.path.getsize(path),
+                                           range=bool(request.range), compress=result['compress']))
+
+    # 断点续传按原始字节计算，有 Range 时不压缩
+    accepts_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    if result['compress'] and accepts_gzip and not request.range:
+        return Response(gzip_stream(path), mimetype='application/octet-stream', headers={
+            'Content-Encoding': 'gzip',
+            'Content-Disposition': f"attachment; filename*=UTF-8''{quote(os.path.basename(path))}",
+        })
+
+    return send_file(path, as_attachment=True, conditional=True, max_age=0)
+
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """接收 Synology Chat Webhook"""
+    if CONFIG['app_mode'] == 'agent':
+        return jsonify({'error': 'agent mode'}), 404
+
     try:
         # 获取请求数据
         content_type = request.content_type
@@ -585,18 +1448,34 @@ def webhook():
         else:
             data = {
                 'text': request.form.get('text') or request.values.get('text', ''),
-                'user_id': request.form.get('user_id') or request.values.get('user_id')
+                'user_id': request.form.get('user_id') or request.values.get('user_id'),
+                'post_id': request.form.get('post_id') or request.values.get('post_id'),
+                'timestamp': request.form.get('timestamp') or request.values.get('timestamp')
             }
 
         if not data or not data.get('text'):
             return jsonify({'error': 'No data received'}), 400
 
-        logger.info(f"收到消息: {data.get('text', '')[:50]}")
-
         user_message = data.get('text', '').strip()
 
-        # 智能处理
-        reply = smart_process(user_message)
+        request_id = uuid.uuid4().hex[:12]
+        # Synology 只等待有限时间：各阶段按剩余时间安排，来不及的先回复部分结果
+        with log_context(request_id=request_id, user=data.get('user_id')), \
+                deadline_scope(CONFIG['request_deadline']):
+            # 用户原文不写日志，只记录长度
+            logger.info('收到消息', extra=log_extra('request', chars=len(user_message)))
+            start = time.perf_counter()
+
+            profile = wants_profile() and profiler.start(request_id)
+            try:
+                # 智能处理（重发的请求只执行一次）
+                reply = process_once(data, user_message)
+            finally:
+                if profile:
+                    profiler.finish(*profile)
+
+            logger.info('请求完成', extra=log_extra(
+                'request', duration_ms=round((time.perf_counter() - start) * 1000, 1)))
 
         return jsonify({'text': reply}), 200
 
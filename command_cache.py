@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+只读命令的短时结果缓存
+
+/df -h、/whoami、$sys、"列出文件" 这类只读查询每次都要新起一个 /bin/sh 或遍历目录。
+白名单内、且不含管道/重定向等 shell 元字符的命令被视为只读，结果按
+"规范化命令 + 工作目录" 缓存 CACHE_TTL 秒，并发的相同请求只执行一次。
+命令末尾加 ! 可跳过缓存强制重新执行。
+截止时间前没等到正在执行的相同命令时不再重复执行，先回复"仍在执行"，结果出来后再交给 on_late。
+"""
+
+import os
+import shlex
+import hashlib
+import logging
+
+from shared_state import SingleFlight
+from deadline import budget, start_late
+
+logger = logging.getLogger(__name__)
+
+# 默认视为只读的命令
+DEFAULT_READ_ONLY = {
+    'df', 'du', 'free', 'uptime', 'whoami', 'id', 'hostname', 'uname', 'pwd',
+    'ls', 'date', 'w', 'who', 'ps', 'vm_stat', 'sw_vers', 'nproc', 'lsblk',
+}
+
+# 出现这些字符时命令可能有副作用（重定向、管道、命令替换、串联），不缓存
+SHELL_META = set(';&|<>`$()\n\\')
+
+FORCE_SUFFIX = '!'
+
+
+def split_force(text: str) -> tuple:
+    """去掉末尾的 ! 强制刷新标记，返回 (文本, 是否强制刷新)"""
+    text = text.rstrip()
+    if text.endswith(FORCE_SUFFIX) and len(text) > 1:
+        return text[:-1].rstrip(), True
+    return text, False
+
+
+def normalize_read_only(command: str, allowed: set = None):
+    """只读命令返回规范化后的命令（用作缓存键），否则返回 None"""
+    if not command or any(ch in SHELL_META for ch in command):
+        return None
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        return None
+    if not tokens or os.path.basename(tokens[0]) not in (allowed or DEFAULT_READ_ONLY):
+        return None
+    return ' '.join(shlex.quote(token) for token in tokens)
+
+
+def format_age(age: float) -> str:
+    """回复末尾的缓存说明"""
+    return f"\n\n🕒 {int(age)} 秒前的结果（末尾加 {FORCE_SUFFIX} 强制刷新）"
+
+
+class CommandCache:
+    """按 (规范化命令, 工作目录) 缓存结果，底层是共享状态上的 SingleFlight"""
+
+    def __init__(self, state, ttl: float = 10, allowed: set = None):
+        self.ttl = ttl
+        self.allowed = allowed or DEFAULT_READ_ONLY
+        self.flight = SingleFlight(state, 'cmdcache', result_ttl=ttl, lock_ttl=60)
+
+    def classify(self, command: str):
+        return normalize_read_only(command, self.allowed)
+
+    @staticmethod
+    def key(normalized: str, cwd: str = '') -> str:
+        return hashlib.sha1(f'{normalized}\0{cwd}'.encode('utf-8')).hexdigest()
+
+    def forget(self, normalized: str, cwd: str = ''):
+        """丢弃缓存的结果（如截止时间到了只拿到部分输出）"""
+        self.flight.forget(self.key(normalized, cwd))
+
+    def run(self, normalized: str, cwd: str, compute, fresh: bool = False, on_late=None) -> dict:
+        """
+        返回 SingleFlight 的结果: {'value', 'source', 'age'}；ttl 为 0 时不缓存，直接执行。
+        截止时间前相同的命令还没执行完时返回 source='pending'，之后拿到结果交给 on_late(value)
+        """
+        if not self.ttl:
+            return {'value': compute(), 'source': 'computed', 'age': 0.0}
+        # 挂靠其他请求的执行结果时，最多等到本请求的截止时间
+        key = self.key(normalized, cwd)
+        result = self.flight.do(key, compute, wait=budget(60), fresh=fresh)
+        if result['source'] == 'pending' and on_late:
+            start_late(self._join_late, key, compute, on_late, name='cmdcache-late')
+        return result
+
+    def _join_late(self, key: str, compute, on_late):
+        result = self.flight.do(key, compute, wait=self.flight.lock_ttl)
+        if result['source'] == 'pending':
+            logger.warning('等待相同命令的执行结果超时')
+            return
+        on_late(result['value'])
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+请求截止时间
+
+Synology Outgoing Webhook 只等待有限的时间，超时后会重发。webhook() 为每个请求创建一个
+Deadline（contextvar，线程池中复制上下文即可带过去），各处理阶段据此决定自己的预算：
+
+    budget(30)                子调用的超时：30 秒与剩余时间中较小者，没有截止时间时为 30
+    run_within(fn, on_late)   在后台线程执行 fn，截止前完成就直接返回结果；
+                              否则先返回 (False, None)，fn 完成后调用 on_late(结果)，
+                              由调用方先回复已有的部分结果、其余部分之后推送
+
+后台继续执行的工作不再受截止时间限制（detach）。这些线程都通过 start_late 启动并登记：
+- 平滑重启时 handover() 用 wait_late 等它们结束，结果推送进队列后再移交给新 worker
+- 请求正在被剖析时，采样器同时采样这些线程（否则请求线程只会停在等待上）
+"""
+
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from profiler import sampled_thread
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('deadline', default=None)
+
+
+class Deadline:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+@contextmanager
+def deadline_scope(seconds: float):
+    """在 with 块内设置截止时间，seconds <= 0 表示不限制"""
+    token = _current.set(Deadline(seconds) if seconds and seconds > 0 else None)
+    try:
+        yield _current.get()
+    finally:
+        _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+def budget(cap: float, reserve: float = 0) -> float:
+    """子调用可用的时间：cap 与（剩余时间 - reserve）中较小者"""
+    deadline = _current.get()
+    if deadline is None:
+        return cap
+    return max(0.0, min(cap, deadline.remaining() - reserve))
+
+
+def detach(fn, *args):
+    """返回一个可在其他线程执行的函数：沿用当前上下文（日志字段等），但去掉截止时间"""
+    context = contextvars.copy_context()
+
+    def run():
+        _current.set(None)
+        with sampled_thread():
+            return fn(*args)
+
+    return lambda: context.run(run)
+
+
+_late_threads = set()
+_late_lock = threading.Lock()
+
+
+def start_late(fn, *args, name: str = 'deadline-late') -> threading.Thread:
+    """在登记过的后台线程中执行 fn（detach 后），供平滑重启时等待"""
+    task = detach(fn, *args)
+
+    def target():
+        try:
+            task()
+        finally:
+            with _late_lock:
+                _late_threads.discard(threading.current_thread())
+
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    with _late_lock:
+        _late_threads.add(thread)
+    thread.start()
+    return thread
+
+
+def wait_late(timeout: float) -> int:
+    """等待后台线程结束（最多 timeout 秒），返回仍在运行的数量"""
+    end = time.monotonic() + timeout
+    while True:
+        with _late_lock:
+            threads = list(_late_threads)
+        remaining = end - time.monotonic()
+        if not threads or remaining <= 0:
+            return len(threads)
+        threads[0].join(remaining)
+
+
+def run_within(fn, on_late=None, reserve: float = 0):
+    """
+    最多等待到截止时间前 reserve 秒。
+    按时完成返回 (True, 结果)（fn 的异常原样抛出）；超时返回 (False, None)，
+    fn 之后完成时调用 on_late(结果)（为 None 时丢弃，异常只记日志）
+    """
+    wait = budget(float('inf'), reserve)
+    if wait == float('inf'):
+        return True, fn()
+
+    done = threading.Event()
+    lock = threading.Lock()
+    outcome = {'late': False}
+
+    def target():
+        try:
+            outcome['result'] = fn()
+        except Exception as e:
+            outcome['error'] = e
+        with lock:
+            done.set()
+            late = outcome['late']
+        if not late:
+            return
+        if 'error' in outcome:
+            logger.error(f"截止时间后继续执行失败: {str(outcome['error'])}")
+        elif on_late:
+            try:
+                on_late(outcome['result'])
+            except Exception as e:
+                logger.error(f"推送后续结果失败: {str(e)}")
+
+    start_late(target)
+    done.wait(wait)
+    with lock:
+        if not done.is_set():
+            outcome['late'] = True
+            return False, None
+    if 'error' in outcome:
+        raise outcome['error']
+    return True, outcome['result']
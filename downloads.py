@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+文件下载链接
+
+/get <路径> 或 "发送文件 <路径>" 回复一个短期有效的 HMAC 签名链接，由 /download 端点提供下载：
+- 链接参数: p=路径（base64url）、e=过期时间戳、z=是否压缩、s=签名
+- 只允许 ALLOWED_PATHS 下的文件（按 realpath 判断，符号链接跳出也会被拒绝）
+- 不压缩时由 send_file 交给 wsgi.file_wrapper（gunicorn 下为 sendfile），支持 Range 断点续传
+- 压缩时分块 gzip 流式输出，内存占用与文件大小无关
+"""
+
+import os
+import hmac
+import time
+import zlib
+import base64
+import hashlib
+from urllib.parse import urlencode
+
+# 本身已压缩的格式，压缩没有意义
+COMPRESSED_EXTENSIONS = {
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.zip', '.7z', '.rar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp3', '.m4a', '.aac', '.flac', '.mp4', '.mkv', '.mov', '.avi', '.pdf',
+}
+
+CHUNK_SIZE = 256 * 1024
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _signature(secret: str, path: str, expires: int, compress: bool) -> str:
+    message = f'{path}\n{expires}\n{int(compress)}'.encode('utf-8')
+    return _b64encode(hmac.new(secret.encode('utf-8'), message, hashlib.sha256).digest()[:18])
+
+
+def resolve_allowed(path: str, allowed: list) -> dict:
+    """展开并规范化路径，检查是否位于允许的目录下"""
+    real = os.path.realpath(os.path.expanduser(path))
+    for root in allowed:
+        root = os.path.realpath(os.path.expanduser(root))
+        if os.path.commonpath([real, root]) == root:
+            break
+    else:
+        return {'success': False, 'error': f'不允许访问该路径: {real}'}
+
+    if not os.path.isfile(real):
+        return {'success': False, 'error': f'文件不存在: {real}'}
+    return {'success': True, 'path': real}
+
+
+def make_link(base_url: str, path: str, secret: str, ttl: int = 600, compress: bool = False) -> str:
+    """生成签名下载链接"""
+    expires = int(time.time()) + ttl
+    query = urlencode({
+        'p': _b64encode(path.encode('utf-8')),
+        'e': expires,
+        'z': int(compress),
+        's': _signature(secret, path, expires, compress),
+    })
+    return f"{base_url.rstrip('/')}/download?{query}"
+
+
+def verify_link(args, secret: str) -> dict:
+    """校验 /download 的查询参数"""
+    try:
+        path = _b64decode(args.get('p', '')).decode('utf-8')
+        expires = int(args.get('e', 0))
+        compress = args.get('z') == '1'
+    except (ValueError, UnicodeDecodeError):
+        return {'success': False, 'error': '链接无效'}
+
+    expected = _signature(secret, path, expires, compress)
+    if not hmac.compare_digest(expected, args.get('s', '')):
+        return {'success': False, 'error': '签名无效'}
+    if expires < time.time():
+        return {'success': False, 'error': '链接已过期'}
+    return {'success': True, 'path': path, 'compress': compress}
+
+
+def should_compress(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() not in COMPRESSED_EXTENSIONS
+
+
+def gzip_stream(path: str, level: int = 6):
+    """逐块读取并输出 gzip 数据"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+    yield compressor.flush()
+
+
+def format_size(size: int) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+        size /= 1024
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+多主机并发执行
+
+同一个程序以 agent 模式（APP_MODE=agent）部署在各台服务器上，只暴露 /agent/run；
+控制端（正常的机器人）把 /cmd @group、$sys @all、"看看所有服务器状态" 并发分发到
+各个 agent，每台主机有独立的截止时间，结果汇总成一张紧凑的表格。
+
+配置:
+    FANOUT_HOSTS=web1=http://10.0.0.2:5001,web2=http://10.0.0.3:5001
+    FANOUT_GROUPS=web=web1|web2,db=db1
+    AGENT_TOKEN=共享密钥（控制端和 agent 相同）
+
+本地测试（每个端口一个 agent 进程）:
+    APP_MODE=agent AGENT_TOKEN=test PORT=5101 python app_v4.py
+    APP_MODE=agent AGENT_TOKEN=test PORT=5102 python app_v4.py
+    FANOUT_HOSTS=a=http://127.0.0.1:5101,b=http://127.0.0.1:5102 AGENT_TOKEN=test python app_v4.py
+"""
+
+import re
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+ALL = 'all'
+
+# /cmd @group、$sys @all 末尾的目标；@ 前必须有空格，"ssh user@web1" 不算
+_TARGET_RE = re.compile(r'^(.*\S)\s+@([\w.-]+)$', re.DOTALL)
+
+
+def parse_hosts(spec: str) -> dict:
+    """web1=http://10.0.0.2:5001,web2=... -> {'web1': 'http://10.0.0.2:5001', ...}"""
+    hosts = {}
+    for item in (spec or '').split(','):
+        if '=' in item:
+            name, url = item.split('=', 1)
+            hosts[name.strip()] = url.strip().rstrip('/')
+    return hosts
+
+
+def parse_groups(spec: str) -> dict:
+    """web=web1|web2,db=db1 -> {'web': ['web1', 'web2'], 'db': ['db1']}"""
+    groups = {}
+    for item in (spec or '').split(','):
+        if '=' in item:
+            name, members = item.split('=', 1)
+            groups[name.strip()] = [m.strip() for m in members.split('|') if m.strip()]
+    return groups
+
+
+class FanoutClient:
+    """向多个 agent 并发发送请求，复用连接池"""
+
+    def __init__(self, hosts: dict, groups: dict, token: str, timeout: float = 15, max_workers: int = 16):
+        self.hosts = hosts
+        self.groups = groups
+        self.token = token
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(len(hosts), 1), pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fanout')
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.hosts)
+
+    def resolve(self, target: str):
+        """目标（all / 组名 / 主机名）-> 主机名列表，未知目标返回 None"""
+        if target == ALL:
+            return list(self.hosts)
+        if target in self.groups:
+            return [name for name in self.groups[target] if name in self.hosts]
+        if target in self.hosts:
+            return [target]
+        return None
+
+    def split_target(self, text: str):
+        """'df -h @web' -> ('df -h', ['web1', 'web2'])；不是已知目标时返回 None"""
+        if not self.enabled:
+            return None
+        match = _TARGET_RE.match(text.strip())
+        if not match:
+            return None
+        names = self.resolve(match.group(2))
+        if names is None:
+            return None
+        return match.group(1).strip(), names
+
+    def _call(self, name: str, payload: dict, timeout: float) -> dict:
+        start = time.perf_counter()
+        try:
+            response = self.session.post(
+                f'{self.hosts[name]}/agent/run',
+                json=dict(payload, timeout=timeout),
+                headers={'X-Agent-Token': self.token},
+                timeout=(min(3, timeout), timeout)
+            )
+            if response.status_code != 200:
+                result = {'success': False, 'error': f'HTTP {response.status_code}'}
+            else:
+                result = response.json()
+        except requests.Timeout:
+            result = {'success': False, 'error': '超时'}
+        except Exception as e:
+            result = {'success': False, 'error': str(e)}
+        result['elapsed'] = time.perf_counter() - start
+        return result
+
+    def run(self, names: list, payload: dict, timeout: float = None) -> dict:
+        """并发执行，返回 {主机名: 结果}；超过截止时间仍未返回的主机记为超时"""
+        timeout = self.timeout if timeout is None else timeout
+        futures = {self.executor.submit(self._call, name, payload, timeout): name for name in names}
+        done, _ = wait(futures, timeout=timeout + 1)
+
+        results = {}
+        for future, name in futures.items():
+            if future in done:
+                results[name] = future.result()
+            else:
+                results[name] = {'success': False, 'error': '超时', 'elapsed': timeout}
+        return results
+
+
+# ===================== 结果渲染 =====================
+
+def render_sys_table(results: dict) -> str:
+    """$sys @group 的汇总表"""
+    lines = [f"{'主机':<10}{'CPU':>7}{'内存':>7}{'磁盘':>7}{'负载':>7}"]
+    for name, result in sorted(results.items()):
+        if not result.get('success'):
+            lines.append(f"{name:<12}❌ {result.get('error', '失败')}")
+            continue
+        m = result['metrics']
+        load = f"{m['load']:.2f}" if m.get('load') is not None else '-'
+        lines.append(f"{name:<12}{m['cpu']:>6.0f}%{m['memory']:>6.0f}%{m['disk']:>6.0f}%{load:>8}")
+
+    ok = sum(1 for r in results.values() if r.get('success'))
+    return f"🖥️ **服务器状态** ({ok}/{len(results)} 在线)\n\n```\n" + '\n'.join(lines) + "\n```"
+
+
+def render_shell_results(command: str, results: dict, max_chars: int = 400) -> str:
+    """/cmd @group 的汇总结果，每台主机一段"""
+    ok = sum(1 for r in results.values() if r.get('success'))
+    output = f"💻 `{command}` - {ok}/{len(results)} 成功\n"
+    for name, result in sorted(results.items()):
+        emoji = '✅' if result.get('success') else '❌'
+        text = (result.get('output') or result.get('error') or '').strip() or '（无输出）'
+        if len(text) > max_chars:
+            text = text[:max_chars] + '\n...'
+        output += f"\n{emoji} **{name}** ({result.get('elapsed', 0):.1f}s)\n```\n{text}\n```\n"
+    return output
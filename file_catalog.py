@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+"""
+列式文件目录（catalog）
+
+analyze_directory 遍历目录时顺便生成列式目录，之后 "一年以前且大于 100MB 的文件"、
+"按扩展名统计"、"这周改了什么" 之类的问题直接在列上过滤、分组，不必再次遍历磁盘。
+
+每次扫描保存为一组定长列文件（array.tofile 写出，读取时 mmap，零拷贝）：
+    size.col    int64   文件大小
+    mtime.col   int64   修改时间（秒）
+    ext.col     uint16  扩展名编号（编号表在 meta.json，超过 65535 种时其余归入 OTHER_EXT）
+    top.col     uint32  所在的一级子目录编号
+    offset.col  uint64  路径在 paths.bin 中的偏移，文件编号即行号
+安装了 numpy 时用向量化运算，否则退回逐行循环。
+
+查询语法（/query）:
+    /query ~/Downloads size>100M age>1y
+    /query ext=mp4,mkv sort mtime top 20
+    /query by ext | by dir | by month
+    /query age<7d name~report
+"""
+
+import os
+import re
+import json
+import mmap
+import time
+import heapq
+import shutil
+import hashlib
+import logging
+from array import array
+
+from downloads import format_size
+
+try:
+    import numpy
+except ImportError:  # numpy 是可选的
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# 列名 -> array 类型码
+COLUMNS = {'size': 'q', 'mtime': 'q', 'ext': 'H', 'top': 'I', 'offset': 'Q'}
+
+# 根目录下直接存放的文件归入这个"一级子目录"
+ROOT_DIR_NAME = '.'
+
+# 扩展名编号用完后，其余扩展名共用这个编号（不对应任何一个具体的扩展名）
+OTHER_EXT = 0xFFFF
+
+# 写到一半的版本目录（进程崩溃时残留），超过这个秒数后清理
+STALE_TMP = 3600
+
+
+class Catalog:
+    """一次扫描的结果"""
+
+    def __init__(self, root: str, meta: dict, columns: dict, paths):
+        self.root = root
+        self.meta = meta
+        self.columns = columns
+        self.paths = paths
+        self.count = len(columns['size'])
+
+    def path(self, index: int) -> str:
+        start, end = self.columns['offset'][index], self.columns['offset'][index + 1]
+        return os.path.join(self.root, bytes(self.paths[start:end]).decode('utf-8', 'surrogateescape'))
+
+    def column(self, name: str):
+        """numpy 可用时返回 ndarray（零拷贝），否则返回 memoryview / array"""
+        data = self.columns[name]
+        if numpy is not None and not isinstance(data, numpy.ndarray):
+            data = numpy.frombuffer(data, dtype=numpy.dtype(COLUMNS[name])) if len(data) else \
+                numpy.zeros(0, dtype=numpy.dtype(COLUMNS[name]))
+        return data
+
+    def total_size(self) -> int:
+        sizes = self.column('size')
+        return int(sizes.sum()) if numpy is not None else sum(sizes)
+
+    def largest(self, limit: int = 10) -> list:
+        """最大的 limit 个文件: [(路径, 大小)]"""
+        return [(self.path(i), self.columns['size'][i]) for i in _top_indices(self, None, 'size', limit)]
+
+
+# ===================== 扫描 =====================
+
+def scan(root: str, progress: dict = None) -> Catalog:
+    """
+    遍历目录生成列式目录（不跟随符号链接）。
+    progress 不为 None 时持续写入进度（文件数、总大小、已完成的一级子目录比例、目前最大的文件），
+    供截止时间到了还没扫完时回复部分结果
+    """
+    root = os.path.realpath(os.path.expanduser(root))
+    columns = {name: array(code) for name, code in COLUMNS.items()}
+    columns['offset'].append(0)
+    paths = bytearray()
+    ext_codes = {}
+    top_codes = {ROOT_DIR_NAME: 0}
+    dir_count = 0
+    prefix = len(root.rstrip('/')) + 1
+    total = 0
+    largest = []   # 小顶堆 (大小, 路径)
+    started, current = 0, 0
+
+    stack = [(root, 0)]
+    while stack:
+        directory, top = stack.pop()
+        if progress is not None:
+            # 深度优先：一个一级子目录遍历完才会轮到下一个
+            if top != current:
+                current, started = top, started + 1
+            progress.update(files=len(columns['size']), bytes=total, dirs=dir_count,
+                            fraction=max(0, started - 1) / max(1, len(top_codes) - 1),
+                            largest=sorted(largest, reverse=True))
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dir_count += 1
+                        code = top if directory != root else top_codes.setdefault(entry.name, len(top_codes))
+                        stack.append((entry.path, code))
+                        continue
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                ext = os.path.splitext(entry.name)[1].lower()
+                columns['size'].append(stat.st_size)
+                columns['mtime'].append(int(stat.st_mtime))
+                code = ext_codes.get(ext)
+                if code is None:
+                    code = OTHER_EXT if len(ext_codes) >= OTHER_EXT else ext_codes.setdefault(ext, len(ext_codes))
+                columns['ext'].append(code)
+                columns['top'].append(top)
+                paths += entry.path[prefix:].encode('utf-8', 'surrogateescape')
+                columns['offset'].append(len(paths))
+                if progress is not None:
+                    total += stat.st_size
+                    if len(largest) < 5:
+                        heapq.heappush(largest, (stat.st_size, entry.path))
+                    elif stat.st_size > largest[0][0]:
+                        heapq.heapreplace(largest, (stat.st_size, entry.path))
+
+    meta = {
+        'root': root,
+        'scanned_at': time.time(),
+        'files': len(columns['size']),
+        'dirs': dir_count,
+        'extensions': sorted(ext_codes, key=ext_codes.get),
+        'top_dirs': sorted(top_codes, key=top_codes.get),
+    }
+    if progress is not None:
+        progress.update(files=meta['files'], bytes=total, dirs=dir_count, fraction=1.0,
+                        largest=sorted(largest, reverse=True))
+    return Catalog(root, meta, columns, paths)
+
+
+# ===================== 持久化 =====================
+
+def _map(path: str, typecode: str = None):
+    """只读 mmap 一个文件；空文件无法 mmap，返回空数组"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return array(typecode) if typecode else b''
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    return view.cast(typecode) if typecode else view
+
+
+class CatalogStore:
+    """
+    按根目录保存最近一次扫描：先写到临时目录再原子改名为版本目录，然后原子地切换 current 符号链接。
+    被替换的上一个版本保留（其他 worker 可能正在打开或 mmap），更早的版本才删除；
+    多个 worker 同时保存时互不删除对方正在写的目录
+    """
+
+    def __init__(self, directory: str, max_age: int = 3600):
+        self.directory = directory
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def _base(self, root: str) -> str:
+        key = hashlib.sha1(os.path.realpath(os.path.expanduser(root)).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, key)
+
+    def save(self, catalog: Catalog):
+        base = self._base(catalog.root)
+        name = f"{time.time_ns()}-{os.getpid()}"
+        tmp = os.path.join(base, f'.tmp-{name}')
+        os.makedirs(tmp)
+        for column in COLUMNS:
+            with open(os.path.join(tmp, f'{column}.col'), 'wb') as f:
+                catalog.columns[column].tofile(f)
+        with open(os.path.join(tmp, 'paths.bin'), 'wb') as f:
+            f.write(catalog.paths)
+        with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(catalog.meta, f, ensure_ascii=False)
+        os.rename(tmp, os.path.join(base, name))
+
+        current = os.path.join(base, 'current')
+        try:
+            replaced = os.readlink(current)
+        except OSError:
+            replaced = None
+        link = os.path.join(base, f'current.{os.getpid()}')
+        os.symlink(name, link)
+        os.replace(link, current)
+        self._cleanup(base, keep={name, replaced})
+
+    @staticmethod
+    def _cleanup(base: str, keep: set):
+        """删除比保留的版本都旧的版本目录，以及长时间没写完的临时目录"""
+        stamps = [int(v.split('-')[0]) for v in keep if v]
+        oldest = min(stamps)
+        for entry in os.listdir(base):
+            path = os.path.join(base, entry)
+            if entry in keep or not os.path.isdir(path) or os.path.islink(path):
+                continue
+            try:
+                if entry.startswith('.tmp-'):
+                    stale = time.time() - os.path.getmtime(path) > STALE_TMP
+                else:
+                    stale = int(entry.split('-')[0]) < oldest
+            except (OSError, ValueError):
+                continue
+            if stale:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def load(self, root: str):
+        current = os.path.join(self._base(root), 'current')
+        try:
+            version = os.path.realpath(current)
+            with open(os.path.join(version, 'meta.json'), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            columns = {name: _map(os.path.join(version, f'{name}.col'), code) for name, code in COLUMNS.items()}
+            paths = _map(os.path.join(version, 'paths.bin'))
+        except (OSError, ValueError):
+            return None
+        return Catalog(meta['root'], meta, columns, paths)
+
+    def scan(self, root: str, progress: dict = None) -> Catalog:
+        catalog = scan(root, progress)
+        try:
+            self.save(catalog)
+        except OSError as e:
+            logger.error(f"保存文件目录失败: {str(e)}")
+        return catalog
+
+    def get(self, root: str, max_age: int = None, progress: dict = None) -> Catalog:
+        """读取已有的扫描结果，过期或不存在时重新扫描（progress 见 scan）"""
+        max_age = self.max_age if max_age is None else max_age
+        catalog = self.load(root)
+        if catalog is None or time.time() - catalog.meta['scanned_at'] > max_age:
+            catalog = self.scan(root, progress)
+        return catalog
+
+    def latest_root(self):
+        """最近一次扫描的根目录"""
+        latest = None
+        for key in os.listdir(self.directory):
+            try:
+                with open(os.path.join(self.directory, key, 'current', 'meta.json'), 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if latest is None or meta['scanned_at'] > latest['scanned_at']:
+                latest = meta
+        return latest['root'] if latest else None
+
+
+# ===================== 查询 =====================
+
+_SIZE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'kb': 1024, 'm': 1024 ** 2, 'mb': 1024 ** 2,
+               'g': 1024 ** 3, 'gb': 1024 ** 3, 't': 1024 ** 4, 'tb': 1024 ** 4}
+_AGE_UNITS = {'h': 3600, 'd': 86400, 'w': 7 * 86400, 'mo': 30 * 86400, 'y': 365 * 86400}
+
+OPERATORS = {
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+}
+
+
+def parse_size(text: str) -> int:
+    match = re.match(r'^([\d.]+)([a-z]*)$', text.lower())
+    if not match or match.group(2) not in _SIZE_UNITS:
+        raise ValueError(f'无法解析大小: {text}')
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2)])
+
+
+def parse_age(text: str) -> int:
+    match = re.match(r'^(\d+)(h|d|w|mo|y)$', text.lower())
+    if not match:
+        raise ValueError(f'无法解析时间: {text}（支持 h/d/w/mo/y）')
+    return int(match.group(1)) * _AGE_UNITS[match.group(2)]
+
+
+def parse_query(text: str) -> dict:
+    """
+    解析查询语句：{'root', 'filters': [(列, 运算符, 值)], 'exts', 'name', 'group', 'sort', 'limit'}
+    """
+    query = {'root': None, 'filters': [], 'exts': None, 'name': None,
+             'group': None, 'sort': 'size', 'limit': 20}
+    tokens = re.sub(r'\s*(>=|<=|>|<|=|~)\s*', r'\1', text.strip()).split()
+    now = time.time()
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        lower = token.lower()
+        if token.startswith(('/', '~')) and query['root'] is None:
+            query['root'] = token
+        elif lower in ('by', 'group') and i + 1 < len(tokens):
+            i += 1
+            query['group'] = tokens[i].lower()
+            if query['group'] not in ('ext', 'dir', 'month'):
+                raise ValueError(f"不支持的分组: {tokens[i]}（ext / dir / month）")
+        elif lower in ('sort', 'order') and i + 1 < len(tokens):
+            i += 1
+            query['sort'] = tokens[i].lower()
+            if query['sort'] not in ('size', 'mtime', 'age'):
+                raise ValueError(f"不支持的排序: {tokens[i]}（size / mtime / age）")
+        elif lower in ('top', 'limit') and i + 1 < len(tokens) and tokens[i + 1].isdigit():
+            i += 1
+            query['limit'] = min(int(tokens[i]), 200)
+        elif lower.startswith('ext='):
+            query['exts'] = ['.' + e.lstrip('.') if e and e != '-' else '' for e in lower[4:].split(',')]
+        elif lower.startswith('name~'):
+            query['name'] = re.compile(token[5:], re.IGNORECASE)
+        else:
+            match = re.match(r'^(size|age)(>=|<=|>|<)(\S+)$', lower)
+            if not match:
+                raise ValueError(f'无法理解: {token}')
+            field, op, value = match.groups()
+            if field == 'size':
+                query['filters'].append(('size', op, parse_size(value)))
+            else:
+                # age > 1y 即 mtime < 现在 - 1 年
+                flipped = {'>': '<', '>=': '<=', '<': '>', '<=': '>='}[op]
+                query['filters'].append(('mtime', flipped, int(now - parse_age(value))))
+        i += 1
+    return query
+
+
+def _mask(catalog: Catalog, query: dict):
+    """满足数值条件的行：numpy 时为布尔数组，否则为行号列表"""
+    ext_codes = None
+    if query['exts'] is not None:
+        extensions = catalog.meta['extensions']
+        ext_codes = [extensions.index(e) for e in query['exts'] if e in extensions]
+
+    if numpy is not None:
+        mask = numpy.ones(catalog.count, dtype=bool)
+        for name, op, value in query['filters']:
+            mask &= OPERATORS[op](catalog.column(name), value)
+        if ext_codes is not None:
+            mask &= numpy.isin(catalog.column('ext'), ext_codes)
+        rows = numpy.flatnonzero(mask)
+    else:
+        rows = range(catalog.count)
+        for name, op, value in query['filters']:
+            column, compare = catalog.columns[name], OPERATORS[op]
+            rows = [i for i in rows if compare(column[i], value)]
+        if ext_codes is not None:
+            column, wanted = catalog.columns['ext'], set(ext_codes)
+            rows = [i for i in rows if column[i] in wanted]
+
+    if query['name'] is not None:
+        pattern = query['name']
+        rows = [i for i in rows if pattern.search(os.path.basename(catalog.path(i)))]
+        if numpy is not None:
+            rows = numpy.asarray(rows, dtype=numpy.int64)
+    return rows
+
+
+def _top_indices(catalog: Catalog, rows, sort: str, limit: int) -> list:
+    """rows 中按 sort 排在最前的 limit 个行号（age 为最旧的在前）"""
+    column = catalog.column('mtime' if sort == 'age' else sort)
+    descending = sort != 'age'
+    if numpy is not None:
+        rows = numpy.arange(catalog.count) if rows is None else rows
+        if len(rows) == 0:
+            return []
+        keys = column[rows] if descending else -column[rows]
+        if len(rows) > limit:
+            part = numpy.argpartition(-keys, limit - 1)[:limit]
+        else:
+            part = numpy.arange(len(rows))
+        return [int(rows[i]) for i in part[numpy.argsort(-keys[part], kind='stable')]]
+
+    rows = range(catalog.count) if rows is None else rows
+    pick = heapq.nlargest if descending else heapq.nsmallest
+    return pick(limit, rows, key=lambda i: column[i])
+
+
+def _group_keys(catalog: Catalog, group: str):
+    """分组键列和键名"""
+    if group == 'ext':
+        names = [e or '(无扩展名)' for e in catalog.meta['extensions']]
+        if len(names) == OTHER_EXT:
+            # 编号已用完，之后出现的扩展名都是 OTHER_EXT
+            names.append('(其他扩展名)')
+        return catalog.column('ext'), names
+    if group == 'dir':
+        return catalog.column('top'), catalog.meta['top_dirs']
+
+    # 按月：把 mtime 换算成 年*12+月
+    mtimes = catalog.column('mtime')
+    if numpy is not None:
+        months = mtimes.astype('datetime64[s]').astype('datetime64[M]').astype(numpy.int64)
+        first = int(months.min()) if len(months) else 0
+        names = [f'{(first + k) // 12 + 1970}-{(first + k) % 12 + 1:02d}'
+                 for k in range(int(months.max()) - first + 1 if len(months) else 0)]
+        return months - first, names
+    keys, names, codes = array('I'), [], {}
+    for mtime in mtimes:
+        name = time.strftime('%Y-%m', time.gmtime(mtime))
+        keys.append(codes.setdefault(name, len(codes)))
+        if len(codes) > len(names):
+            names.append(name)
+    return keys, names
+
+
+def run_query(catalog: Catalog, query: dict) -> dict:
+    """在目录上执行查询"""
+    rows = _mask(catalog, query)
+    sizes = catalog.column('size')
+    result = {
+        'success': True,
+        'root': catalog.root,
+        'scanned_at': catalog.meta['scanned_at'],
+        'total_files': catalog.count,
+        'matched': len(rows),
+        'matched_size': int(sizes[rows].sum()) if numpy is not None else sum(sizes[i] for i in rows),
+    }
+
+    if query['group']:
+        keys, names = _group_keys(catalog, query['group'])
+        if numpy is not None:
+            selected = keys[rows].astype(numpy.int64)
+            counts = numpy.bincount(selected, minlength=len(names))
+            totals = numpy.bincount(selected, weights=sizes[rows], minlength=len(names))
+            groups = [(names[k], int(counts[k]), int(totals[k])) for k in numpy.flatnonzero(counts)]
+        else:
+            counts, totals = {}, {}
+            for i in rows:
+                counts[keys[i]] = counts.get(keys[i], 0) + 1
+                totals[keys[i]] = totals.get(keys[i], 0) + sizes[i]
+            groups = [(names[k], counts[k], totals[k]) for k in counts]
+        if query['group'] == 'month':
+            groups.sort(key=lambda g: g[0], reverse=True)
+        else:
+            groups.sort(key=lambda g: g[2], reverse=True)
+        result['groups'] = groups[:query['limit']]
+    else:
+        mtimes = catalog.columns['mtime']
+        result['rows'] = [(catalog.path(i), catalog.columns['size'][i], mtimes[i])
+                          for i in _top_indices(catalog, rows, query['sort'], query['limit'])]
+    return result
+
+
+# ===================== 聊天 =====================
+
+def render_result(result: dict, group: str = None) -> str:
+    age = time.time() - result['scanned_at']
+    output = f"🗂️ **文件查询** - {result['root']}\n\n"
+    output += (f"匹配 {result['matched']:,} / {result['total_files']:,} 个文件，"
+               f"共 {format_size(result['matched_size'])}\n")
+
+    if 'groups' in result:
+        title = {'ext': '扩展名', 'dir': '子目录', 'month': '月份'}[group]
+        output += f"\n```\n{title:<14}{'文件数':>8}{'大小':>12}\n"
+        for name, count, size in result['groups']:
+            output += f"{name[:16]:<16}{count:>10,}{format_size(size):>13}\n"
+        output += "```\n"
+    elif result['rows']:
+        output += "\n```\n"
+        for path, size, mtime in result['rows']:
+            relative = os.path.relpath(path, result['root'])
+            output += f"{format_size(size):>9}  {time.strftime('%Y-%m-%d', time.localtime(mtime))}  {relative}\n"
+        output += "```\n"
+
+    output += f"\n🕐 扫描于 {int(age // 60)} 分钟前（/query ... 后加 ! 重新扫描）"
+    return output
+
+
+_NATURAL = [
+    (r'按(扩展名|类型|后缀)', 'by ext'),
+    (r'按(子)?目录', 'by dir'),
+    (r'按月', 'by month'),
+    (r'(大于|超过|大过)\s*([\d.]+)\s*([kmgt]b?)', lambda m: f'size>{m.group(2)}{m.group(3)}'),
+    (r'(小于|不到)\s*([\d.]+)\s*([kmgt]b?)', lambda m: f'size<{m.group(2)}{m.group(3)}'),
+    (r'(一年|1\s*年)(以前|以上|前|没动)|(超过|早于)\s*(一|1)\s*年', 'age>1y'),
+    (r'(半年)(以前|以上|前|没动)', 'age>6mo'),
+    (r'(\d+)\s*个?月(以前|以上|前|没动)', lambda m: f'age>{m.group(1)}mo'),
+    (r'(本周|这周|这一周|最近一周|7\s*天内)', 'age<7d'),
+    (r'(今天)', 'age<1d'),
+    (r'最近\s*(\d+)\s*天', lambda m: f'age<{m.group(1)}d'),
+]
+
+
+def parse_natural(text: str):
+    """把 "一年以前且大于 100MB 的文件"、"按扩展名统计大小" 翻译为查询语句，无法识别返回 None"""
+    lower = text.lower()
+    terms = []
+    for pattern, term in _NATURAL:
+        match = re.search(pattern, lower)
+        if match:
+            terms.append(term(match) if callable(term) else term)
+    if not terms:
+        return None
+
+    path = re.search(r'(~?/[^\s，。的]*)', text)
+    if path:
+        terms.insert(0, path.group(1))
+    elif '下载' in text:
+        terms.insert(0, '~/Downloads')
+    elif '文档' in text:
+        terms.insert(0, '~/Documents')
+    elif '桌面' in text:
+        terms.insert(0, '~/Desktop')
+    if '修改' in text or '改' in text:
+        terms.append('sort mtime')
+    return ' '.join(terms)
@@ -0,0 +1,59 @@
+"""
+gunicorn 配置（平滑重启）
+
+    gunicorn -c gunicorn.conf.py --daemon     启动
+    kill -HUP $(cat gunicorn.pid)             重新加载代码和 .env：先启动新 worker，
+                                              旧 worker 处理完当前请求后退出
+    kill -USR2 $(cat gunicorn.pid)            升级 Python / 依赖：启动新的 master，
+                                              确认就绪后再对旧 master 发 TERM
+
+restart.sh 封装了以上流程，并轮询 /health 确认新 worker 就绪。
+"""
+
+import os
+import sys
+import signal
+
+from dotenv import load_dotenv
+
+INSTALL_DIR = os.path.dirname(os.path.abspath(__file__))
+load_dotenv(os.path.join(INSTALL_DIR, '.env'))
+
+wsgi_app = os.getenv('APP_MODULE', 'app_v4:app')
+bind = f"0.0.0.0:{os.getenv('PORT', 5001)}"
+workers = int(os.getenv('WORKERS', 2))
+timeout = 120
+# 旧 worker 排空进行中请求的最长时间
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', 60))
+pidfile = os.path.join(INSTALL_DIR, 'gunicorn.pid')
+errorlog = os.path.join(INSTALL_DIR, 'service.log')
+capture_output = True
+
+
+def _app_hook(name: str):
+    """应用模块中的钩子函数（app_v3 没有这些钩子）"""
+    module = sys.modules.get(wsgi_app.split(':')[0])
+    return getattr(module, name, None)
+
+
+def post_worker_init(worker):
+    begin_drain = _app_hook('begin_drain')
+    if begin_drain:
+        def handle_term(sig, frame):
+            begin_drain()
+            worker.handle_exit(sig, frame)
+        signal.signal(signal.SIGTERM, handle_term)
+
+    warm_up = _app_hook('warm_up')
+    if warm_up:
+        warm_up()
+
+
+def worker_exit(server, worker):
+    """在 worker 进程中、退出前调用"""
+    handover = _app_hook('handover')
+    if handover:
+        try:
+            handover()
+        except Exception as e:
+            server.log.error(f"移交后台任务失败: {str(e)}")
@@ -123,19 +123,9 @@ echo ""
 read -p "是否现在启动服务？(y/n) " -n 1 -r
 echo ""
 if [[ $REPLY =~ ^[Yy]$ ]]; then
-    # 停止现有服务
-    pkill -f "gunicorn.*app_v3" 2>/dev/null || true
-    sleep 2
-
-    # 启动服务
-    cd "$INSTALL_DIR"
-    source venv/bin/activate
-    gunicorn -w 2 -b 0.0.0.0:5001 --timeout 120 --daemon app_v3:app
-
-    sleep 2
-
-    # 检查服务状态
-    if curl -s http://localhost:5001/health > /dev/null; then
+    # 启动服务（已在运行时平滑重载，并等待 /health 就绪）
+    chmod +x "$INSTALL_DIR/restart.sh"
+    if "$INSTALL_DIR/restart.sh"; then
         echo "✅ 服务启动成功！"
         echo ""
         echo "========================================="
@@ -156,8 +146,8 @@ if [[ $REPLY =~ ^[Yy]$ ]]; then
         echo "   tail -f $INSTALL_DIR/service.log"
         echo ""
         echo "4. 管理服务:"
-        echo "   停止: pkill -f gunicorn"
-        echo "   重启: $INSTALL_DIR/restart.sh"
+        echo "   停止: $INSTALL_DIR/restart.sh --stop"
+        echo "   重启: $INSTALL_DIR/restart.sh（平滑重启，不中断进行中的请求）"
         echo ""
     else
         echo "❌ 服务启动失败，请查看日志:"
@@ -168,8 +158,7 @@ else
     echo ""
     echo "稍后手动启动服务:"
     echo "  cd $INSTALL_DIR"
-    echo "  source venv/bin/activate"
-    echo "  gunicorn -w 2 -b 0.0.0.0:5001 --timeout 120 --daemon app_v3:app"
+    echo "  ./restart.sh"
 fi
 
 echo ""
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+非阻塞结构化日志
+
+请求线程只把日志记录放进队列（QueueHandler），真正的格式化和磁盘 I/O 由
+QueueListener 后台线程完成。文件日志为 JSON 行，自动带上当前请求的
+request_id / user / handler；控制台输出沿用原来的文本格式（有 colorlog 时着色）。
+
+多个 gunicorn worker 写同一个文件时不能各自按大小轮转（会互相覆盖、丢日志）：
+    max_bytes=0   所有 worker 追加写同一个文件（WatchedFileHandler），由外部 logrotate 轮转
+    max_bytes>0   每个 worker 写自己的文件（service.json.<pid>.log）并按大小轮转
+
+用法:
+    setup_logging(log_file='service.json.log', sample_rates={'request': 0.1})
+
+    with log_context(request_id='abc123', user='42'):
+        logger.info('收到消息', extra=log_extra('request', chars=12))
+        update_context(handler='system')
+
+采样按类别（extra 中的 category，否则为 logger 名）生效，WARNING 及以上永不采样。
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, WatchedFileHandler
+
+try:
+    import colorlog
+except ImportError:  # colorlog 是可选的
+    colorlog = None
+
+CONSOLE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+
+# 当前请求的日志上下文
+_context = contextvars.ContextVar('log_context', default={})
+
+_listener = None
+
+
+# ===================== 请求上下文 =====================
+
+def get_context() -> dict:
+    """当前请求的上下文字段"""
+    return _context.get()
+
+
+def update_context(**fields):
+    """在当前上下文中追加字段（例如路由确定后的 handler）"""
+    _context.set({**_context.get(), **fields})
+
+
+@contextmanager
+def log_context(**fields):
+    """在 with 块内绑定上下文字段，退出时恢复"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def log_extra(category: str, **fields) -> dict:
+    """构造 logger 的 extra 参数：日志类别 + 结构化字段"""
+    return {'category': category, 'fields': fields}
+
+
+# ===================== 过滤器与格式化 =====================
+
+class ContextFilter(logging.Filter):
+    """把请求上下文写入日志记录（在请求线程中执行，入队之前）"""
+
+    def filter(self, record):
+        ctx = _context.get()
+        record.request_id = ctx.get('request_id', '-')
+        record.user = ctx.get('user')
+        record.handler = ctx.get('handler')
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """按类别采样，被丢弃的记录不会入队"""
+
+    def __init__(self, rates: dict = None):
+        super().__init__()
+        self.rates = rates or {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rates.get(getattr(record, 'category', None) or record.name)
+        return rate is None or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """一条日志一行 JSON"""
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+                  + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'user': getattr(record, 'user', None),
+            'handler': getattr(record, 'handler', None),
+        }
+        category = getattr(record, 'category', None)
+        if category:
+            entry['category'] = category
+        entry.update(getattr(record, 'fields', None) or {})
+        return json.dumps({k: v for k, v in entry.items() if v is not None},
+                          ensure_ascii=False, default=str)
+
+
+def _file_handler(log_file: str, max_bytes: int, backup_count: int) -> logging.Handler:
+    if not max_bytes:
+        # logrotate 移走文件后自动重新打开
+        return WatchedFileHandler(log_file, encoding='utf-8')
+    base, ext = os.path.splitext(log_file)
+    return RotatingFileHandler(f'{base}.{os.getpid()}{ext}', maxBytes=max_bytes,
+                               backupCount=backup_count, encoding='utf-8')
+
+
+def _console_handler() -> logging.Handler:
+    handler = logging.StreamHandler()
+    if colorlog:
+        handler.setFormatter(colorlog.ColoredFormatter('%(log_color)s' + CONSOLE_FORMAT))
+    else:
+        handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+    return handler
+
+
+# ===================== 初始化 =====================
+
+def setup_logging(level: str = 'INFO', log_file: str = None, sample_rates: dict = None,
+                  max_bytes: int = 0, backup_count: int = 5):
+    """把根 logger 切换到队列模式，可重复调用（重新初始化）"""
+    global _listener
+    shutdown_logging()
+
+    handlers = [_console_handler()]
+    if log_file:
+        file_handler = _file_handler(log_file, max_bytes, backup_count)
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rates))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+@atexit.register
+def shutdown_logging():
+    """停止后台线程并写完队列中剩余的日志"""
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+def parse_sample_rates(value: str) -> dict:
+    """解析 "request=0.1,intent=0.5" 格式的采样配置"""
+    rates = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            name, rate = item.split('=', 1)
+            rates[name.strip()] = float(rate)
+    return rates
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+嵌入式时序指标存储（RRD 风格的定长环形文件）
+
+每个序列一个文件，文件内有三个归档，写入时同时合并到各归档，自动降采样：
+    10 秒 × 8640   = 24 小时
+    1 分钟 × 10080 = 7 天
+    1 小时 × 8760  = 1 年
+每个槽位保存 (槽起始时间, 平均, 最小, 最大, 样本数)，文件大小固定（约 660KB / 序列），
+序列数量有上限，因此磁盘占用有界。超过 expire 秒没有写入的序列（已退出的进程）会被删除，
+达到上限时也先删除这些序列，仍然没有空位才丢弃新序列（记录警告）。
+
+范围查询选择能覆盖起点的最细归档，只读取需要的连续槽位（最多两段 pread）。
+
+多个 gunicorn worker 中只有持有 "metrics" 租约的那个负责采集写入，其他 worker 只读。
+"""
+
+import os
+import re
+import time
+import struct
+import logging
+import threading
+
+import psutil
+
+from alerts import parse_duration
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SCBRRD1\0'
+SLOT = struct.Struct('<qfffI')   # 槽起始时间, avg, min, max, count
+
+# (步长秒, 槽位数)
+ARCHIVES = ((10, 8640), (60, 10080), (3600, 8760))
+
+# 指标别名 -> (序列名, 显示名, 单位)
+METRICS = {
+    'cpu': ('cpu', 'CPU', '%'),
+    'memory': ('memory', '内存', '%'),
+    'mem': ('memory', '内存', '%'),
+    '内存': ('memory', '内存', '%'),
+    'disk': ('disk', '磁盘', '%'),
+    '磁盘': ('disk', '磁盘', '%'),
+    'load': ('load', '负载', ''),
+    '负载': ('load', '负载', ''),
+}
+
+
+def _safe_name(series: str) -> str:
+    return re.sub(r'[^\w.-]', '_', series)
+
+
+class MetricsStore:
+    """定长环形文件时序存储"""
+
+    def __init__(self, directory: str, archives=ARCHIVES, max_series: int = 64, expire: int = 7 * 86400):
+        self.directory = directory
+        self.archives = archives
+        self.max_series = max_series
+        self.expire = expire
+        # 因达到上限而丢弃的序列，每个只警告一次
+        self._dropped = set()
+        self.size = len(MAGIC) + sum(slots for _, slots in archives) * SLOT.size
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, series: str) -> str:
+        return os.path.join(self.directory, _safe_name(series) + '.rrd')
+
+    def _offset(self, archive: int) -> int:
+        return len(MAGIC) + sum(slots for _, slots in self.archives[:archive]) * SLOT.size
+
+    def series(self) -> list:
+        """已有的序列名"""
+        return sorted(n[:-4] for n in os.listdir(self.directory) if n.endswith('.rrd'))
+
+    def disk_usage(self) -> int:
+        return sum(os.path.getsize(self._path(s)) for s in self.series())
+
+    def _open_for_write(self, series: str):
+        path = self._path(series)
+        if os.path.exists(path) and os.path.getsize(path) == self.size:
+            return os.open(path, os.O_RDWR)
+        if not os.path.exists(path) and len(self.series()) >= self.max_series:
+            if not self.prune() and len(self.series()) >= self.max_series:
+                if series not in self._dropped:
+                    self._dropped.add(series)
+                    logger.warning(f"指标序列数已达上限 {self.max_series}，不记录: {series}")
+                return None
+        # 新建（或归档布局变化后重建）
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(fd, self.size)
+        os.pwrite(fd, MAGIC, 0)
+        return fd
+
+    def prune(self, now: float = None) -> list:
+        """删除超过 expire 秒没有写入的序列，返回删除的序列名"""
+        if not self.expire:
+            return []
+        cutoff = (now or time.time()) - self.expire
+        removed = []
+        for series in self.series():
+            path = self._path(series)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed.append(series)
+            except FileNotFoundError:
+                pass
+        if removed:
+            self._dropped.clear()
+            logger.info(f"删除 {len(removed)} 个长期未更新的指标序列: {', '.join(removed)}")
+        return removed
+
+    # ===================== 写入 =====================
+
+    def record(self, samples: dict, ts: float = None):
+        """写入一次采样：{序列名: 数值}"""
+        ts = int(ts or time.time())
+        with self._lock:
+            for series, value in samples.items():
+                if value is None:
+                    continue
+                fd = self._open_for_write(series)
+                if fd is None:
+                    continue
+                try:
+                    for index, (step, slots) in enumerate(self.archives):
+                        self._merge(fd, index, step, slots, ts, float(value))
+                finally:
+                    os.close(fd)
+
+    def _merge(self, fd: int, archive: int, step: int, slots: int, ts: int, value: float):
+        slot_ts = ts - ts % step
+        position = self._offset(archive) + (slot_ts // step % slots) * SLOT.size
+        old_ts, avg, low, high, count = SLOT.unpack(os.pread(fd, SLOT.size, position))
+        if old_ts == slot_ts and count:
+            count += 1
+            avg += (value - avg) / count
+            low, high = min(low, value), max(high, value)
+        else:
+            avg = low = high = value
+            count = 1
+        os.pwrite(fd, SLOT.pack(slot_ts, avg, low, high, count), position)
+
+    # ===================== 查询 =====================
+
+    def fetch(self, series: str, start: float, end: float = None) -> dict:
+        """
+        范围查询，返回 {'step', 'points': [(ts, avg, min, max), ...]}（按时间排序，缺失的槽位不返回）
+        """
+        end = int(end or time.time())
+        start = int(start)
+        path = self._path(series)
+        if not os.path.exists(path) or os.path.getsize(path) != self.size:
+            return {'step': self.archives[0][0], 'points': []}
+
+        # 能覆盖起点的最细归档
+        now = time.time()
+        archive = len(self.archives) - 1
+        for index, (step, slots) in enumerate(self.archives):
+            if now - step * slots <= start:
+                archive = index
+                break
+        step, slots = self.archives[archive]
+
+        first = start - start % step
+        count = min(slots, (end - first) // step + 1)
+        begin = first // step % slots
+        base = self._offset(archive)
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            head = min(count, slots - begin)
+            data = os.pread(fd, head * SLOT.size, base + begin * SLOT.size)
+            if count > head:
+                data += os.pread(fd, (count - head) * SLOT.size, base)
+        finally:
+            os.close(fd)
+
+        points = [(slot_ts, avg, low, high) for slot_ts, avg, low, high, n in SLOT.iter_unpack(data)
+                  if n and first <= slot_ts <= end]
+        points.sort()
+        return {'step': step, 'points': points}
+
+
+# ===================== 采集 =====================
+
+def collect_process_samples(names: list = None, top: int = 5) -> dict:
+    """
+    按进程名汇总的 CPU%（proc.<名称>.cpu）和常驻内存 MB（proc.<名称>.mem）
+    names 为空时取 CPU 占用最高的 top 个进程名
+    """
+    usage = {}
+    for proc in psutil.process_iter(['name', 'cpu_percent', 'memory_info']):
+        name = proc.info['name']
+        if not name or (names and name not in names):
+            continue
+        cpu, mem = usage.get(name, (0.0, 0.0))
+        memory_info = proc.info['memory_info']
+        usage[name] = (cpu + (proc.info['cpu_percent'] or 0),
+                       mem + (memory_info.rss / 1024 ** 2 if memory_info else 0))
+
+    if not names:
+        usage = dict(sorted(usage.items(), key=lambda x: x[1][0], reverse=True)[:top])
+
+    samples = {}
+    for name, (cpu, mem) in usage.items():
+        samples[f'proc.{name}.cpu'] = cpu
+        samples[f'proc.{name}.mem'] = mem
+    return samples
+
+
+class MetricsRecorder:
+    """定期采集并写入存储（持有 "metrics" 租约的 worker 负责）"""
+
+    def __init__(self, store: MetricsStore, collect, state, interval: int = 10):
+        self.store = store
+        self.collect = collect
+        self.state = state
+        self.interval = interval
+        self.owner = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        pruned_at = 0
+        while not self._stop.wait(self.interval):
+            try:
+                if self.state.acquire_lease('metrics', self.owner, ttl=self.interval * 3):
+                    self.store.record(self.collect())
+                    # 每小时清理一次已退出进程的序列
+                    if time.time() - pruned_at > 3600:
+                        self.store.prune()
+                        pruned_at = time.time()
+            except Exception as e:
+                logger.error(f"指标采集失败: {str(e)}", exc_info=True)
+
+    def start(self):
+        if self._thread:
+            return
+        self.owner = str(os.getpid())
+        self._thread = threading.Thread(target=self._run, name='metrics-recorder', daemon=True)
+        self._thread.start()
+        logger.info(f"指标历史记录已启动: 间隔 {self.interval} 秒，目录 {self.store.directory}")
+
+    def stop(self):
+        self._stop.set()
+        self.state.release_lease('metrics', self.owner)
+
+
+# ===================== 时间范围 =====================
+
+_RANGE_RE = re.compile(r'(\d+)\s*(分钟|小时|天|[mhd])(?![a-z])', re.IGNORECASE)
+_UNITS = {'分钟': 'm', '小时': 'h', '天': 'd'}
+
+
+def parse_range(text: str, now: float = None):
+    """
+    从文本中解析时间范围，返回 (start, end, 描述)：
+    12h / 30m / 7d / 过去 6 小时 / 昨晚（20:00 → 08:00）/ 昨天 / 今天，默认最近 1 小时
+    """
+    now = now or time.time()
+    local = time.localtime(now)
+    midnight = time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1))
+
+    if re.search(r'昨晚|昨夜|overnight|last night', text, re.IGNORECASE):
+        # 昨天 20:00 → 今天 08:00；早上 8 点前问时这个晚上还没过完，截止到现在
+        night = midnight - 4 * 3600
+        return night, min(night + 12 * 3600, now), '昨晚 20:00 → 08:00'
+    if '昨天' in text or 'yesterday' in text.lower():
+        return midnight - 86400, midnight, '昨天'
+    if '今天' in text or 'today' in text.lower():
+        return midnight, now, '今天'
+
+    match = _RANGE_RE.search(text)
+    if match:
+        amount, unit = match.group(1), _UNITS.get(match.group(2), match.group(2).lower())
+        seconds = parse_duration(amount + unit)
+        label = {'m': '分钟', 'h': '小时', 'd': '天'}[unit]
+        return now - seconds, now, f'最近 {amount} {label}'
+    return now - 3600, now, '最近 1 小时'
+
+
+# ===================== 聊天渲染 =====================
+
+SPARK = '▁▂▃▄▅▆▇█'
+
+
+def sparkline(values: list, low: float = None, high: float = None) -> str:
+    """None 显示为空格"""
+    present = [v for v in values if v is not None]
+    if not present:
+        return ''
+    low = min(present) if low is None else low
+    high = max(present) if high is None else high
+    span = (high - low) or 1
+    return ''.join(' ' if v is None else SPARK[min(len(SPARK) - 1, int((v - low) / span * len(SPARK)))]
+                   for v in values)
+
+
+def resample(points: list, start: float, end: float, width: int) -> list:
+    """把数据点按时间平均分到 width 个桶，返回每桶的平均值（无数据为 None）"""
+    buckets = [[] for _ in range(width)]
+    span = max(end - start, 1)
+    for ts, avg, _, _ in points:
+        index = int((ts - start) / span * width)
+        if 0 <= index < width:
+            buckets[index].append(avg)
+    return [sum(b) / len(b) if b else None for b in buckets]
+
+
+def _clock(ts: float, span: float) -> str:
+    return time.strftime('%m-%d %H:%M' if span > 86400 else '%H:%M', time.localtime(ts))
+
+
+def render_history(label: str, unit: str, result: dict, start: float, end: float,
+                   range_label: str, width: int = 40) -> str:
+    """一个序列的走势：火花线 + 平均值进度条 + 最低/最高"""
+    points = result['points']
+    step_label = {10: '10 秒', 60: '1 分钟', 3600: '1 小时'}.get(result['step'], f"{result['step']} 秒")
+    output = f"**{label}**（{range_label}，{step_label}粒度）\n"
+    if not points:
+        return output + "暂无数据\n"
+
+    # 各槽位平均值的平均
+    average = sum(p[1] for p in points) / len(points)
+    low = min(points, key=lambda p: p[2])
+    high = max(points, key=lambda p: p[3])
+    span = end - start
+
+    line = sparkline(resample(points, start, end, width), 0 if unit == '%' else None,
+                     100 if unit == '%' else None)
+    left, right = _clock(start, span), _clock(end, span)
+    output += f"```\n{line}\n{left}{right:>{max(width - len(left), len(right) + 1)}}\n"
+    if unit == '%':
+        filled = int(20 * average / 100)
+        output += f"{'█' * filled}{'░' * (20 - filled)} 平均 {average:.1f}%\n"
+    output += "```\n"
+    output += (f"平均 {average:.1f}{unit}  最低 {low[2]:.1f}{unit}  "
+               f"最高 {high[3]:.1f}{unit}（{_clock(high[0], span)}）\n")
+    return output
+
+
+def resolve_series(text: str, known: list) -> list:
+    """从文本中找出要查询的序列：[(序列名, 显示名, 单位)]"""
+    found = []
+    lower = text.lower()
+    for alias, target in METRICS.items():
+        if re.search(rf'(?<![a-z0-9_.]){re.escape(alias)}(?![a-z0-9_])', lower) and target not in found:
+            found.append(target)
+
+    # 进程：nginx（CPU）或 nginx.mem（内存）
+    for word in re.findall(r'[\w.-]+', text):
+        # 进程名本身可能带点（php-fpm8.1、python3.11），只把最后一段当作 cpu / mem
+        name, _, kind = word.rpartition('.')
+        if kind not in ('', 'cpu', 'mem'):
+            name, kind = word, ''
+        series = f"proc.{name}.{kind or 'cpu'}"
+        if series in known:
+            target = (series, f"{name} {'内存' if kind == 'mem' else 'CPU'}", 'MB' if kind == 'mem' else '%')
+            if target not in found:
+                found.append(target)
+    return found
+
+
+def history_text(store: MetricsStore, text: str, now: float = None) -> str:
+    """/history <指标> [范围] 或自然语言（"昨晚 CPU 和内存怎么样"）的回复"""
+    known = store.series()
+    targets = resolve_series(text, known)
+    if not targets:
+        processes = sorted({s[len('proc.'):].rsplit('.', 1)[0] for s in known if s.startswith('proc.')})
+        output = "📈 **指标历史**\n\n用法: /history cpu 12h、/history 内存 昨晚、/history nginx 1d\n\n"
+        output += "主机指标: cpu, memory, disk, load\n"
+        if processes:
+            output += f"进程: {', '.join(processes)}（加 .mem 查看内存）\n"
+        return output + f"\n💾 占用磁盘 {store.disk_usage() / 1024 ** 2:.1f}MB"
+
+    start, end, range_label = parse_range(text, now)
+    output = "📈 **指标历史**\n\n"
+    for series, label, unit in targets:
+        output += render_history(label, unit, store.fetch(series, start, end), start, end, range_label) + '\n'
+    return output.rstrip()
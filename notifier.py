@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+主动推送消息到 Synology Chat（Incoming Webhook）
+
+Synology 的 Incoming Webhook 接收表单字段 payload='{"text": "..."}'。
+
+长回复用 split_message 在代码块和行边界处切分；MessageSender 在后台按令牌桶限速发送，
+并把短时间内到达的小消息合并成一条，避免刷屏或被 Synology 限流。
+
+离线测试时可以启动一个桩接收器代替 Synology，把收到的消息打印出来：
+    python notifier.py --stub-receiver 8765
+    SYNOLOGY_CHAT_WEBHOOK_URL=http://127.0.0.1:8765/webhook
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+def push_message(text: str, webhook_url: str, timeout: float = 10) -> dict:
+    """推送一条消息到 Incoming Webhook"""
+    if not webhook_url:
+        return {'success': False, 'error': '未配置 SYNOLOGY_CHAT_WEBHOOK_URL'}
+
+    try:
+        response = requests.post(
+            webhook_url,
+            data={'payload': json.dumps({'text': text}, ensure_ascii=False)},
+            timeout=timeout
+        )
+        if response.status_code != 200:
+            return {'success': False, 'error': f'HTTP {response.status_code}: {response.text[:200]}'}
+
+        # Synology 出错时也返回 200，错误在 JSON 的 success 字段里
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        if body.get('success') is False:
+            return {'success': False, 'error': json.dumps(body.get('error', body), ensure_ascii=False)}
+
+        return {'success': True}
+    except Exception as e:
+        logger.error(f"推送消息失败: {str(e)}")
+        return {'success': False, 'error': str(e)}
+
+
+# ===================== 切分 =====================
+
+FENCE = '```'
+
+
+def _hard_wrap(line: str, limit: int) -> list:
+    return [line[i:i + limit] for i in range(0, len(line), limit)] or ['']
+
+
+def split_message(text: str, limit: int = 2000) -> list:
+    """
+    按行切分为不超过 limit 字符的若干段；切点落在代码块内部时，
+    在本段末尾补上 ``` 并在下一段开头重新打开代码块（保留语言标记）
+    """
+    if len(text) <= limit:
+        return [text]
+
+    chunks = []
+    current = []
+    size = 0
+    fence = None  # 当前所在代码块的开头行，例如 "```" 或 "```bash"
+
+    def flush():
+        nonlocal current, size
+        body = '\n'.join(current)
+        if fence:
+            body += '\n' + FENCE
+        chunks.append(body)
+        current = [fence] if fence else []
+        size = len(fence) + 1 if fence else 0
+
+    # 为补齐的 ``` 预留空间
+    room = limit - len(FENCE) - 1
+    for line in text.split('\n'):
+        reserve = len(fence) + 1 if fence else 0
+        for piece in _hard_wrap(line, max(room - reserve, 1)):
+            if size + len(piece) + 1 > room and current and current != [fence]:
+                flush()
+            current.append(piece)
+            size += len(piece) + 1
+
+        if line.strip().startswith(FENCE):
+            fence = None if fence else line.strip()
+
+    if current and current != [fence]:
+        chunks.append('\n'.join(current))
+    return chunks
+
+
+# ===================== 限速批量发送 =====================
+
+class MessageSender:
+    """
+    后台发送队列：
+    - 令牌桶限速（rate 条/秒，突发 burst 条），多个 worker 共享同一个桶
+    - batch_window 秒内相继到达的小消息合并为一条（不超过 limit 字符）
+    - 发送失败按指数退避重试
+    """
+
+    def __init__(self, webhook_url: str, state, rate: float = 1.0, burst: int = 3,
+                 limit: int = 2000, batch_window: float = 0.5, retries: int = 3):
+        self.webhook_url = webhook_url
+        self.state = state
+        self.rate = rate
+        self.burst = burst
+        self.limit = limit
+        self.batch_window = batch_window
+        self.retries = retries
+        self._queue = queue.Queue()
+        self._carry = None       # 合并时放不下、留给下一批的消息
+        self._inflight = None    # 已取出、正在等待或发送的消息
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.webhook_url)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, name='message-sender', daemon=True).start()
+
+    def send(self, text: str, delay: float = 0) -> dict:
+        """入队（长消息自动切分），立即返回"""
+        if not self.enabled:
+            return {'success': False, 'error': '未配置 SYNOLOGY_CHAT_WEBHOOK_URL'}
+        self._ensure_started()
+        not_before = time.time() + delay
+        for chunk in split_message(text, self.limit):
+            self._queue.put((not_before, chunk))
+        return {'success': True, 'queued': True}
+
+    def pending(self) -> list:
+        """尚未发出的消息"""
+        items = ([self._carry] if self._carry else []) + list(self._queue.queue)
+        return [text for _, text in items]
+
+    def handover(self, timeout: float = 5, inflight: bool = True) -> list:
+        """
+        平滑重启时调用：取走队列中的消息，等待正在发送的那条完成（最多 timeout 秒），
+        返回尚未发出的消息，由新 worker 接着发送。之后 send() 的消息仍由本进程发送。
+        inflight=False 时不等待也不返回正在发送的那条（之后再调用一次 handover 处理）
+        """
+        with self._lock:
+            remaining, self._queue = self._queue, queue.Queue()
+        if not inflight:
+            items = ([self._carry] if self._carry else []) + list(remaining.queue)
+            self._carry = None
+            return [text for _, text in items]
+        deadline = time.time() + timeout
+        while self._inflight is not None and time.time() < deadline:
+            time.sleep(0.05)
+
+        items = ([self._carry] if self._carry else []) + list(remaining.queue)
+        self._carry = None
+        texts = [text for _, text in items]
+        if self._inflight is not None:
+            # 超时仍未发出：宁可重复也不丢
+            texts.insert(0, self._inflight)
+        return texts
+
+    def _next_batch(self) -> str:
+        if self._carry:
+            (not_before, text), self._carry = self._carry, None
+        else:
+            not_before, text = self._queue.get()
+        self._inflight = text
+        if not_before > time.time():
+            time.sleep(not_before - time.time())
+
+        # 合并窗口内的后续小消息
+        deadline = time.time() + self.batch_window
+        while True:
+            try:
+                not_before, following = self._queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                return text
+            if len(text) + len(following) + 2 > self.limit:
+                self._carry = (not_before, following)
+                return text
+            text += '\n\n' + following
+            self._inflight = text
+
+    def _acquire_token(self):
+        while True:
+            wait = self.state.take_token('synology_webhook', self.rate, self.burst)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _run(self):
+        while True:
+            text = self._next_batch()
+            for attempt in range(self.retries + 1):
+                self._acquire_token()
+                result = push_message(text, self.webhook_url)
+                if result['success']:
+                    break
+                logger.warning(f"推送失败（第 {attempt + 1} 次）: {result.get('error')}")
+                time.sleep(min(30, 2 ** attempt))
+            self._inflight = None
+
+
+# ===================== 桩接收器（离线测试）=====================
+
+class StubReceiver:
+    """
+    模拟 Synology Incoming Webhook 的本地 HTTP 服务，收到的消息保存在 messages 中
+
+    with StubReceiver() as stub:
+        push_message('hi', stub.url)
+        stub.messages  # ['hi']
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.messages = []
+        self.received = threading.Condition()
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                payload = parse_qs(body).get('payload', ['{}'])[0]
+                with receiver.received:
+                    receiver.messages.append(json.loads(payload).get('text', ''))
+                    receiver.received.notify_all()
+
+                reply = b'{"success": true}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = f'http://{host}:{self.server.server_address[1]}/webhook'
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait_for(self, count: int, timeout: float = 5) -> bool:
+        """等待至少收到 count 条消息"""
+        with self.received:
+            return self.received.wait_for(lambda: len(self.messages) >= count, timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Synology Incoming Webhook 桩接收器')
+    parser.add_argument('--stub-receiver', type=int, default=8765, metavar='PORT')
+    args = parser.parse_args()
+
+    stub = StubReceiver(port=args.stub_receiver).start()
+    print(f"桩接收器已启动: {stub.url}")
+    seen = 0
+    try:
+        while True:
+            stub.wait_for(seen + 1, timeout=1)
+            for message in stub.messages[seen:]:
+                print(f"[{time.strftime('%H:%M:%S')}] {message}\n")
+            seen = len(stub.messages)
+    except KeyboardInterrupt:
+        stub.stop()
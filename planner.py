@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+多步骤任务规划与并行执行（complex 意图）
+
+"检查磁盘和最大的日志文件并总结" 被拆成一个步骤 DAG：
+    s1 shell df -h            ─┐
+    s2 analyze_dir /var/log   ─┼─> s3 summarize
+互不依赖的步骤并发执行，每个步骤有独立的超时，完成一个就回调一次（用于逐条推送结果）。
+
+步骤类型:
+    shell        执行命令（只允许 ALLOWED_COMMANDS 中的只读命令，可用 | 连接）
+    sysinfo      系统信息
+    analyze_dir  目录分析（最大的文件等）
+    summarize    用 LLM 汇总依赖步骤的结果
+
+规划先用规则（常见说法，零成本），规则拆不出两步以上时再让 LLM 以 JSON 输出计划
+（同一次调用判断是否真的需要多个步骤，不需要时输出空计划），
+LLM 给出的计划会校验步骤类型、依赖是否存在、是否有环以及命令是否在允许列表中。
+"""
+
+import os
+import re
+import json
+import time
+import shlex
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('shell', 'sysinfo', 'analyze_dir', 'summarize')
+
+MAX_STEPS = 6
+
+# 多步骤请求的连接词和动作词
+CONJUNCTIONS = re.compile(r'并且|然后|同时|以及|接着|之后|再|并|和|，|,|;|；|\band then\b|\bthen\b')
+ACTIONS = re.compile(r'检查|查看|看看|看下|分析|找|列出|统计|总结|汇总|执行|运行|比较|对比|报告|'
+                     r'check|analy[sz]e|find|list|summari[sz]e|run|compare', re.IGNORECASE)
+
+_FORBIDDEN = re.compile(r'[;&`<>\n]|\$\(')
+
+# 计划中的命令无需确认就会执行：即使在允许列表中也不自动执行这些命令
+NO_AUTO_RUN = {'kill', 'pkill', 'killall'}
+
+# find 中会删除文件、执行其他命令或写文件的参数
+FIND_UNSAFE = {'-delete', '-exec', '-execdir', '-ok', '-okdir', '-fprint', '-fprint0', '-fprintf', '-fls'}
+
+
+def check_command(command: str, allowed: set) -> str:
+    """命令是否符合允许列表且只读，返回错误信息，符合时返回 None"""
+    if _FORBIDDEN.search(command):
+        return '不允许使用 ; & ` < > $( 等 Shell 语法'
+    for segment in command.split('|'):
+        try:
+            tokens = shlex.split(segment)
+        except ValueError as e:
+            return f'无法解析命令: {str(e)}'
+        name = os.path.basename(tokens[0]) if tokens else ''
+        if not name or name not in allowed:
+            return f"命令不在允许列表中: {tokens[0] if tokens else '(空)'}"
+        if name in NO_AUTO_RUN:
+            return f'计划中不会自动执行 {name}，请单独发送命令'
+        if name == 'find':
+            unsafe = FIND_UNSAFE.intersection(tokens[1:])
+            if unsafe:
+                return f"计划中不允许 find {' '.join(sorted(unsafe))}"
+    return None
+
+
+def looks_multi_step(message: str) -> bool:
+    """有连接词且拆开后至少两段包含动作"""
+    parts = [p for p in CONJUNCTIONS.split(message) if p.strip()]
+    return len(parts) >= 2 and sum(1 for p in parts if ACTIONS.search(p)) >= 2
+
+
+# ===================== 规划 =====================
+
+def _step(kind: str, args: str, title: str, deps: list = None) -> dict:
+    return {'kind': kind, 'args': args, 'title': title, 'deps': deps or []}
+
+
+def _path_in(message: str, default: str = None) -> str:
+    match = re.search(r'(~?/[\w./-]+)', message)
+    if match:
+        return match.group(1)
+    for word, path in (('下载', '~/Downloads'), ('文档', '~/Documents'), ('桌面', '~/Desktop')):
+        if word in message:
+            return path
+    return default
+
+
+def heuristic_plan(message: str) -> list:
+    """按常见说法拆分步骤，识别不出两步时返回空列表"""
+    lower = message.lower()
+    steps = []
+    if re.search(r'磁盘|硬盘|空间|disk', lower):
+        steps.append(_step('shell', 'df -h', '磁盘使用情况'))
+    if re.search(r'cpu|内存|负载|系统状态|memory|load', lower):
+        steps.append(_step('sysinfo', '', '系统状态'))
+    if re.search(r'日志|\blogs?\b', lower):
+        steps.append(_step('analyze_dir', _path_in(message, '/var/log'), '最大的日志文件'))
+    elif re.search(r'目录|文件夹|最大的文件|大文件', message):
+        steps.append(_step('analyze_dir', _path_in(message, '~'), '目录分析'))
+    for command in re.findall(r'`([^`]+)`', message):
+        steps.append(_step('shell', command.strip(), command.strip()))
+
+    if len(steps) < 2 and not (steps and re.search(r'总结|汇总|报告|summar', lower)):
+        return []
+    if re.search(r'总结|汇总|报告|建议|summar', lower):
+        steps.append(_step('summarize', message, '总结', deps=list(range(len(steps)))))
+
+    for index, step in enumerate(steps):
+        step['id'] = f's{index + 1}'
+        step['deps'] = [f's{d + 1}' for d in step['deps']]
+    return steps
+
+
+PLAN_PROMPT = """把用户的请求拆成可执行的步骤，只输出 JSON:
+{{"steps":[{{"id":"s1","kind":"类型","args":"参数","title":"简短说明","deps":[]}}]}}
+
+类型: shell（args 为命令，只能使用 {allowed}，可用 | 连接）、sysinfo（系统信息，args 为空）、
+analyze_dir（args 为目录路径）、summarize（用 AI 汇总 deps 中步骤的结果，args 为空）
+互不依赖的步骤 deps 为空，以便并行执行；最多 {max_steps} 步。
+如果请求只是普通对话或一个步骤就能完成，输出 {{"steps":[]}}。
+
+请求: {message}"""
+
+
+def validate_plan(steps: list, allowed: set, max_steps: int = MAX_STEPS) -> str:
+    """校验计划，返回错误信息，合法时返回 None"""
+    if not isinstance(steps, list) or not 2 <= len(steps) <= max_steps:
+        return f'步骤数应在 2 到 {max_steps} 之间'
+    ids = set()
+    for step in steps:
+        if not isinstance(step, dict) or step.get('kind') not in KINDS or not step.get('id'):
+            return f'无效的步骤: {step}'
+        if step['id'] in ids:
+            return f"步骤 id 重复: {step['id']}"
+        ids.add(step['id'])
+        if not isinstance(step.get('deps', []), list):
+            return f"步骤 {step['id']} 的 deps 不是列表"
+        if step['kind'] == 'shell':
+            error = check_command(str(step.get('args', '')), allowed)
+            if error:
+                return error
+
+    for step in steps:
+        missing = [d for d in step.get('deps', []) if d not in ids]
+        if missing:
+            return f"步骤 {step['id']} 依赖不存在的步骤: {missing}"
+
+    # 拓扑排序检查环
+    remaining = {s['id']: set(s.get('deps', [])) for s in steps}
+    while remaining:
+        ready = [sid for sid, deps in remaining.items() if not deps]
+        if not ready:
+            return '步骤之间存在循环依赖'
+        for sid in ready:
+            del remaining[sid]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return None
+
+
+def llm_plan(message: str, ask, allowed: set) -> dict:
+    """让 LLM 规划；ask(prompt) -> JSON 文本"""
+    commands = ', '.join(sorted(set(allowed) - NO_AUTO_RUN))
+    prompt = PLAN_PROMPT.format(allowed=commands, max_steps=MAX_STEPS, message=message)
+    try:
+        data = json.loads(ask(prompt))
+        steps = data.get('steps') if isinstance(data, dict) else None
+    except (ValueError, TypeError) as e:
+        return {'success': False, 'error': f'无法解析计划: {str(e)}'}
+    if steps == []:
+        return {'success': False, 'error': '不需要多个步骤'}
+
+    error = validate_plan(steps, allowed)
+    if error:
+        return {'success': False, 'error': error}
+    for step in steps:
+        step['args'] = message if step['kind'] == 'summarize' else str(step.get('args', ''))
+        step['title'] = str(step.get('title') or ('总结' if step['kind'] == 'summarize' else step['args']))[:60]
+        step['deps'] = list(step.get('deps', []))
+    return {'success': True, 'steps': steps}
+
+
+def make_plan(message: str, allowed: set, ask=None) -> dict:
+    """规则优先，其次 LLM"""
+    steps = heuristic_plan(message)
+    if steps:
+        # 用户明确写出的命令不在允许列表中时直接拒绝，不再交给 LLM
+        error = validate_plan(steps, allowed)
+        if error:
+            return {'success': False, 'error': error, 'rejected': True}
+        return {'success': True, 'steps': steps, 'source': 'rules'}
+    if ask is None:
+        return {'success': False, 'error': '无法拆分为多个步骤'}
+    result = llm_plan(message, ask, allowed)
+    if result['success']:
+        result['source'] = 'llm'
+    return result
+
+
+# ===================== 执行 =====================
+
+class PlanRunner:
+    """
+    按依赖关系并发执行步骤
+    actions: {类型: fn(step, inputs) -> {'success', 'text'}}，inputs 为依赖步骤的结果列表
+    """
+
+    def __init__(self, actions: dict, max_workers: int = 4, step_timeout: float = 30):
+        self.actions = actions
+        self.max_workers = max_workers
+        self.step_timeout = step_timeout
+
+    def _run_step(self, step: dict, inputs: list) -> dict:
+        start = time.perf_counter()
+        try:
+            result = self.actions[step['kind']](step, inputs)
+        except Exception as e:
+            logger.error(f"步骤执行失败: {step['id']} {str(e)}")
+            result = {'success': False, 'text': f'❌ {str(e)}'}
+        return dict(result, id=step['id'], kind=step['kind'], title=step['title'],
+                    elapsed=time.perf_counter() - start)
+
+    def run(self, steps: list, on_step=None) -> list:
+        """执行全部步骤，每完成一个调用 on_step(result)，返回按完成顺序排列的结果"""
+        context = contextvars.copy_context()
+        pending = {step['id']: step for step in steps}
+        done = {}
+        running = {}   # future -> (step, 截止时间)
+        order = []
+        pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='plan')
+
+        def finish(result):
+            done[result['id']] = result
+            order.append(result)
+            if on_step:
+                on_step(result)
+
+        try:
+            while pending or running:
+                for sid, step in list(pending.items()):
+                    if all(dep in done for dep in step['deps']):
+                        inputs = [done[dep] for dep in step['deps']]
+                        future = pool.submit(context.copy().run, self._run_step, step, inputs)
+                        running[future] = (step, time.monotonic() + self.step_timeout)
+                        del pending[sid]
+
+                if not running:
+                    break
+                timeout = max(0, min(deadline for _, deadline in running.values()) - time.monotonic())
+                finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    running.pop(future)
+                    finish(future.result())
+
+                # 超时的步骤不再等待（线程自行结束），依赖它的步骤照常执行
+                now = time.monotonic()
+                for future, (step, deadline) in list(running.items()):
+                    if deadline <= now:
+                        running.pop(future)
+                        finish({'id': step['id'], 'kind': step['kind'], 'title': step['title'],
+                                'success': False, 'elapsed': self.step_timeout,
+                                'text': f'⏱️ 超时（{self.step_timeout:.0f} 秒）'})
+        finally:
+            pool.shutdown(wait=False)
+        return order
+
+
+# ===================== 渲染 =====================
+
+def render_plan(steps: list) -> str:
+    output = f"🧭 **执行计划**（{len(steps)} 步，无依赖的步骤并行执行）\n\n"
+    for step in steps:
+        after = f"（等待 {', '.join(step['deps'])}）" if step['deps'] else ''
+        detail = f": `{step['args']}`" if step['kind'] in ('shell', 'analyze_dir') and step['args'] else ''
+        output += f"- {step['id']} {step['title']}{detail}{after}\n"
+    return output
+
+
+def render_step(result: dict) -> str:
+    icon = '✅' if result['success'] else '❌'
+    output = f"{icon} **{result['id']} {result['title']}**（{result['elapsed']:.1f} 秒）\n"
+    text = result['text'].strip() or '（无输出）'
+    if result['kind'] == 'summarize' or not result['success']:
+        return output + '\n' + text
+    return output + f"```\n{text}\n```"
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+按需请求剖析
+
+平时每个请求只检查进程内缓存的开关（关闭状态每 flag_ttl 秒才读一次共享状态），
+剖析之外只有 ContextVar 读取的开销；管理员用 /profile on N 开启后，接下来的 N 个请求
+（或带 X-Profile 头的请求）会被剖析：
+- 各阶段耗时：用 span('name') / @traced('name') 标注（路由、LLM、子进程、目录遍历…）
+- 采样剖析：后台线程每隔 interval 秒抓取请求线程的调用栈，输出 flamegraph.pl
+  可直接使用的折叠栈格式（"a;b;c 计数"）
+
+每个请求写出 <PROFILE_DIR>/<时间>-<request_id>.folded 和 .spans.json，
+各 span 的累计耗时汇总在共享状态中，可通过 /profile 或 /admin/profile 查看。
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import contextvars
+from functools import wraps
+from contextlib import contextmanager
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+_active = contextvars.ContextVar('profile', default=None)
+
+
+class RequestProfile:
+    """一个被剖析请求的数据"""
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.thread_id = threading.get_ident()
+        self.started = time.perf_counter()
+        self.spans = []          # (name, 开始偏移 ms, 耗时 ms, 深度)
+        self.depth = 0
+        self.stacks = Counter()  # 折叠栈 -> 采样次数
+        self.sampler = None
+
+
+# ===================== 阶段耗时 =====================
+
+class span:
+    """记录一个阶段的耗时；未开启剖析时几乎零开销"""
+
+    __slots__ = ('name', 'profile', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.profile = _active.get()
+        if self.profile:
+            self.start = time.perf_counter()
+            self.profile.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        profile = self.profile
+        if profile:
+            profile.depth -= 1
+            now = time.perf_counter()
+            profile.spans.append((self.name, (self.start - profile.started) * 1000,
+                                  (now - self.start) * 1000, profile.depth))
+        return False
+
+
+def traced(name: str):
+    """函数装饰器版本的 span"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _active.get() is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ===================== 采样器 =====================
+
+def _fold(frame) -> str:
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(parts))
+
+
+class _Sampler:
+    """进程内唯一的采样线程，只采样正在被剖析的请求线程"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.targets = {}   # thread_id -> RequestProfile
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def add(self, profile: RequestProfile):
+        with self.lock:
+            self.targets[profile.thread_id] = profile
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self.thread.start()
+
+    def remove(self, profile: RequestProfile):
+        with self.lock:
+            for thread_id in [t for t, p in self.targets.items() if p is profile]:
+                del self.targets[thread_id]
+
+    def attach(self, thread_id: int, profile: RequestProfile):
+        with self.lock:
+            self.targets[thread_id] = profile
+
+    def detach(self, thread_id: int, profile: RequestProfile):
+        with self.lock:
+            if self.targets.get(thread_id) is profile:
+                del self.targets[thread_id]
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.targets:
+                    continue
+                targets = dict(self.targets)
+            frames = sys._current_frames()
+            for thread_id, profile in targets.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    profile.stacks[_fold(frame)] += 1
+
+
+@contextmanager
+def sampled_thread():
+    """
+    在其他线程中继续当前请求的工作时使用（上下文已复制）：
+    请求正在被剖析则同时采样本线程，请求剖析结束后自动停止
+    """
+    profile = _active.get()
+    if profile is None or profile.sampler is None:
+        yield
+        return
+    thread_id = threading.get_ident()
+    profile.sampler.attach(thread_id, profile)
+    try:
+        yield
+    finally:
+        profile.sampler.detach(thread_id, profile)
+
+
+# ===================== 管理 =====================
+
+class Profiler:
+    """开关、请求剖析的开始/结束、结果落盘与汇总"""
+
+    def __init__(self, state, output_dir: str, interval: float = 0.005, flag_ttl: float = 2.0):
+        self.state = state
+        self.output_dir = output_dir
+        self.flag_ttl = flag_ttl
+        self._sampler = _Sampler(interval)
+        # 在这个时间（monotonic）之前视为未开启，不读共享状态
+        self._idle_until = 0.0
+
+    def enable(self, count: int):
+        """接下来 count 个请求开启剖析（其他 worker 最多 flag_ttl 秒后生效）"""
+        self.state.set('profile:remaining', count)
+        self._idle_until = 0.0
+
+    def disable(self):
+        self.state.delete('profile:remaining')
+
+    def remaining(self) -> int:
+        return self.state.get('profile:remaining', 0)
+
+    def claim(self) -> bool:
+        """当前请求是否需要剖析（原子地消耗一个名额）"""
+        if time.monotonic() < self._idle_until:
+            return False
+        if self.state.get('profile:remaining', 0) <= 0:
+            self._idle_until = time.monotonic() + self.flag_ttl
+            return False
+        return self.state.incr('profile:remaining', -1) >= 0
+
+    def start(self, request_id: str):
+        profile = RequestProfile(request_id)
+        profile.sampler = self._sampler
+        token = _active.set(profile)
+        self._sampler.add(profile)
+        return profile, token
+
+    def finish(self, profile: RequestProfile, token) -> str:
+        """结束剖析并落盘，返回文件路径前缀"""
+        self._sampler.remove(profile)
+        _active.reset(token)
+        total_ms = (time.perf_counter() - profile.started) * 1000
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{profile.request_id}")
+        with open(prefix + '.folded', 'w', encoding='utf-8') as f:
+            for stack, count in profile.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        with open(prefix + '.spans.json', 'w', encoding='utf-8') as f:
+            json.dump({
+                'request_id': profile.request_id,
+                'total_ms': round(total_ms, 2),
+                'samples': sum(profile.stacks.values()),
+                'spans': [{'name': n, 'start_ms': round(s, 2), 'duration_ms': round(d, 2), 'depth': depth}
+                          for n, s, d, depth in sorted(profile.spans, key=lambda x: x[1])]
+            }, f, ensure_ascii=False)
+
+        for name, _, duration, _ in profile.spans + [('request', 0, total_ms, 0)]:
+            self.state.incr(f'profile:span:{name}:count')
+            self.state.incr(f'profile:span:{name}:total_us', int(duration * 1000))
+
+        logger.info(f"请求剖析已保存: {prefix}")
+        return prefix
+
+    def summary(self, top: int = 10) -> list:
+        """累计耗时最多的 span：[{'name', 'count', 'total_ms', 'avg_ms'}]"""
+        totals = {}
+        for key, value in self.state.items('profile:span:'):
+            name, field = key[len('profile:span:'):].rsplit(':', 1)
+            totals.setdefault(name, {'name': name, 'count': 0, 'total_us': 0})[field] = value
+
+        rows = []
+        for item in totals.values():
+            if item['count']:
+                rows.append({
+                    'name': item['name'],
+                    'count': item['count'],
+                    'total_ms': round(item['total_us'] / 1000, 1),
+                    'avg_ms': round(item['total_us'] / 1000 / item['count'], 1),
+                })
+        rows.sort(key=lambda r: r['total_ms'], reverse=True)
+        return rows[:top]
+
+    def recent_files(self, limit: int = 5) -> list:
+        if not os.path.isdir(self.output_dir):
+            return []
+        names = sorted((n for n in os.listdir(self.output_dir) if n.endswith('.folded')), reverse=True)
+        return names[:limit]
+
+    def reset(self):
+        for key, _ in self.state.items('profile:span:'):
+            self.state.delete(key)
+
+    def summary_text(self) -> str:
+        """/profile 的回复内容"""
+        rows = self.summary()
+        output = f"🔬 **请求剖析**（剩余待剖析请求: {self.remaining()}）\n\n"
+        if not rows:
+            return output + "暂无数据，使用 /profile on 5 剖析接下来的 5 个请求"
+
+        output += "```\n" + f"{'阶段':<22}{'次数':>6}{'平均ms':>10}{'累计ms':>10}\n"
+        for row in rows:
+            output += f"{row['name']:<24}{row['count']:>6}{row['avg_ms']:>10}{row['total_ms']:>10}\n"
+        output += "```\n"
+
+        files = self.recent_files()
+        if files:
+            output += "\n📄 最近的火焰图数据（flamegraph.pl 格式）:\n"
+            output += '\n'.join(f"- {os.path.join(self.output_dir, n)}" for n in files)
+        return output
@@ -1,26 +1,95 @@
 #!/bin/bash
-# Synology Chatbot Claude 重启脚本
+# Synology Chatbot Claude 重启脚本（平滑重启，不丢进行中的请求）
+#
+#   ./restart.sh            USR2 启动新一代 master 和 worker，新 worker 就绪后旧 master 排空退出
+#   ./restart.sh --hup      HUP 原地替换 worker（更快，但新 worker 加载期间请求会短暂排队）
+#   ./restart.sh --stop     优雅停止
 
 INSTALL_DIR="$HOME/SynologyChatbotClaude"
+PIDFILE="$INSTALL_DIR/gunicorn.pid"
+PORT=$(grep -E '^PORT=' "$INSTALL_DIR/.env" 2>/dev/null | cut -d= -f2)
+HEALTH_URL="http://localhost:${PORT:-5001}/health"
 
-echo "🔄 重启服务..."
 cd "$INSTALL_DIR"
+source venv/bin/activate
 
-# 停止现有服务
-pkill -f "gunicorn.*app_v3" 2>/dev/null || true
-sleep 2
+# pidfile 中记录的 master 进程（仍在运行时输出 pid）
+master_pid() {
+    [ -f "$1" ] && kill -0 "$(cat "$1")" 2>/dev/null && cat "$1"
+}
 
-# 启动服务
-source venv/bin/activate
-gunicorn -w 2 -b 0.0.0.0:5001 --timeout 120 --daemon app_v3:app
+# 等待启动时间晚于 $1 的新 worker 在 /health 上多次返回 200
+# （USR2 期间新旧 worker 同时在线，旧 worker 的响应不计数）
+wait_ready() {
+    local ok=0
+    for _ in $(seq 1 120); do
+        if curl -s -f "$HEALTH_URL" | python3 -c \
+            "import sys, json; sys.exit(0 if json.load(sys.stdin).get('started_at', 0) >= $1 else 1)" 2>/dev/null; then
+            ok=$((ok + 1))
+            [ $ok -ge 3 ] && return 0
+        fi
+        sleep 0.5
+    done
+    return 1
+}
+
+PID=$(master_pid "$PIDFILE")
+
+if [ "$1" = "--stop" ]; then
+    if [ -n "$PID" ]; then
+        kill -TERM "$PID"
+        echo "⏹️  已发送停止信号，进行中的请求处理完后退出"
+    else
+        echo "服务未运行"
+    fi
+    exit 0
+fi
+
+SINCE=$(date +%s)
+NEW_PID=""
 
-sleep 2
+if [ -z "$PID" ]; then
+    # 早期版本直接用命令行启动、没有 pidfile：优雅停止后再启动
+    if pgrep -f "gunicorn.*app_v[34]" > /dev/null; then
+        echo "⏹️  停止旧的 gunicorn 进程..."
+        pkill -TERM -f "gunicorn.*app_v[34]"
+        for _ in $(seq 1 60); do
+            pgrep -f "gunicorn.*app_v[34]" > /dev/null || break
+            sleep 1
+        done
+    fi
+    echo "🚀 启动服务..."
+    gunicorn -c gunicorn.conf.py --daemon
+elif [ "$1" = "--hup" ]; then
+    echo "🔄 重新加载 worker（HUP）..."
+    kill -HUP "$PID"
+else
+    echo "🔄 启动新一代进程（USR2）..."
+    kill -USR2 "$PID"
+    for _ in $(seq 1 60); do
+        # 新版 gunicorn 把新 master 写入 gunicorn.pid.2，旧版把旧 master 的 pidfile 改名为 .oldbin
+        NEW_PID=$(master_pid "$PIDFILE.2")
+        if [ -z "$NEW_PID" ] && [ -f "$PIDFILE.oldbin" ]; then
+            NEW_PID=$(master_pid "$PIDFILE")
+        fi
+        [ -n "$NEW_PID" ] && [ "$NEW_PID" != "$PID" ] && break
+        sleep 0.5
+    done
+fi
 
 # 检查服务状态
-if curl -s http://localhost:5001/health > /dev/null; then
+if wait_ready "$SINCE"; then
+    if [ -n "$NEW_PID" ] && [ "$NEW_PID" != "$PID" ]; then
+        # 新 master 已就绪，旧 master 排空后退出
+        kill -TERM "$PID"
+    fi
     echo "✅ 服务重启成功"
 else
-    echo "❌ 服务启动失败，请查看日志:"
+    if [ -n "$NEW_PID" ] && [ "$NEW_PID" != "$PID" ]; then
+        # 新 master 未就绪：停掉它，旧 master 继续服务
+        kill -TERM "$NEW_PID"
+    fi
+    echo "❌ 新 worker 未就绪，请查看日志:"
     echo "   tail -f $INSTALL_DIR/service.log"
     exit 1
 fi
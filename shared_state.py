@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+跨 worker 共享状态层
+
+gunicorn 的每个 worker 都有独立内存，缓存、计数器、会话等状态如果放在进程内，
+就会在 worker 之间重复且不一致。这里用本地 SQLite（WAL 模式）做后端，
+所有 worker 打开同一个数据库文件，提供带 TTL 的键值存储和原子操作。
+
+用法:
+    state = SharedState('~/SynologyChatbotClaude/state.db')
+    state.set('cache:df', {'output': '...'}, ttl=10)
+    state.get('cache:df')
+    state.incr('counter:webhook')
+    state.add('lock:job', os.getpid(), ttl=30)   # 键不存在时才写入
+
+    flight = SingleFlight(state, 'webhook', result_ttl=60)
+    flight.do(key, compute)                      # 相同 key 只执行一次
+
+性能测试:
+    python shared_state.py --bench 5000
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 每写入多少次清理一次过期键
+PURGE_EVERY = 500
+
+
+class SharedState:
+    """基于 SQLite 的跨进程键值存储，值以 JSON 序列化"""
+
+    def __init__(self, path: str, busy_timeout: float = 5.0):
+        self.path = os.path.expanduser(path)
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._writes = 0
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = self._conn()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS kv ('
+            ' key TEXT PRIMARY KEY,'
+            ' value TEXT NOT NULL,'
+            ' expires_at REAL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires_at)')
+
+    # ===================== 连接管理 =====================
+
+    def _conn(self) -> sqlite3.Connection:
+        """每个线程一个连接；fork 之后（gunicorn preload）重新打开"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self):
+        """写事务：BEGIN IMMEDIATE 立即拿写锁，保证读-改-写原子性"""
+        return _Transaction(self._conn())
+
+    @staticmethod
+    def _expires(ttl):
+        """None 表示永不过期；0 表示立即过期（调用方应直接跳过写入）"""
+        return None if ttl is None else time.time() + ttl
+
+    def _after_write(self):
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            self.purge_expired()
+
+    # ===================== 基本操作 =====================
+
+    def get(self, key: str, default=None):
+        """读取键值，过期视为不存在"""
+        row = self._conn().execute(
+            'SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key: str, value, ttl: float = None):
+        """写入键值，ttl 为秒数，None 表示永不过期，<= 0 时不保存（并删除旧值）"""
+        if ttl is not None and ttl <= 0:
+            self.delete(key)
+            return
+        self._conn().execute(
+            'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value, ensure_ascii=False), self._expires(ttl))
+        )
+        self._after_write()
+
+    def add(self, key: str, value, ttl: float = None) -> bool:
+        """仅当键不存在（或已过期）时写入，返回是否写入成功；可用作跨进程锁"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM kv WHERE key = ? AND expires_at <= ?', (key, now))
+            cursor = conn.execute(
+                'INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), self._expires(ttl))
+            )
+            added = cursor.rowcount == 1
+        self._after_write()
+        return added
+
+    def delete(self, key: str) -> bool:
+        """删除键，返回键是否存在"""
+        cursor = self._conn().execute('DELETE FROM kv WHERE key = ?', (key,))
+        return cursor.rowcount == 1
+
+    def incr(self, key: str, amount: int = 1, ttl: float = None) -> int:
+        """原子自增并返回新值；键不存在时从 0 开始，ttl 只在新建时生效"""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+                (key, now)
+            ).fetchone()
+            if row:
+                value = json.loads(row[0]) + amount
+                conn.execute('UPDATE kv SET value = ? WHERE key = ?', (json.dumps(value), key))
+            else:
+                value = amount
+                conn.execute(
+                    'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+                    (key, json.dumps(value), self._expires(ttl))
+                )
+        self._after_write()
+        return value
+
+    def expire(self, key: str, ttl: float = None) -> bool:
+        """重新设置键的 TTL，返回键是否存在"""
+        cursor = self._conn().execute(
+            'UPDATE kv SET expires_at = ? WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (self._expires(ttl), key, time.time())
+        )
+        return cursor.rowcount == 1
+
+    def ttl(self, key: str):
+        """剩余秒数；永不过期返回 None，不存在返回 -1"""
+        row = self._conn().execute(
+            'SELECT expires_at FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, time.time())
+        ).fetchone()
+        if not row:
+            return -1
+        return None if row[0] is None else row[0] - time.time()
+
+    def items(self, prefix: str = '') -> list:
+        """按前缀列出未过期的 (key, value)"""
+        rows = self._conn().execute(
+            'SELECT key, value FROM kv WHERE key >= ? AND key < ? '
+            'AND (expires_at IS NULL OR expires_at > ?) ORDER BY key',
+            (prefix, prefix + '￿', time.time())
+        ).fetchall()
+        return [(k, json.loads(v)) for k, v in rows]
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """
+        获取或续租一个有时限的租约，用于让多个 worker 中只有一个执行后台任务；
+        持有者崩溃后租约在 ttl 秒后自动释放
+        """
+        key = f'lease:{name}'
+        if self.add(key, owner, ttl=ttl):
+            return True
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                'UPDATE kv SET expires_at = ? WHERE key = ? AND value = ? AND expires_at > ?',
+                (self._expires(ttl), key, json.dumps(owner, ensure_ascii=False), time.time())
+            )
+            return cursor.rowcount == 1
+
+    def release_lease(self, name: str, owner: str) -> bool:
+        """释放自己持有的租约"""
+        cursor = self._conn().execute(
+            'DELETE FROM kv WHERE key = ? AND value = ?',
+            (f'lease:{name}', json.dumps(owner, ensure_ascii=False))
+        )
+        return cursor.rowcount == 1
+
+    def take_token(self, name: str, rate: float, burst: float) -> float:
+        """
+        跨进程令牌桶：每秒补充 rate 个令牌，最多 burst 个。
+        拿到令牌返回 0，否则返回需要等待的秒数（不扣令牌）
+        """
+        key = f'bucket:{name}'
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+            bucket = json.loads(row[0]) if row else {'tokens': burst, 'ts': now}
+            tokens = min(burst, bucket['tokens'] + (now - bucket['ts']) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            conn.execute(
+                'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps({'tokens': tokens, 'ts': now}), self._expires(burst / rate + 60))
+            )
+        return wait
+
+    def purge_expired(self) -> int:
+        """清理过期键，返回清理数量"""
+        cursor = self._conn().execute(
+            'DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?', (time.time(),)
+        )
+        if cursor.rowcount:
+            logger.debug(f"共享状态清理过期键: {cursor.rowcount}")
+        return cursor.rowcount
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+
+# ===================== 单飞执行 =====================
+
+class _Call:
+    """进程内正在执行的一次调用"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class SingleFlight:
+    """
+    相同 key 的并发请求只执行一次 compute，其余请求挂靠等待结果；
+    完成的结果在 result_ttl 秒内直接从共享缓存返回（0 表示不缓存，只合并并发请求）。
+
+    同一进程内用 Event 唤醒等待者，跨 worker 用共享状态里的锁键 + 轮询结果。
+    compute 的返回值必须能被 JSON 序列化。
+
+    do() 返回: {
+        'value': 结果（pending 时为 None）,
+        'source': 'computed' | 'cache' | 'joined' | 'pending',
+        'age': 结果已生成的秒数
+    }
+    """
+
+    def __init__(self, state: SharedState, namespace: str, result_ttl: float = 60,
+                 lock_ttl: float = 120, poll_interval: float = 0.05):
+        self.state = state
+        self.namespace = namespace
+        self.result_ttl = result_ttl
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def _result_key(self, key):
+        return f'{self.namespace}:result:{key}'
+
+    def _lock_key(self, key):
+        return f'{self.namespace}:lock:{key}'
+
+    def cached(self, key: str):
+        """返回缓存的结果（不执行），没有时返回 None"""
+        entry = self.state.get(self._result_key(key))
+        if entry is None:
+            return None
+        return {'value': entry['value'], 'source': 'cache', 'age': time.time() - entry['at']}
+
+    def forget(self, key: str):
+        """丢弃缓存结果，下次调用重新执行"""
+        self.state.delete(self._result_key(key))
+
+    def do(self, key: str, compute, wait: float = 30, fresh: bool = False) -> dict:
+        """执行或挂靠 compute；fresh=True 时跳过结果缓存（仍然合并并发请求）"""
+        if not fresh:
+            hit = self.cached(key)
+            if hit:
+                return hit
+
+        # 同进程内：挂靠已有调用
+        with self._lock:
+            call = self._calls.get(key)
+            owner = call is None
+            if owner:
+                call = self._calls[key] = _Call()
+
+        if not owner:
+            if call.event.wait(wait) and call.result and call.result['source'] != 'pending':
+                return dict(call.result, source='joined')
+            return {'value': None, 'source': 'pending', 'age': 0.0}
+
+        try:
+            call.result = self._run_or_join(key, compute, wait)
+            return call.result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def _run_or_join(self, key, compute, wait):
+        deadline = time.time() + wait
+        while True:
+            if self.state.add(self._lock_key(key), os.getpid(), ttl=self.lock_ttl):
+                try:
+                    value = compute()
+                    # result_ttl 为 0 时只合并并发请求，不缓存结果
+                    if self.result_ttl:
+                        self.state.set(self._result_key(key), {'value': value, 'at': time.time()},
+                                       ttl=self.result_ttl)
+                    return {'value': value, 'source': 'computed', 'age': 0.0}
+                finally:
+                    self.state.delete(self._lock_key(key))
+
+            # 其他 worker 正在执行：等待其结果，锁消失但无结果时（执行失败）重新争抢
+            while self.state.ttl(self._lock_key(key)) != -1:
+                if time.time() >= deadline:
+                    return {'value': None, 'source': 'pending', 'age': 0.0}
+                time.sleep(self.poll_interval)
+
+            hit = self.cached(key)
+            if hit:
+                return dict(hit, source='joined')
+
+
+# ===================== 性能测试 =====================
+
+def _percentile(samples: list, p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def benchmark(path: str, n: int = 5000) -> dict:
+    """测量 get/set/incr/add 的单次延迟（微秒）"""
+    state = SharedState(path)
+    results = {}
+
+    def measure(name, fn):
+        samples = []
+        for i in range(n):
+            start = time.perf_counter()
+            fn(i)
+            samples.append((time.perf_counter() - start) * 1e6)
+        results[name] = {
+            'p50': _percentile(samples, 0.50),
+            'p99': _percentile(samples, 0.99),
+            'ops/s': n / (sum(samples) / 1e6),
+        }
+
+    measure('set', lambda i: state.set(f'bench:{i % 100}', {'i': i}, ttl=60))
+    measure('get', lambda i: state.get(f'bench:{i % 100}'))
+    measure('incr', lambda i: state.incr('bench:counter'))
+    measure('add', lambda i: state.add(f'bench:lock:{i}', 1, ttl=60))
+
+    for key, _ in state.items('bench:'):
+        state.delete(key)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description='共享状态层性能测试')
+    parser.add_argument('--bench', type=int, default=5000, metavar='N', help='每项操作次数')
+    parser.add_argument('--db', default=None, help='数据库路径（默认使用临时文件）')
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    print(f"数据库: {db_path}  次数: {args.bench}")
+    for op, stats in benchmark(db_path, args.bench).items():
+        print(f"{op:<5} p50 {stats['p50']:8.1f}µs   p99 {stats['p99']:8.1f}µs   {stats['ops/s']:10.0f} ops/s")
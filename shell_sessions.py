@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+每用户常驻 Shell 会话
+
+execute_shell_command 每次都新起 /bin/sh 且 cwd 固定为 ~，/cd logs 之后 /ls 没有效果。
+这里为每个用户分配一个长期存活的 /bin/sh（从预先启动的热池中取出），
+保留工作目录和环境变量；输出接在 PTY 上，命令结束后打印带随机标记的哨兵行来分帧。
+
+- 命令从管道写入，shell 为非交互模式（没有提示符和回显），命令的 stdin 重定向到 /dev/null
+- 超时或 shell 异常退出时整个会话被杀掉，下次自动换一个新的
+- 空闲超过 idle_timeout 的会话被回收，会话总数不超过 max_sessions（淘汰最久未用的）；
+  正在执行命令的会话不会被回收或淘汰
+- 工作目录写入共享状态，用户下一条消息落到另一个 worker 时也能回到同一目录
+"""
+
+import os
+import pty
+import time
+import uuid
+import shlex
+import select
+import signal
+import logging
+import threading
+import subprocess
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# 单条命令最多保留的输出字节数
+MAX_OUTPUT = 1024 * 1024
+
+
+class ShellSession:
+    """一个常驻 /bin/sh 进程"""
+
+    def __init__(self, shell: str = '/bin/sh', cwd: str = None):
+        self.cwd = cwd or os.path.expanduser('~')
+        self.marker = f'__SCB_{uuid.uuid4().hex}__'.encode()
+        self.lock = threading.Lock()
+        self._close_lock = threading.Lock()
+        self.last_used = time.time()
+        # 已分配给请求、尚未执行完的次数（由 SessionPool 在 _lock 下维护），大于 0 时不回收、不淘汰
+        self.busy = 0
+
+        master, slave = pty.openpty()
+        env = dict(os.environ, TERM='dumb', COLUMNS='120', PAGER='cat', GIT_PAGER='cat')
+        self.proc = subprocess.Popen(
+            [shell],
+            stdin=subprocess.PIPE,
+            stdout=slave,
+            stderr=slave,
+            cwd=self.cwd,
+            env=env,
+            start_new_session=True,
+            close_fds=True
+        )
+        os.close(slave)
+        self.fd = master
+
+    @property
+    def alive(self) -> bool:
+        return self.proc.poll() is None and self.fd is not None
+
+    def run(self, command: str, timeout: float = 30) -> dict:
+        """执行一条命令，返回与 execute_shell_command 相同结构的结果"""
+        framed = (f'{{ {command}\n}} < /dev/null 2>&1; '
+                  f'printf \'\\n%s %d %s\\n\' \'{self.marker.decode()}\' "$?" "$PWD"\n')
+        self.last_used = time.time()
+        try:
+            self.proc.stdin.write(framed.encode('utf-8'))
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            self.close()
+            return {'success': False, 'error': '❌ 会话已退出'}
+
+        buffer = bytearray()
+        deadline = time.time() + timeout
+        while True:
+            end = buffer.find(self.marker)
+            if end != -1 and buffer.find(b'\n', end) != -1:
+                break
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.close()
+                return {'success': False, 'error': f'❌ 命令超时（{timeout:.0f}秒），会话已重置'}
+
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if not ready:
+                continue
+            try:
+                chunk = os.read(self.fd, 65536)
+            except OSError:
+                chunk = b''
+            if not chunk:
+                self.close()
+                return {'success': False, 'error': '❌ Shell 已退出（可能是语法错误）',
+                        'output': buffer.decode('utf-8', 'replace')}
+            buffer += chunk
+            if len(buffer) > MAX_OUTPUT + 4096 and buffer.find(self.marker) == -1:
+                # 只保留开头，避免撑爆内存
+                del buffer[MAX_OUTPUT:len(buffer) - 4096]
+
+        end = buffer.find(self.marker)
+        trailer = buffer[end:buffer.find(b'\n', end)].decode('utf-8', 'replace').rstrip('\r').split(' ', 2)
+        output = buffer[:end].decode('utf-8', 'replace').replace('\r\n', '\n')
+        # 去掉哨兵前补的换行
+        if output.endswith('\n'):
+            output = output[:-1]
+
+        return_code = int(trailer[1])
+        self.cwd = trailer[2] if len(trailer) > 2 else self.cwd
+        self.last_used = time.time()
+        return {
+            'success': return_code == 0,
+            'output': output,
+            'return_code': return_code,
+            'cwd': self.cwd
+        }
+
+    def close(self):
+        """可重复调用、可并发调用：fd 先置为 None 再关闭，同一个 fd 号只会关闭一次"""
+        with self._close_lock:
+            fd, self.fd = self.fd, None
+            if self.proc.poll() is None:
+                try:
+                    os.killpg(self.proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                self.proc.wait()
+            if fd is not None:
+                os.close(fd)
+
+
+class SessionPool:
+    """按用户分配会话，并维持若干个预先启动的空闲 shell"""
+
+    def __init__(self, state=None, warm: int = 2, max_sessions: int = 16,
+                 idle_timeout: float = 900, shell: str = '/bin/sh'):
+        self.state = state
+        self.warm = warm
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.shell = shell
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()   # user -> ShellSession，按最近使用排序
+        self._spare = deque()
+        self._pid = None
+        self._wake = threading.Event()
+
+    # ===================== 生命周期 =====================
+
+    def _ensure_started(self):
+        """每个 worker 进程第一次使用时启动维护线程（兼容 gunicorn preload 的 fork）"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._sessions = OrderedDict()
+            self._spare = deque()
+            threading.Thread(target=self._maintain, name='shell-pool', daemon=True).start()
+
+    def _maintain(self):
+        while True:
+            try:
+                self.reap()
+                while len(self._spare) < self.warm:
+                    self._spare.append(ShellSession(self.shell))
+            except Exception as e:
+                logger.error(f"Shell 会话池维护失败: {str(e)}")
+            self._wake.wait(30)
+            self._wake.clear()
+
+    def reap(self) -> int:
+        """回收空闲超时和已退出的会话"""
+        now = time.time()
+        with self._lock:
+            # 正在执行命令的会话不回收（命令自己超时或结束后再说）
+            expired = [user for user, session in self._sessions.items()
+                       if not session.busy and
+                       (not session.alive or now - session.last_used > self.idle_timeout)]
+            victims = [self._sessions.pop(user) for user in expired]
+        for session in victims:
+            session.close()
+        if victims:
+            logger.info(f"回收 Shell 会话: {len(victims)} 个")
+        return len(victims)
+
+    def close_all(self):
+        with self._lock:
+            sessions = list(self._sessions.values()) + list(self._spare)
+            self._sessions.clear()
+            self._spare.clear()
+        for session in sessions:
+            session.close()
+
+    # ===================== 会话分配 =====================
+
+    def _cwd_key(self, user) -> str:
+        return f'shell:cwd:{user}'
+
+    def cwd_for(self, user) -> str:
+        """用户当前工作目录（跨 worker）"""
+        if self.state:
+            cwd = self.state.get(self._cwd_key(user))
+            if cwd:
+                return cwd
+        session = self._sessions.get(user)
+        return session.cwd if session else os.path.expanduser('~')
+
+    def _acquire(self, user) -> ShellSession:
+        """取得用户的会话并标记为忙，用完必须调用 _release"""
+        victim = None
+        with self._lock:
+            session = self._sessions.get(user)
+            if session and session.alive:
+                self._sessions.move_to_end(user)
+                session.busy += 1
+                return session
+
+            if len(self._sessions) >= self.max_sessions:
+                # 淘汰最久未用且空闲的会话；都在执行命令时暂时超出上限
+                idle = next((u for u, s in self._sessions.items() if not s.busy), None)
+                if idle is not None:
+                    victim = self._sessions.pop(idle)
+                else:
+                    logger.warning(f"Shell 会话都在使用中，暂时超出上限 {self.max_sessions}")
+
+            session = None
+            while self._spare and session is None:
+                candidate = self._spare.popleft()
+                session = candidate if candidate.alive else None
+            self._sessions[user] = session = session or ShellSession(self.shell)
+            session.busy += 1
+
+        if victim:
+            victim.close()
+        self._wake.set()
+        return session
+
+    def _release(self, session: ShellSession):
+        with self._lock:
+            session.busy -= 1
+
+    def run(self, user, command: str, timeout: float = 30) -> dict:
+        """在用户的会话中执行命令"""
+        self._ensure_started()
+        session = self._acquire(user)
+        try:
+            with session.lock:
+                wanted = self.cwd_for(user)
+                if wanted != session.cwd:
+                    # 上一条命令落在其他 worker：先切到同一目录
+                    command = f'cd {shlex.quote(wanted)} 2>/dev/null; {command}'
+                result = session.run(command, timeout)
+        finally:
+            self._release(session)
+
+        if self.state and result.get('cwd'):
+            self.state.set(self._cwd_key(user), result['cwd'], ttl=self.idle_timeout * 4)
+        return result
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+任务存储：紧凑 JSON + 大结果压缩归档 + 摘要索引 + 按状态保留期清理
+
+tasks/
+    <id>.json              任务本身（紧凑 JSON，外部处理程序也直接读写这个文件）
+    blobs/<id>.xz          超过 blob_threshold 的 result，lzma（或 zlib）压缩，/status 时才读取
+
+摘要索引（id、类型、描述、状态、创建时间、文件 mtime）放在共享状态 task:<id> 中，
+/tasks 只读索引；目录中 mtime 变化的文件（被外部更新过）才重新读取。
+
+后台维护（持有 "tasks" 租约的 worker 负责）：
+- 已结束且一段时间未修改的任务：大结果移入压缩文件，其余字段重写为紧凑 JSON；
+  读取前和替换前各检查一次 mtime，期间被外部程序改过的任务留到下一轮
+- 按状态的保留期删除过期任务（连同压缩文件和索引），0 表示永久保留
+"""
+
+import os
+import re
+import json
+import lzma
+import zlib
+import time
+import logging
+import threading
+
+from alerts import parse_duration
+
+logger = logging.getLogger(__name__)
+
+INDEX_PREFIX = 'task:'
+
+FINISHED = ('completed', 'failed')
+
+CODECS = {
+    'lzma': ('.xz', lambda data: lzma.compress(data, preset=6), lzma.decompress),
+    'zlib': ('.z', lambda data: zlib.compress(data, 9), zlib.decompress),
+}
+
+_TASK_ID = re.compile(r'^[\w-]{1,64}$')
+
+
+def parse_retention(value: str) -> dict:
+    """解析 "completed=30d,failed=30d,pending=90d" 格式的保留期（秒）"""
+    retention = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            status, duration = item.split('=', 1)
+            retention[status.strip()] = parse_duration(duration.strip())
+    return retention
+
+
+def _dump(task: dict) -> str:
+    return json.dumps(task, ensure_ascii=False, separators=(',', ':'))
+
+
+def _summary(task: dict, mtime: float) -> dict:
+    return {
+        'id': task.get('id'),
+        'type': task.get('type'),
+        'description': (task.get('description') or '')[:80],
+        'status': task.get('status'),
+        'created_at': task.get('created_at') or '',
+        'mtime': mtime,
+    }
+
+
+class TaskStore:
+    """任务文件的读写、索引、压缩与清理"""
+
+    def __init__(self, directory: str, state, retention: dict = None, blob_threshold: int = 4096,
+                 codec: str = 'lzma', settle: int = 300):
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, 'blobs')
+        self.state = state
+        self.retention = retention or {}
+        self.blob_threshold = blob_threshold
+        self.codec = codec if codec in CODECS else 'lzma'
+        # 外部处理程序可能还在更新的任务不压缩
+        self.settle = settle
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+    def _path(self, task_id: str) -> str:
+        return os.path.join(self.directory, f'{task_id}.json')
+
+    def _write(self, task: dict, expect: float = None) -> float:
+        """
+        原子写入，返回新的 mtime。
+        给出 expect 时在替换前再检查一次：文件的 mtime 已不是 expect（被外部改过）则放弃，返回 None
+        """
+        path = self._path(task['id'])
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(_dump(task))
+        if expect is not None and os.stat(path).st_mtime != expect:
+            os.remove(tmp)
+            return None
+        os.replace(tmp, path)
+        return os.stat(path).st_mtime
+
+    def _read(self, task_id: str) -> dict:
+        with open(self._path(task_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    # ===================== 读写 =====================
+
+    def create(self, task: dict) -> dict:
+        mtime = self._write(task)
+        self.state.set(INDEX_PREFIX + task['id'], _summary(task, mtime))
+        return task
+
+    def get(self, task_id: str) -> dict:
+        """读取任务；已归档的结果在这里解压"""
+        if not _TASK_ID.match(task_id or '') or not os.path.exists(self._path(task_id)):
+            return {'success': False, 'error': f'任务不存在: {task_id}'}
+        try:
+            task = self._read(task_id)
+            blob = task.pop('result_blob', None)
+            if blob:
+                ext, _, decompress = CODECS[blob['codec']]
+                with open(os.path.join(self.blob_dir, task_id + ext), 'rb') as f:
+                    task['result'] = decompress(f.read()).decode('utf-8')
+        except (OSError, ValueError, KeyError, lzma.LZMAError, zlib.error) as e:
+            return {'success': False, 'error': f'读取任务失败: {str(e)}'}
+        return {'success': True, 'task': task}
+
+    def list(self) -> list:
+        """所有任务的摘要（新的在前），只重新读取 mtime 变化的文件"""
+        index = {key[len(INDEX_PREFIX):]: value for key, value in self.state.items(INDEX_PREFIX)}
+        summaries = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json') or not entry.is_file():
+                    continue
+                task_id = entry.name[:-5]
+                mtime = entry.stat().st_mtime
+                summary = index.pop(task_id, None)
+                if not summary or summary['mtime'] != mtime:
+                    try:
+                        summary = dict(_summary(self._read(task_id), mtime), id=task_id)
+                    except (OSError, ValueError) as e:
+                        # 外部程序写到一半，下次再读
+                        logger.warning(f"读取任务失败: {entry.name} {str(e)}")
+                        continue
+                    self.state.set(INDEX_PREFIX + task_id, summary)
+                summaries.append(summary)
+
+        # 文件已被删除的索引
+        for task_id in index:
+            self.state.delete(INDEX_PREFIX + task_id)
+
+        summaries.sort(key=lambda s: s['created_at'], reverse=True)
+        return summaries
+
+    # ===================== 维护 =====================
+
+    def _archive(self, task: dict) -> int:
+        """把大结果移入压缩文件，返回压缩文件大小（未归档返回 0）"""
+        result = task.get('result')
+        if not isinstance(result, str) or len(result.encode('utf-8')) < self.blob_threshold:
+            return 0
+        ext, compress, _ = CODECS[self.codec]
+        data = result.encode('utf-8')
+        packed = compress(data)
+        path = os.path.join(self.blob_dir, task['id'] + ext)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(packed)
+        os.replace(tmp, path)
+        task['result'] = None
+        task['result_blob'] = {'codec': self.codec, 'size': len(data), 'stored': len(packed)}
+        return len(packed)
+
+    def _remove(self, task_id: str):
+        for path in [self._path(task_id)] + [os.path.join(self.blob_dir, task_id + ext)
+                                             for ext, _, _ in CODECS.values()]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.state.delete(INDEX_PREFIX + task_id)
+
+    def maintain(self, now: float = None) -> dict:
+        """压缩 + 清理一遍，返回统计"""
+        now = now or time.time()
+        stats = {'compacted': 0, 'deleted': 0, 'saved': 0}
+        for summary in self.list():
+            task_id, mtime = summary['id'], summary['mtime']
+            ttl = self.retention.get(summary['status'], 0)
+            try:
+                if ttl and now - mtime > ttl:
+                    self._remove(task_id)
+                    stats['deleted'] += 1
+                    continue
+
+                if summary['status'] not in FINISHED or now - mtime < self.settle:
+                    continue
+                with open(self._path(task_id), 'r', encoding='utf-8') as f:
+                    stat = os.fstat(f.fileno())
+                    # 外部程序在列出之后又改过文件：下一轮再处理
+                    if stat.st_mtime != mtime:
+                        continue
+                    task = json.load(f)
+                size = stat.st_size
+                stored = self._archive(task)
+                compact = len(_dump(task).encode('utf-8'))
+                if stored or compact < size:
+                    new_mtime = self._write(task, expect=mtime)
+                    if new_mtime is None:
+                        # 归档之后被外部改过：放弃这次重写，刚写的压缩文件不再有任务引用
+                        if stored:
+                            os.remove(os.path.join(self.blob_dir, task_id + CODECS[self.codec][0]))
+                        continue
+                    self.state.set(INDEX_PREFIX + task_id, _summary(task, new_mtime))
+                    stats['compacted'] += 1
+                    stats['saved'] += size - compact - stored
+            except (OSError, ValueError) as e:
+                logger.warning(f"维护任务失败: {task_id} {str(e)}")
+
+        # 任务文件已不存在的压缩文件
+        with os.scandir(self.blob_dir) as entries:
+            for entry in entries:
+                task_id = os.path.splitext(entry.name)[0]
+                if not entry.name.endswith('.tmp') and not os.path.exists(self._path(task_id)):
+                    os.remove(entry.path)
+        return stats
+
+    def disk_usage(self) -> dict:
+        usage = {'tasks': 0, 'blobs': 0}
+        for key, directory in (('tasks', self.directory), ('blobs', self.blob_dir)):
+            with os.scandir(directory) as entries:
+                usage[key] = sum(e.stat().st_size for e in entries if e.is_file())
+        return usage
+
+
+class TaskMaintainer:
+    """定期压缩和清理任务（持有 "tasks" 租约的 worker 负责）"""
+
+    def __init__(self, store: TaskStore, state, interval: int = 3600):
+        self.store = store
+        self.state = state
+        self.interval = interval
+        self.owner = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        # 启动后先执行一次，之后每 interval 秒一次
+        while True:
+            try:
+                if self.state.acquire_lease('tasks', self.owner, ttl=self.interval * 2):
+                    stats = self.store.maintain()
+                    if stats['compacted'] or stats['deleted']:
+                        logger.info(f"任务维护: 压缩 {stats['compacted']} 个，删除 {stats['deleted']} 个，"
+                                    f"节省 {stats['saved'] / 1024:.0f}KB")
+            except Exception as e:
+                logger.error(f"任务维护失败: {str(e)}", exc_info=True)
+            if self._stop.wait(self.interval):
+                break
+
+    def start(self):
+        if self._thread:
+            return
+        self.owner = str(os.getpid())
+        self._thread = threading.Thread(target=self._run, name='task-maintainer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.state.release_lease('tasks', self.owner)
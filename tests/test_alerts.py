@@ -0,0 +1,46 @@
+from alerts import AlertEngine, AlertRule, parse_rules
+from notifier import MessageSender, StubReceiver
+from shared_state import SharedState
+
+
+def test_parse_rules_skips_invalid():
+    rules = parse_rules('cpu > 80 for 5m; disk>90; process:nginx missing; bogus')
+    assert [(r.metric, r.process, r.duration) for r in rules] == [
+        ('cpu', None, 300), ('disk', None, 0), (None, 'nginx', 0)]
+
+
+def test_alert_fires_after_duration_and_recovers(tmp_path):
+    state = SharedState(str(tmp_path / 'state.db'))
+    metrics = {'cpu': 95.0}
+    with StubReceiver() as stub:
+        sender = MessageSender(stub.url, state, rate=100, burst=10, batch_window=0.05)
+        engine = AlertEngine([AlertRule('cpu > 80 for 1m')], lambda with_processes: metrics,
+                             sender.send, state, repeat=600)
+
+        # 未满持续时长不推送，满足后推送一次，提醒间隔内不重复
+        assert engine.evaluate(now=1000) == []
+        assert len(engine.evaluate(now=1060)) == 1
+        assert engine.evaluate(now=1120) == []
+        assert len(engine.evaluate(now=1700)) == 1
+
+        metrics['cpu'] = 10.0
+        assert len(engine.evaluate(now=1710)) == 1
+        assert engine.evaluate(now=1720) == []
+
+        # 相继到达的消息可能被合并成一条
+        with stub.received:
+            assert stub.received.wait_for(lambda: '已恢复' in '\n\n'.join(stub.messages), 5)
+    received = '\n\n'.join(stub.messages)
+    assert received.count('🚨 **告警** CPU > 80%（持续 1 分钟）') == 1
+    assert received.count('告警持续中') == 1
+    assert received.count('✅ **已恢复**') == 1
+
+
+def test_missing_process(tmp_path):
+    state = SharedState(str(tmp_path / 'state.db'))
+    sent = []
+    engine = AlertEngine([AlertRule('process:nginx missing')],
+                         lambda with_processes: {'processes': ['sshd'] if with_processes else []},
+                         lambda text: sent.append(text) or {'success': True}, state)
+    engine.evaluate(now=1000)
+    assert sent == ['🚨 **告警** 进程 nginx 未运行\n当前: 未运行']
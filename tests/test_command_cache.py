@@ -0,0 +1,32 @@
+import threading
+import time
+
+from command_cache import CommandCache
+from deadline import deadline_scope, wait_late
+from shared_state import SharedState
+
+
+def test_pending_join_does_not_run_command_again(tmp_path):
+    cache = CommandCache(SharedState(str(tmp_path / 'state.db')), ttl=10)
+    runs = []
+    release = threading.Event()
+
+    def compute():
+        runs.append(1)
+        release.wait(5)
+        return 'output'
+
+    owner = threading.Thread(target=cache.run, args=('df -h', '/', compute))
+    owner.start()
+    time.sleep(0.1)
+
+    late = []
+    with deadline_scope(0.2):
+        result = cache.run('df -h', '/', compute, on_late=late.append)
+    assert result['source'] == 'pending'
+
+    release.set()
+    owner.join()
+    assert wait_late(5) == 0
+    assert late == ['output']
+    assert len(runs) == 1
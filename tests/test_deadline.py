@@ -0,0 +1,61 @@
+import threading
+import time
+
+import pytest
+
+from deadline import budget, deadline_scope, run_within, start_late, wait_late
+
+
+def test_budget_is_capped_by_remaining_time():
+    assert budget(30) == 30
+    with deadline_scope(2):
+        assert 1.5 < budget(30) <= 2
+        assert budget(30, reserve=1) <= 1
+        assert budget(0.5) == 0.5
+    with deadline_scope(0):
+        assert budget(30) == 30
+
+
+def test_run_within_returns_result_in_time():
+    with deadline_scope(2):
+        assert run_within(lambda: 42) == (True, 42)
+
+
+def test_run_within_reraises_errors():
+    with deadline_scope(2):
+        with pytest.raises(ZeroDivisionError):
+            run_within(lambda: 1 / 0)
+
+
+def test_run_within_without_deadline_runs_inline():
+    caller = threading.current_thread()
+    assert run_within(lambda: threading.current_thread() is caller) == (True, True)
+
+
+def test_late_result_goes_to_on_late():
+    late = []
+    delivered = threading.Event()
+
+    def slow():
+        time.sleep(0.3)
+        return 'done'
+
+    def on_late(result):
+        late.append(result)
+        delivered.set()
+
+    start = time.monotonic()
+    with deadline_scope(0.5):
+        assert run_within(slow, on_late, reserve=0.4) == (False, None)
+    # 截止前 reserve 秒就返回，不等 fn 完成
+    assert time.monotonic() - start < 0.25
+    assert delivered.wait(2)
+    assert late == ['done']
+
+
+def test_late_threads_drop_the_deadline():
+    seen = []
+    with deadline_scope(0.1):
+        start_late(lambda: seen.append(budget(30)))
+    assert wait_late(2) == 0
+    assert seen == [30]
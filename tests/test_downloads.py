@@ -0,0 +1,50 @@
+import gzip
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+from downloads import gzip_stream, make_link, resolve_allowed, verify_link
+
+
+def _args(link: str) -> dict:
+    return dict(parse_qsl(urlsplit(link).query))
+
+
+def test_valid_link():
+    args = _args(make_link('http://nas:5000/', '/data/a b.txt', 'key', compress=True))
+    assert verify_link(args, 'key') == {'success': True, 'path': '/data/a b.txt', 'compress': True}
+
+
+def test_tampered_link_is_rejected():
+    args = _args(make_link('http://nas:5000', '/data/a.txt', 'key'))
+    other = _args(make_link('http://nas:5000', '/etc/passwd', 'key'))
+
+    for field, value in (('p', other['p']), ('e', str(int(args['e']) + 3600)), ('z', '1')):
+        assert verify_link(dict(args, **{field: value}), 'key')['error'] == '签名无效'
+    assert verify_link(args, 'other-key')['error'] == '签名无效'
+    assert verify_link(dict(args, p='%%%'), 'key')['success'] is False
+
+
+def test_expired_link_is_rejected(monkeypatch):
+    args = _args(make_link('http://nas:5000', '/data/a.txt', 'key', ttl=60))
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert verify_link(args, 'key')['error'] == '链接已过期'
+
+
+def test_resolve_allowed_blocks_symlink_escape(tmp_path):
+    allowed, outside = tmp_path / 'share', tmp_path / 'private'
+    allowed.mkdir()
+    outside.mkdir()
+    (outside / 'secret').write_text('x')
+    (allowed / 'file').write_text('x')
+    (allowed / 'link').symlink_to(outside / 'secret')
+
+    assert resolve_allowed(str(allowed / 'file'), [str(allowed)])['success']
+    assert not resolve_allowed(str(allowed / 'link'), [str(allowed)])['success']
+    assert not resolve_allowed(str(allowed / '..' / 'private' / 'secret'), [str(allowed)])['success']
+
+
+def test_gzip_stream(tmp_path):
+    path = tmp_path / 'log.txt'
+    path.write_bytes(b'line\n' * 200000)
+    assert gzip.decompress(b''.join(gzip_stream(str(path)))) == b'line\n' * 200000
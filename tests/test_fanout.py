@@ -0,0 +1,72 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fanout import FanoutClient, parse_groups, parse_hosts
+
+
+@pytest.fixture
+def agent():
+    """本地 /agent/run：回显命令；命令为 sleep 时超过客户端的超时"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if self.path != '/agent/run' or self.headers.get('X-Agent-Token') != 'secret':
+                self.send_response(403)
+                self.end_headers()
+                return
+            if payload['command'] == 'sleep':
+                # 客户端此时已超时断开，不再回复
+                time.sleep(payload['timeout'] + 0.5)
+                return
+            body = json.dumps({'success': True, 'output': payload['command'],
+                               'timeout': payload['timeout']}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def test_parse_and_resolve():
+    hosts = parse_hosts('web1=http://a:1/, web2=http://b:2,db1=http://c:3')
+    groups = parse_groups('web=web1|web2|gone,db=db1')
+    client = FanoutClient(hosts, groups, 'secret')
+    assert hosts['web1'] == 'http://a:1'
+    assert client.resolve('web') == ['web1', 'web2']
+    assert client.resolve('all') == ['web1', 'web2', 'db1']
+    assert client.split_target('df -h @web') == ('df -h', ['web1', 'web2'])
+    assert client.split_target('ssh user@web1') is None
+    assert client.split_target('df -h @unknown') is None
+
+
+def test_run_collects_every_host(agent):
+    client = FanoutClient({'a': agent, 'b': agent}, {}, 'secret', timeout=5)
+    results = client.run(['a', 'b'], {'command': 'uptime'}, timeout=2)
+    assert {name: r['output'] for name, r in results.items()} == {'a': 'uptime', 'b': 'uptime'}
+    # agent 收到的是本次调用的超时，而不是客户端默认值
+    assert results['a']['timeout'] == 2
+
+
+def test_slow_and_failing_hosts(agent):
+    client = FanoutClient({'slow': agent, 'down': 'http://127.0.0.1:9'}, {}, 'secret')
+    start = time.monotonic()
+    results = client.run(['slow', 'down'], {'command': 'sleep'}, timeout=0.5)
+    assert time.monotonic() - start < 1.5
+    assert (results['slow']['success'], results['slow']['error']) == (False, '超时')
+    assert results['down']['success'] is False
+
+    client.token = 'wrong'
+    assert client.run(['slow'], {'command': 'uptime'}, timeout=2)['slow']['error'] == 'HTTP 403'
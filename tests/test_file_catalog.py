@@ -0,0 +1,102 @@
+import os
+import time
+
+import pytest
+
+import file_catalog
+from file_catalog import CatalogStore, parse_query, run_query, scan
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def backend(request, monkeypatch):
+    if request.param == 'python':
+        monkeypatch.setattr(file_catalog, 'numpy', None)
+    elif file_catalog.numpy is None:
+        pytest.skip('numpy 未安装')
+    return request.param
+
+
+def _tree(tmp_path):
+    old = time.time() - 2 * 365 * 86400
+    files = {'a.mp4': 300, 'b.MP4': 100, 'docs/c.txt': 10, 'docs/d': 20, 'e.log': 5}
+    for name, size in files.items():
+        path = tmp_path / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b'x' * size)
+    os.utime(tmp_path / 'a.mp4', (old, old))
+    return tmp_path
+
+
+def test_parse_query():
+    query = parse_query('~/Downloads size > 100M age>1y ext=mp4,.mkv,- by ext top 5')
+    assert query['root'] == '~/Downloads'
+    assert query['filters'][0] == ('size', '>', 100 * 1024 ** 2)
+    # age>1y 即 mtime 早于一年前
+    assert query['filters'][1][:2] == ('mtime', '<')
+    assert query['exts'] == ['.mp4', '.mkv', '']
+    assert (query['group'], query['limit']) == ('ext', 5)
+
+    with pytest.raises(ValueError):
+        parse_query('by owner')
+    with pytest.raises(ValueError):
+        parse_query('size>lots')
+
+
+def test_filter_and_sort(tmp_path, backend):
+    catalog = scan(str(_tree(tmp_path)))
+    result = run_query(catalog, parse_query('ext=mp4'))
+    assert (result['matched'], result['matched_size']) == (2, 400)
+    assert [os.path.basename(p) for p, _, _ in result['rows']] == ['a.mp4', 'b.MP4']
+
+    result = run_query(catalog, parse_query('age>1y'))
+    assert [os.path.basename(p) for p, _, _ in result['rows']] == ['a.mp4']
+
+    result = run_query(catalog, parse_query('size<50 sort age top 1'))
+    assert result['matched'] == 3 and len(result['rows']) == 1
+
+
+def test_group(tmp_path, backend):
+    catalog = scan(str(_tree(tmp_path)))
+    result = run_query(catalog, parse_query('by ext'))
+    assert result['groups'] == [('.mp4', 2, 400), ('(无扩展名)', 1, 20), ('.txt', 1, 10), ('.log', 1, 5)]
+    result = run_query(catalog, parse_query('by dir'))
+    assert dict((name, size) for name, _, size in result['groups']) == {'.': 405, 'docs': 30}
+
+
+def test_extension_overflow(tmp_path, backend, monkeypatch):
+    # 编号用完后新的扩展名归入单独的"其他"，不会混进已有的扩展名
+    monkeypatch.setattr(file_catalog, 'OTHER_EXT', 2)
+    for name in ('a.x', 'b.y', 'c.z', 'd.w', 'e.x'):
+        (tmp_path / name).write_bytes(b'x')
+    catalog = scan(str(tmp_path))
+    assert len(catalog.meta['extensions']) == 2
+
+    # 哪两个扩展名先拿到编号取决于遍历顺序
+    counts = {'.x': 2, '.y': 1, '.z': 1, '.w': 1}
+    named = catalog.meta['extensions']
+    groups = {name: count for name, count, _ in run_query(catalog, parse_query('by ext'))['groups']}
+    assert groups == {**{e: counts[e] for e in named}, '(其他扩展名)': 5 - sum(counts[e] for e in named)}
+    for ext in named:
+        assert run_query(catalog, parse_query('ext=' + ext))['matched'] == counts[ext]
+
+
+def test_save_keeps_replaced_version(tmp_path):
+    store = CatalogStore(str(tmp_path / 'store'))
+    (tmp_path / 'data').mkdir()
+    root = _tree(tmp_path / 'data')
+    base = store._base(str(root))
+    versions = []
+    for _ in range(3):
+        store.scan(str(root))
+        versions.append(os.readlink(os.path.join(base, 'current')))
+
+    # 最新版本和被替换的上一个版本保留，更早的删除，临时目录不残留
+    entries = sorted(e for e in os.listdir(base) if e != 'current')
+    assert entries == sorted(versions[1:])
+    assert store.load(str(root)).count == 5
+
+    # 其他 worker 正在写的临时目录不会被删除
+    pending = os.path.join(base, f'.tmp-{time.time_ns()}-1')
+    os.makedirs(pending)
+    store.scan(str(root))
+    assert os.path.isdir(pending)
@@ -0,0 +1,58 @@
+import os
+import time
+
+from metrics_store import MetricsStore, history_text, parse_range, resolve_series
+
+
+def _at(hour: int) -> float:
+    return time.mktime((2026, 3, 10, hour, 0, 0, 0, 0, -1))
+
+
+def test_last_night_before_eight():
+    # 凌晨 3 点：昨天 20:00 到现在
+    start, end, _ = parse_range('昨晚 CPU', now=_at(3))
+    assert start == time.mktime((2026, 3, 9, 20, 0, 0, 0, 0, -1))
+    assert end == _at(3)
+
+
+def test_last_night_in_the_evening():
+    # 晚上 10 点：昨天 20:00 到今天 08:00
+    start, end, _ = parse_range('last night', now=_at(22))
+    assert start == time.mktime((2026, 3, 9, 20, 0, 0, 0, 0, -1))
+    assert end == _at(8)
+
+
+def test_relative_range():
+    now = _at(12)
+    assert parse_range('过去 6 小时', now=now)[:2] == (now - 6 * 3600, now)
+    assert parse_range('cpu 30m', now=now)[:2] == (now - 1800, now)
+    assert parse_range('cpu', now=now)[:2] == (now - 3600, now)
+
+
+def test_stale_series_evicted_when_full(tmp_path):
+    store = MetricsStore(str(tmp_path), archives=((10, 6),), max_series=2, expire=3600)
+    store.record({'cpu': 1, 'proc.old.cpu': 2}, ts=1000)
+    old = time.time() - 7200
+    os.utime(store._path('proc.old.cpu'), (old, old))
+
+    store.record({'proc.new.cpu': 3}, ts=1010)
+    assert store.series() == ['cpu', 'proc.new.cpu']
+
+    # 没有可删除的序列时丢弃新序列
+    store.record({'proc.other.cpu': 4}, ts=1020)
+    assert store.series() == ['cpu', 'proc.new.cpu']
+
+
+def test_tonight_is_not_last_night():
+    now = _at(22)
+    assert parse_range('今天晚上 cpu', now=now)[2] != '昨晚 20:00 → 08:00'
+
+
+def test_process_names_with_dots(tmp_path):
+    store = MetricsStore(str(tmp_path), archives=((10, 6),))
+    store.record({'proc.php-fpm8.1.cpu': 1, 'proc.python3.11.mem': 2}, ts=1000)
+    known = store.series()
+
+    assert [s for s, _, _ in resolve_series('php-fpm8.1 12h', known)] == ['proc.php-fpm8.1.cpu']
+    assert [s for s, _, _ in resolve_series('python3.11.mem', known)] == ['proc.python3.11.mem']
+    assert 'php-fpm8.1, python3.11' in history_text(store, '')
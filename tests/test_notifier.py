@@ -0,0 +1,52 @@
+from notifier import MessageSender, StubReceiver, split_message
+from shared_state import SharedState
+
+
+def test_short_message_is_not_split():
+    assert split_message('hello', limit=10) == ['hello']
+
+
+def test_chunks_respect_limit_and_keep_lines():
+    text = '\n'.join(f'line {i}' for i in range(100))
+    chunks = split_message(text, limit=60)
+    assert all(len(chunk) <= 60 for chunk in chunks)
+    assert '\n'.join(chunks) == text
+
+
+def test_long_line_is_hard_wrapped():
+    chunks = split_message('x' * 250, limit=100)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert ''.join(chunks) == 'x' * 250
+
+
+def test_fence_is_closed_and_reopened():
+    text = 'intro\n```bash\n' + '\n'.join(f'echo {i}' for i in range(40)) + '\n```\noutro'
+    chunks = split_message(text, limit=80)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert len(chunk) <= 80
+        # 每段的代码块都是闭合的
+        assert chunk.count('```') % 2 == 0
+    assert all(chunk.startswith('```bash') for chunk in chunks[1:-1])
+    assert chunks[-1].endswith('outro')
+
+
+def test_sender_batches_small_messages(tmp_path):
+    state = SharedState(str(tmp_path / 'state.db'))
+    with StubReceiver() as stub:
+        sender = MessageSender(stub.url, state, rate=100, burst=10, batch_window=0.2)
+        for i in range(3):
+            sender.send(f'msg {i}')
+        assert stub.wait_for(1)
+    assert stub.messages[0] == 'msg 0\n\nmsg 1\n\nmsg 2'
+
+
+def test_sender_splits_long_message(tmp_path):
+    state = SharedState(str(tmp_path / 'state.db'))
+    with StubReceiver() as stub:
+        sender = MessageSender(stub.url, state, rate=100, burst=10, limit=50, batch_window=0)
+        text = '\n'.join(f'line {i:02d}' for i in range(20))
+        sender.send(text)
+        assert stub.wait_for(len(split_message(text, 50)))
+    assert all(len(message) <= 50 for message in stub.messages)
+    assert '\n'.join(stub.messages) == text
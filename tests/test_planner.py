@@ -0,0 +1,56 @@
+import pytest
+
+from planner import check_command, make_plan, validate_plan
+
+ALLOWED = {'ls', 'cat', 'grep', 'find', 'ps', 'kill', 'pkill', 'df', 'du', 'head', 'wc'}
+
+
+@pytest.mark.parametrize('command', [
+    'df -h',
+    'du -sh /var/log',
+    'ps aux | grep nginx | head -5',
+    'find /var/log -name "*.log" -size +10M',
+])
+def test_read_only_commands_allowed(command):
+    assert check_command(command, ALLOWED) is None
+
+
+@pytest.mark.parametrize('command', [
+    'find /tmp -name "*.log" -delete',
+    'find / -exec rm {} +',
+    'find . -execdir rm {} ;',
+    'find . -ok rm {} +',
+    'find . -okdir rm {} +',
+    'find . -fprint /etc/passwd',
+    'ls | find . -delete',
+])
+def test_destructive_find_rejected(command):
+    assert check_command(command, ALLOWED)
+
+
+@pytest.mark.parametrize('command', ['kill 1', 'pkill nginx', 'ps aux | kill -9 1', '/bin/kill 1'])
+def test_kill_not_auto_run(command):
+    assert check_command(command, ALLOWED)
+
+
+@pytest.mark.parametrize('command', ['rm -rf /', 'ls; rm -rf /', 'cat $(ls)', 'ls > /tmp/x', 'ls `id`'])
+def test_shell_syntax_and_unknown_commands_rejected(command):
+    assert check_command(command, ALLOWED)
+
+
+def test_llm_plan_with_destructive_step_rejected():
+    steps = [
+        {'id': 's1', 'kind': 'shell', 'args': 'df -h', 'deps': []},
+        {'id': 's2', 'kind': 'shell', 'args': 'find /var/log -mtime +30 -delete', 'deps': []},
+    ]
+    assert validate_plan(steps, ALLOWED)
+
+
+def test_explicit_kill_in_message_rejected_without_llm():
+    plan = make_plan('检查磁盘然后执行 `pkill nginx`', ALLOWED)
+    assert not plan['success'] and plan['rejected']
+
+
+def test_llm_plan_empty_means_single_step():
+    plan = make_plan('你好，然后呢', ALLOWED, ask=lambda prompt: '{"steps": []}')
+    assert not plan['success'] and not plan.get('rejected')
@@ -0,0 +1,21 @@
+from shared_state import SharedState, SingleFlight
+
+
+def test_ttl_none_never_expires_and_zero_is_not_stored(tmp_path):
+    state = SharedState(str(tmp_path / 'state.db'))
+    state.set('forever', 1)
+    state.set('gone', 1, ttl=0)
+    assert state.get('forever') == 1
+    assert state.get('gone') is None
+
+    state.set('forever', 2, ttl=0)
+    assert state.get('forever') is None
+
+
+def test_single_flight_without_result_ttl_does_not_cache(tmp_path):
+    flight = SingleFlight(SharedState(str(tmp_path / 'state.db')), 'test', result_ttl=0)
+    calls = []
+    compute = lambda: calls.append(1) or len(calls)
+
+    assert flight.do('k', compute)['value'] == 1
+    assert flight.do('k', compute) == {'value': 2, 'source': 'computed', 'age': 0.0}
@@ -0,0 +1,73 @@
+import json
+import os
+import time
+
+from shared_state import SharedState
+from task_store import TaskStore, parse_retention
+
+
+def _store(tmp_path, **kwargs):
+    state = SharedState(str(tmp_path / 'state.db'))
+    return TaskStore(str(tmp_path / 'tasks'), state, blob_threshold=100, settle=0, **kwargs)
+
+
+def _age(store, task_id, seconds):
+    old = time.time() - seconds
+    os.utime(store._path(task_id), (old, old))
+
+
+def test_parse_retention():
+    assert parse_retention('completed=30d, failed=12h,pending=0') == \
+        {'completed': 30 * 86400, 'failed': 12 * 3600, 'pending': 0}
+
+
+def test_large_result_is_archived(tmp_path):
+    store = _store(tmp_path)
+    result = 'output line\n' * 500
+    store.create({'id': 'big', 'status': 'completed', 'result': result, 'description': 'x'})
+    store.create({'id': 'running', 'status': 'pending', 'result': result})
+
+    stats = store.maintain()
+    assert stats['compacted'] == 1 and stats['saved'] > 0
+    with open(store._path('big'), encoding='utf-8') as f:
+        assert json.load(f)['result'] is None
+    assert os.listdir(store.blob_dir) == ['big.xz']
+    assert store.get('big')['task']['result'] == result
+    assert store.get('running')['task']['result'] == result
+
+    # 已经归档过的不再重写
+    assert store.maintain()['compacted'] == 0
+
+
+def test_expired_tasks_are_deleted(tmp_path):
+    store = _store(tmp_path, retention={'failed': 86400})
+    store.create({'id': 'old', 'status': 'failed', 'result': 'x' * 500})
+    store.maintain()
+    store.create({'id': 'new', 'status': 'failed'})
+    store.create({'id': 'kept', 'status': 'completed'})
+    _age(store, 'old', 2 * 86400)
+    _age(store, 'kept', 2 * 86400)
+
+    assert store.maintain()['deleted'] == 1
+    assert sorted(s['id'] for s in store.list()) == ['kept', 'new']
+    assert os.listdir(store.blob_dir) == []
+    assert not store.get('old')['success']
+
+
+def test_external_update_during_archive_wins(tmp_path, monkeypatch):
+    store = _store(tmp_path)
+    store.create({'id': 't', 'status': 'completed', 'result': 'a' * 500})
+    _age(store, 't', 60)
+    archive = store._archive
+
+    def archive_then_external_write(task):
+        stored = archive(task)
+        # 外部处理程序在归档和重写之间更新了任务
+        with open(store._path('t'), 'w', encoding='utf-8') as f:
+            json.dump({'id': 't', 'status': 'completed', 'result': 'b' * 500}, f)
+        return stored
+
+    monkeypatch.setattr(store, '_archive', archive_then_external_write)
+    assert store.maintain()['compacted'] == 0
+    assert store.get('t')['task']['result'] == 'b' * 500
+    assert os.listdir(store.blob_dir) == []
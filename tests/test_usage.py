@@ -0,0 +1,40 @@
+from shared_state import SharedState
+from usage import UsageTracker, _day, choose_model
+
+
+def test_model_names_with_colons(tmp_path):
+    tracker = UsageTracker(SharedState(str(tmp_path / 'state.db')))
+    tracker.record('alice', 'chat', 'qwen2.5:7b', {'prompt': 10, 'completion': 5})
+    tracker.record('alice', 'plan', 'glm-4', {'prompt': 1, 'completion': 1})
+
+    report = tracker.aggregate()
+    assert report['total'] == 17 and report['calls'] == 2
+    assert report['by_model'] == {'qwen2.5:7b': 15, 'glm-4': 2}
+    assert report['by_intent'] == {'chat': 15, 'plan': 2}
+    assert report['by_user'] == {'alice': 17}
+
+
+def test_old_key_layout_is_still_read(tmp_path):
+    state = SharedState(str(tmp_path / 'state.db'))
+    state.incr(f'usage:{_day()}:bob:chat:glm-4:prompt', 7)
+    state.incr(f'usage:{_day()}:bob:chat:glm-4:calls', 1)
+    report = UsageTracker(state).aggregate(user='bob')
+    assert (report['total'], report['calls'], report['by_model']) == (7, 1, {'glm-4': 7})
+
+
+def test_budgets(tmp_path):
+    tracker = UsageTracker(SharedState(str(tmp_path / 'state.db')), user_budget=100, daily_budget=150)
+    tracker.record('alice', 'chat', 'glm-4', {'prompt': 80, 'completion': 20})
+    assert tracker.over_user_budget('alice')
+    assert not tracker.over_user_budget('bob')
+    assert not tracker.over_daily_budget()
+    tracker.record('bob', 'chat', 'glm-4', {'prompt': 50, 'completion': 0})
+    assert tracker.over_daily_budget()
+
+
+def test_choose_model():
+    assert choose_model('你好', 'big', '') == 'big'
+    assert choose_model('你好', 'big', 'fast') == 'fast'
+    assert choose_model('帮我写一个备份脚本', 'big', 'fast') == 'big'
+    assert choose_model('x' * 100, 'big', 'fast') == 'big'
+    assert choose_model('帮我写一个备份脚本', 'big', 'fast', downgrade=True) == 'fast'
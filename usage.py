@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+LLM Token 用量统计、预算与按成本路由
+
+- 每次调用后从响应的 usage 中取 prompt/completion tokens，按 天 / 用户 / 意图 / 模型
+  累加到共享状态（原子计数器，所有 worker 共用）
+- 预算：用户当日用量超过 user_budget 后只能用便宜模型；全局当日用量超过
+  daily_budget 后暂停对话类调用
+- 路由：短小简单的闲聊走快速便宜的模型，长消息或包含复杂度信号的请求走大模型
+"""
+
+import re
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 每日计数保留天数
+RETENTION_DAYS = 90
+
+# 每次调用累加的计数字段
+FIELDS = ('prompt', 'completion', 'calls')
+
+# 出现这些信号时认为请求较复杂，使用大模型
+COMPLEX_HINTS = re.compile(
+    r'```|分析|解释|为什么|原理|代码|脚本|详细|步骤|方案|对比|总结|翻译|写一|优化|排查|'
+    r'\b(why|how|explain|analy[sz]e|code|script|compare|summari[sz]e|debug)\b',
+    re.IGNORECASE
+)
+
+
+def _day(offset: int = 0) -> str:
+    return time.strftime('%Y%m%d', time.localtime(time.time() - offset * 86400))
+
+
+def extract_usage(response) -> dict:
+    """从 OpenAI 兼容（智谱 GLM）的响应中取出 token 用量"""
+    usage = getattr(response, 'usage', None)
+    prompt = getattr(usage, 'prompt_tokens', 0) or 0
+    completion = getattr(usage, 'completion_tokens', 0) or 0
+    return {'prompt': prompt, 'completion': completion}
+
+
+class UsageTracker:
+    """用量统计与预算检查"""
+
+    def __init__(self, state, user_budget: int = 0, daily_budget: int = 0):
+        self.state = state
+        self.user_budget = user_budget
+        self.daily_budget = daily_budget
+
+    def record(self, user, intent: str, model: str, usage: dict):
+        """记录一次调用的用量"""
+        day = _day()
+        ttl = RETENTION_DAYS * 86400
+        total = usage['prompt'] + usage['completion']
+        # 模型名可能包含 ":"（如 "qwen2.5:7b"），放在键的最后
+        base = f'usage:{day}:{user or "-"}:{intent}'
+
+        self.state.incr(f'{base}:prompt:{model}', usage['prompt'], ttl=ttl)
+        self.state.incr(f'{base}:completion:{model}', usage['completion'], ttl=ttl)
+        self.state.incr(f'{base}:calls:{model}', 1, ttl=ttl)
+        # 预算检查用的汇总计数
+        self.state.incr(f'usage_total:{day}:user:{user or "-"}', total, ttl=2 * 86400)
+        self.state.incr(f'usage_total:{day}:all', total, ttl=2 * 86400)
+
+    def used_today(self, user=None) -> int:
+        key = f'usage_total:{_day()}:all' if user is None else f'usage_total:{_day()}:user:{user}'
+        return self.state.get(key, 0)
+
+    def over_user_budget(self, user) -> bool:
+        return bool(self.user_budget) and self.used_today(user) >= self.user_budget
+
+    def over_daily_budget(self) -> bool:
+        return bool(self.daily_budget) and self.used_today() >= self.daily_budget
+
+    # ===================== 报表 =====================
+
+    def aggregate(self, days: int = 1, user=None) -> dict:
+        """最近 days 天的用量：{'total', 'calls', 'by_user', 'by_intent', 'by_model', 'by_day'}"""
+        report = {'total': 0, 'calls': 0, 'by_user': {}, 'by_intent': {}, 'by_model': {}, 'by_day': {}}
+        for offset in range(days):
+            day = _day(offset)
+            for key, value in self.state.items(f'usage:{day}:'):
+                _, _, key_user, intent, rest = key.split(':', 4)
+                field, _, model = rest.partition(':')
+                if field not in FIELDS:
+                    # 旧格式 usage:天:用户:意图:模型:字段
+                    model, _, field = rest.rpartition(':')
+                if user is not None and key_user != str(user):
+                    continue
+                if field == 'calls':
+                    report['calls'] += value
+                    continue
+                report['total'] += value
+                for group, name in (('by_user', key_user), ('by_intent', intent),
+                                    ('by_model', model), ('by_day', day)):
+                    report[group][name] = report[group].get(name, 0) + value
+        return report
+
+    def report_text(self, args: list, user) -> str:
+        """/usage [today|7d|30d] [me]"""
+        days = 1
+        for arg in args:
+            match = re.match(r'^(\d+)d$', arg)
+            if match:
+                days = min(int(match.group(1)), RETENTION_DAYS)
+        only_me = 'me' in args
+        report = self.aggregate(days, user if only_me else None)
+
+        title = '今天' if days == 1 else f'最近 {days} 天'
+        output = f"📈 **Token 用量**（{title}{'，仅自己' if only_me else ''}）\n\n"
+        output += f"总计: {report['total']:,} tokens，{report['calls']:,} 次调用\n"
+
+        def section(name, data, limit=8):
+            if not data:
+                return ''
+            items = sorted(data.items(), key=lambda x: x[1], reverse=True)[:limit]
+            return f"\n**{name}**\n" + '\n'.join(f"- {k}: {v:,}" for k, v in items) + '\n'
+
+        if not only_me:
+            output += section('按用户', report['by_user'])
+        output += section('按意图', report['by_intent'])
+        output += section('按模型', report['by_model'])
+        if days > 1:
+            output += section('按天', dict(sorted(report['by_day'].items())), limit=days)
+
+        if self.user_budget:
+            output += f"\n你今天的用量: {self.used_today(user):,} / {self.user_budget:,}"
+        if self.daily_budget:
+            output += f"\n全局今天的用量: {self.used_today():,} / {self.daily_budget:,}"
+        return output
+
+
+# ===================== 模型路由 =====================
+
+def choose_model(message: str, big_model: str, fast_model: str, short_chars: int = 60,
+                 downgrade: bool = False) -> str:
+    """
+    选择模型：没有配置快速模型时总是用大模型；
+    超预算（downgrade）或短小简单的消息用快速模型
+    """
+    if not fast_model:
+        return big_model
+    if downgrade:
+        return fast_model
+    if len(message) <= short_chars and message.count('\n') < 2 and not COMPLEX_HINTS.search(message):
+        return fast_model
+    return big_model